@@ -0,0 +1,23 @@
+"""Helpers shared by the ETBII web semantic notebooks.
+
+The notebooks import this package from the ``docs/`` directory, which is the
+working directory of the kernels started by ``jupyter-book build docs/``.
+Setting ``ETBII_TRACE`` traces the SPARQL requests and graph operations of
+the kernel, see :mod:`etbii.trace`.
+"""
+
+import os
+
+from etbii.cache import CachedSPARQLWrapper, SPARQLCache
+from etbii.query import normalize_query
+
+if os.environ.get("ETBII_TRACE", "0") != "0":
+    from etbii.trace import install
+
+    install()
+
+__all__ = [
+    "CachedSPARQLWrapper",
+    "SPARQLCache",
+    "normalize_query",
+]
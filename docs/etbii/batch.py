@@ -0,0 +1,141 @@
+"""Inject long lists of values in a query through batched ``VALUES`` clauses.
+
+Notebook 3 joins ``list_of_genes`` into a single ``VALUES`` clause. With a
+whole interactome the query grows past what endpoints accept (``URITooLong``,
+timeouts). The helpers below split the values into chunks bounded both in
+number of values and in bytes, render one query per chunk from a template,
+and merge the results of the chunks in chunk order::
+
+    requests = batched_requests(
+        "expression", "http://bgee.org/sparql", template, "geneName", list_of_genes
+    )
+    KG = await gather_batches(QueryRunner(), requests)
+
+The template marks the place of the clause with :data:`PLACEHOLDER`.
+"""
+
+from rdflib import Graph
+
+from etbii.runner import SPARQLRequest
+
+PLACEHOLDER = "%VALUES%"
+DEFAULT_MAX_VALUES = 200
+DEFAULT_MAX_BYTES = 4096
+
+_ESCAPES = str.maketrans(
+    {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+)
+
+
+def sparql_term(value):
+    """Render ``value`` as a SPARQL term.
+
+    rdflib terms are written with their N3 syntax, other values as string
+    literals.
+    """
+    if hasattr(value, "n3"):
+        return value.n3()
+    return '"%s"' % str(value).translate(_ESCAPES)
+
+
+def values_clause(variable, values):
+    """Return ``VALUES ?variable { ... }`` for ``values``."""
+    terms = " ".join(sparql_term(value) for value in values)
+    return "VALUES ?%s { %s }" % (variable.lstrip("?$"), terms)
+
+
+def chunk_values(values, max_values=DEFAULT_MAX_VALUES, max_bytes=DEFAULT_MAX_BYTES):
+    """Split ``values`` into lists of at most ``max_values`` values.
+
+    A chunk is also closed before its rendered terms exceed ``max_bytes``
+    UTF-8 bytes; a single value longer than that gets a chunk of its own.
+    Duplicate values are dropped, the order of first occurrence is kept.
+    """
+    chunk, size, seen = [], 0, set()
+    for value in values:
+        if value in seen:
+            continue
+        seen.add(value)
+        term_size = len(sparql_term(value).encode("utf-8")) + 1
+        if chunk and (len(chunk) >= max_values or size + term_size > max_bytes):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(value)
+        size += term_size
+    if chunk:
+        yield chunk
+
+
+def batched_requests(
+    name,
+    endpoint,
+    template,
+    variable,
+    values,
+    return_format=None,
+    max_values=DEFAULT_MAX_VALUES,
+    max_bytes=DEFAULT_MAX_BYTES,
+):
+    """Return one :class:`~etbii.runner.SPARQLRequest` per chunk of ``values``.
+
+    The requests are named ``name/0``, ``name/1``, ... in chunk order.
+    """
+    if PLACEHOLDER not in template:
+        raise ValueError("the query template has no %s placeholder" % PLACEHOLDER)
+    return [
+        SPARQLRequest(
+            "%s/%d" % (name, index),
+            endpoint,
+            template.replace(PLACEHOLDER, values_clause(variable, chunk)),
+            return_format,
+        )
+        for index, chunk in enumerate(chunk_values(values, max_values, max_bytes))
+    ]
+
+
+def merge_results(results, distinct=False):
+    """Merge the converted results of the chunks, in the given order.
+
+    Graphs (CONSTRUCT, DESCRIBE) are merged into a new :class:`rdflib.Graph`.
+    SPARQL JSON results are concatenated, dropping repeated rows when
+    ``distinct`` is set.
+    """
+    results = list(results)
+    if not results:
+        return Graph()
+    if isinstance(results[0], Graph):
+        merged = Graph()
+        for prefix, namespace in results[0].namespaces():
+            merged.bind(prefix, namespace, override=False)
+        for graph in results:
+            for triple in graph.triples((None, None, None)):
+                merged.add(triple)
+        return merged
+
+    variables, bindings, seen = [], [], set()
+    for result in results:
+        for variable in result.get("head", {}).get("vars", []):
+            if variable not in variables:
+                variables.append(variable)
+        for binding in result["results"]["bindings"]:
+            if distinct:
+                key = tuple(
+                    sorted((var, tuple(sorted(term.items()))) for var, term in binding.items())
+                )
+                if key in seen:
+                    continue
+                seen.add(key)
+            bindings.append(binding)
+    return {"head": {"vars": variables}, "results": {"bindings": bindings}}
+
+
+async def gather_batches(runner, requests, distinct=False):
+    """Run the chunk ``requests`` concurrently and merge their results."""
+    results = await runner.gather(requests)
+    return merge_results((results[request.name] for request in requests), distinct)
+
+
+def run_batches(runner, requests, distinct=False):
+    """Blocking version of :func:`gather_batches`."""
+    results = runner.run(requests)
+    return merge_results((results[request.name] for request in requests), distinct)
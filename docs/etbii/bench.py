@@ -0,0 +1,375 @@
+"""Benchmark the SPARQL queries of the book.
+
+Rewriting a query of notebook 2 (questions 9.1 to 9.5) or of notebook 3 can
+make it faster or much slower, and the notebooks do not tell. This module
+extracts every query written in the notebooks of ``_toc.yml`` -- the string
+literals assigned to ``query``, ``uniprot_query``, ``bgee_query``, ... or
+given to ``setQuery`` -- and runs each of them several times against the
+endpoint of its cell. From the ``docs/`` directory::
+
+    python -m etbii.bench --runs 5
+    python -m etbii.bench --list
+
+The endpoint of a query is the ``SPARQLWrapper(...)`` of its cell, or of the
+closest cell before (or after) it. Queries go to the local stand-in endpoint
+(:mod:`etbii.standin`, ``ETBII_SPARQL_STANDIN`` or ``http://127.0.0.1:8890``)
+unless ``--live`` is given; the response cache is never used.
+
+For every query the p50/p95 latency (until the response is read), the
+bytes transferred, the number of rows (or triples) and the p50 parse time
+are appended to a JSON history, ``benchmarks.json`` by default. A query is
+reported as a regression when, compared with the previous run against the
+same target, its p50 latency grew by more than ``--latency-threshold``
+(and ``--min-delta`` seconds), its response grew by more than
+``--size-threshold`` or its number of rows changed. The command then exits
+with status 1.
+"""
+
+import argparse
+import ast
+import io
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import nbformat
+from SPARQLWrapper import JSON, SPARQLWrapper
+
+from etbii.build import BOOK_DIR, toc_notebooks
+from etbii.cache import CachedResponse
+from etbii.query import normalize_query, split_prologue
+from etbii.standin import DEFAULT_PORT, redirect
+
+DEFAULT_RUNS = 5
+DEFAULT_HISTORY = "benchmarks.json"
+DEFAULT_TARGET = "http://127.0.0.1:%d" % DEFAULT_PORT
+DEFAULT_LATENCY_THRESHOLD = 0.25
+DEFAULT_SIZE_THRESHOLD = 0.10
+DEFAULT_MIN_DELTA = 0.05
+
+_QUERY_NAME = re.compile(r"query", re.IGNORECASE)
+_WRAPPERS = ("SPARQLWrapper", "CachedSPARQLWrapper")
+
+
+class BenchQuery:
+    """A query of a notebook and the endpoint it is sent to."""
+
+    def __init__(self, name, notebook, cell, endpoint, query):
+        self.name = name
+        self.notebook = notebook
+        self.cell = cell
+        self.endpoint = endpoint
+        self.query = query
+
+    def __repr__(self):
+        return "BenchQuery(%r, %r)" % (self.name, self.endpoint)
+
+
+def _call_name(node):
+    func = node.func
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    if isinstance(func, ast.Name):
+        return func.id
+    return None
+
+
+def _string(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
+
+
+def _scan_cell(source):
+    """Return ``(assignments, endpoints, query_names)`` of a code cell.
+
+    ``assignments`` are the ``(variable, string)`` pairs in source order.
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:  # IPython magics, unfinished exercises
+        return [], [], set()
+    assignments, endpoints, query_names = [], [], set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            value = _string(node.value)
+            for target in node.targets:
+                if value is not None and isinstance(target, ast.Name):
+                    assignments.append((node.lineno, target.id, value))
+        elif isinstance(node, ast.Call) and node.args:
+            name, argument = _call_name(node), node.args[0]
+            if name in _WRAPPERS and _string(argument):
+                endpoints.append(argument.value)
+            elif name == "setQuery":
+                if _string(argument) is not None:
+                    assignments.append((node.lineno, "setQuery", argument.value))
+                elif isinstance(argument, ast.Name):
+                    query_names.add(argument.id)
+    assignments.sort()
+    return [(name, value) for _, name, value in assignments], endpoints, query_names
+
+
+def _is_query(text):
+    _, body = split_prologue(text)
+    return bool(normalize_query(body))
+
+
+def extract_queries(path):
+    """Return the :class:`BenchQuery` of the notebook at ``path``.
+
+    Empty exercise placeholders (nothing but comments and prefixes) are
+    skipped.
+    """
+    nb = nbformat.read(str(path), as_version=4)
+    cells = [
+        (index, *_scan_cell(cell.source))
+        for index, cell in enumerate(nb.cells)
+        if cell.cell_type == "code"
+    ]
+    query_names = set().union(*(names for *_, names in cells))
+
+    def endpoint_of(position):
+        for index, _, endpoints, _ in reversed(cells[: position + 1]):
+            if endpoints:
+                return endpoints[-1]
+        for index, _, endpoints, _ in cells[position + 1:]:
+            if endpoints:
+                return endpoints[0]
+        return None
+
+    queries, seen = [], {}
+    for position, (index, assignments, _, _) in enumerate(cells):
+        for variable, text in assignments:
+            if variable != "setQuery" and variable not in query_names:
+                if not _QUERY_NAME.search(variable):
+                    continue
+            endpoint = endpoint_of(position)
+            if endpoint is None or not _is_query(text):
+                continue
+            name = "%s:%s" % (Path(path).stem, variable)
+            seen[name] = seen.get(name, 0) + 1
+            if seen[name] > 1:
+                name = "%s#%d" % (name, seen[name])
+            queries.append(BenchQuery(name, str(path), index, endpoint, text))
+    return queries
+
+
+def book_queries(book_dir=BOOK_DIR):
+    """Return the queries of every notebook of the book, in table of contents order."""
+    queries = []
+    for path in toc_notebooks(book_dir):
+        queries.extend(extract_queries(path))
+    return queries
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values``."""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _rows(converted):
+    if isinstance(converted, dict):
+        if "boolean" in converted:
+            return 1
+        return len(converted["results"]["bindings"])
+    if isinstance(converted, (bytes, str)):
+        return None
+    return len(converted)
+
+
+def measure(endpoint, query):
+    """Run ``query`` once, return ``(latency, bytes, rows, parse_seconds)``."""
+    sparql = SPARQLWrapper(endpoint)
+    sparql.setQuery(query)
+    if sparql.queryType in ("SELECT", "ASK"):
+        sparql.setReturnFormat(JSON)
+    start = time.perf_counter()
+    result = sparql.query()
+    try:
+        body = result.response.read()
+        headers = dict(result.response.info())
+        url = result.response.geturl()
+    finally:
+        result.response.close()
+    latency = time.perf_counter() - start
+
+    result.response = CachedResponse(io.BytesIO(body), headers, url)
+    start = time.perf_counter()
+    rows = _rows(result.convert())
+    return latency, len(body), rows, time.perf_counter() - start
+
+
+def run_query(bench_query, runs=DEFAULT_RUNS, target=None):
+    """Benchmark ``bench_query`` ``runs`` times and return its statistics.
+
+    ``target`` is the stand-in server to redirect the endpoint to, ``None``
+    queries the live endpoint.
+    """
+    endpoint = redirect(bench_query.endpoint, target) if target else bench_query.endpoint
+
+    latencies, parse_times, sizes, rows, errors = [], [], [], [], []
+    for _ in range(runs):
+        try:
+            latency, size, count, parse_time = measure(endpoint, bench_query.query)
+        except Exception as error:  # report every failure, keep benchmarking
+            message = " ".join(str(error).split())[:200]
+            errors.append("%s: %s" % (type(error).__name__, message))
+            continue
+        latencies.append(latency)
+        parse_times.append(parse_time)
+        sizes.append(size)
+        rows.append(count)
+
+    stats = {"endpoint": bench_query.endpoint, "runs": runs, "errors": len(errors)}
+    if errors:
+        stats["error"] = errors[-1]
+    if latencies:
+        stats.update(
+            p50=round(percentile(latencies, 0.50), 4),
+            p95=round(percentile(latencies, 0.95), 4),
+            parse_p50=round(percentile(parse_times, 0.50), 4),
+            bytes=max(sizes),
+            rows=rows[-1],
+        )
+    return stats
+
+
+def compare(current, baseline, latency_threshold, size_threshold, min_delta):
+    """Return the regressions of ``current`` over ``baseline`` as messages."""
+    regressions = []
+    for name, stats in current.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if "p50" not in stats:
+            if "p50" in before:
+                regressions.append("%s: fails (%s)" % (name, stats.get("error")))
+            continue
+        if "p50" not in before:
+            continue
+        delta = stats["p50"] - before["p50"]
+        if delta > min_delta and delta > latency_threshold * before["p50"]:
+            regressions.append(
+                "%s: p50 %.3fs -> %.3fs" % (name, before["p50"], stats["p50"])
+            )
+        if stats["bytes"] > before["bytes"] * (1 + size_threshold):
+            regressions.append(
+                "%s: %d -> %d bytes" % (name, before["bytes"], stats["bytes"])
+            )
+        if stats["rows"] != before["rows"]:
+            regressions.append("%s: %s -> %s rows" % (name, before["rows"], stats["rows"]))
+    return regressions
+
+
+def load_history(path):
+    """Return the runs recorded in the history file at ``path``."""
+    try:
+        with open(path, encoding="utf-8") as history_file:
+            return json.load(history_file)
+    except FileNotFoundError:
+        return []
+
+
+def save_history(path, history):
+    with open(path, "w", encoding="utf-8") as history_file:
+        json.dump(history, history_file, indent=1, sort_keys=True)
+        history_file.write("\n")
+
+
+def _commit(book_dir):
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=book_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("book_dir", nargs="?", default=str(BOOK_DIR))
+    parser.add_argument("-n", "--runs", type=int, default=DEFAULT_RUNS)
+    parser.add_argument("-k", "--select", help="only run the queries whose name matches")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument(
+        "--target",
+        default=os.environ.get("ETBII_SPARQL_STANDIN", DEFAULT_TARGET),
+        help="stand-in SPARQL server (default: %(default)s)",
+    )
+    target.add_argument("--live", action="store_true", help="query the real endpoints")
+    parser.add_argument("--history", help="JSON history (default: <book_dir>/%s)" % DEFAULT_HISTORY)
+    parser.add_argument("--no-record", action="store_true", help="do not append to the history")
+    parser.add_argument("--list", action="store_true", help="list the queries and exit")
+    parser.add_argument("--latency-threshold", type=float, default=DEFAULT_LATENCY_THRESHOLD)
+    parser.add_argument("--size-threshold", type=float, default=DEFAULT_SIZE_THRESHOLD)
+    parser.add_argument("--min-delta", type=float, default=DEFAULT_MIN_DELTA)
+    args = parser.parse_args(argv)
+
+    queries = book_queries(args.book_dir)
+    if args.select:
+        queries = [query for query in queries if re.search(args.select, query.name)]
+    if args.list:
+        for query in queries:
+            print(f"{query.name:60} {query.endpoint}")
+        return 0
+
+    target = None if args.live else args.target
+    results = {}
+    for query in queries:
+        stats = results[query.name] = run_query(query, args.runs, target)
+        if "p50" in stats:
+            print(
+                f"{query.name:50} p50 {stats['p50']:7.3f}s  p95 {stats['p95']:7.3f}s  "
+                f"parse {stats['parse_p50']:6.3f}s  {stats['bytes']:9d} B  "
+                f"{stats['rows']} rows"
+            )
+        else:
+            print(f"{query.name:50} failed: {stats['error']}")
+
+    history_path = args.history or os.path.join(args.book_dir, DEFAULT_HISTORY)
+    history = load_history(history_path)
+    label = target or "live"
+    baseline = next((run for run in reversed(history) if run["target"] == label), None)
+    regressions = []
+    if baseline is not None:
+        regressions = compare(
+            results,
+            baseline["queries"],
+            args.latency_threshold,
+            args.size_threshold,
+            args.min_delta,
+        )
+    if not args.no_record:
+        history.append(
+            {
+                "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "commit": _commit(args.book_dir),
+                "target": label,
+                "queries": results,
+            }
+        )
+        save_history(history_path, history)
+
+    if regressions:
+        print("\nregressions since %s:" % baseline["date"], file=sys.stderr)
+        for message in regressions:
+            print("  " + message, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
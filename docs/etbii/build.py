@@ -0,0 +1,320 @@
+"""Incremental build of the book.
+
+``jupyter-book`` is configured with ``execute_notebooks: cache``: a notebook is
+only executed again when its code cells (or kernel) changed, otherwise the
+outputs stored in the jupyter cache are merged back and written to
+``_build/jupyter_execute``. Code cells are not the only thing a notebook
+depends on though, ``5-Quiz`` for instance renders ``questions/*.json``. The
+files a notebook reads can be declared in its metadata::
+
+    "etbii": {"inputs": ["questions/summary_quiz.json"]}
+
+This module fingerprints the code cells, the kernel and the declared inputs of
+every notebook of ``_toc.yml``, drops the cached execution of the notebooks
+whose fingerprint changed, runs ``jupyter-book build`` and reports which
+notebooks were skipped. Run it from the ``docs/`` directory::
+
+    python -m etbii.build
+
+The notebooks are independent and mostly wait on SPARQL endpoints. With
+``--jobs N`` the stale ones are executed beforehand in a pool of ``N``
+processes, each bounded by ``--notebook-timeout`` seconds; the results are
+stored in the jupyter cache in table of contents order, so that
+``jupyter-book build`` only merges them into ``_build/jupyter_execute``.
+
+With ``--trace``, the kernels executing the stale notebooks load the
+:mod:`etbii.trace` extension: the SPARQL requests and graph operations of
+every cell are written to ``_build/html/reports/sparql_trace.jsonl``,
+summarized in ``sparql_trace.txt`` after the build.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nbformat
+import yaml
+from jupyter_cache import get_cache
+from jupyter_cache.base import CacheBundleIn
+from jupyter_cache.executors.utils import single_nb_execution
+
+from etbii.trace import DEFAULT_TRACE_FILE, read_spans, summarize
+
+BOOK_DIR = Path(__file__).resolve().parent.parent
+DEFAULT_CACHE = os.path.join("_build", ".jupyter_cache")
+FINGERPRINTS = "etbii_fingerprints.json"
+DEFAULT_CELL_TIMEOUT = 30
+DEFAULT_NOTEBOOK_TIMEOUT = 600
+
+
+def load_config(book_dir):
+    """Return the parsed ``_config.yml`` of ``book_dir``."""
+    with open(Path(book_dir, "_config.yml"), encoding="utf-8") as config_file:
+        return yaml.safe_load(config_file) or {}
+
+
+def toc_notebooks(book_dir):
+    """Return the notebooks listed in ``_toc.yml``, in table of contents order."""
+    with open(Path(book_dir, "_toc.yml"), encoding="utf-8") as toc_file:
+        toc = yaml.safe_load(toc_file)
+
+    names = []
+
+    def walk(node):
+        if isinstance(node, dict):
+            for key in ("root", "file"):
+                if key in node:
+                    names.append(node[key])
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(toc)
+    notebooks = []
+    for name in names:
+        path = Path(book_dir, name)
+        if path.suffix != ".ipynb":
+            path = path.with_name(path.name + ".ipynb")
+        if path.is_file() and path not in notebooks:
+            notebooks.append(path)
+    return notebooks
+
+
+def cache_path(book_dir, config):
+    """Return the jupyter cache directory used by ``jupyter-book build``."""
+    path = (config.get("execute") or {}).get("cache") or DEFAULT_CACHE
+    return Path(book_dir, path)
+
+
+def declared_inputs(nb):
+    """Return the data files a notebook declares in its ``etbii`` metadata."""
+    return list(nb.metadata.get("etbii", {}).get("inputs", []))
+
+
+def fingerprint(path, nb=None):
+    """Hash the code cells, the kernel and the declared inputs of a notebook."""
+    if nb is None:
+        nb = nbformat.read(str(path), as_version=4)
+    digest = hashlib.sha256()
+    digest.update(nb.metadata.get("kernelspec", {}).get("name", "").encode("utf-8"))
+    for cell in nb.cells:
+        if cell.cell_type == "code":
+            digest.update(b"\0cell\0" + cell.source.encode("utf-8"))
+    for name in sorted(declared_inputs(nb)):
+        digest.update(b"\0input\0" + name.encode("utf-8") + b"\0")
+        try:
+            digest.update(Path(path).parent.joinpath(name).read_bytes())
+        except FileNotFoundError:
+            digest.update(b"\0missing\0")
+    return digest.hexdigest()
+
+
+def read_fingerprints(cache_dir):
+    try:
+        with open(Path(cache_dir, FINGERPRINTS), encoding="utf-8") as fp_file:
+            return json.load(fp_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_fingerprints(cache_dir, fingerprints):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(Path(cache_dir, FINGERPRINTS), "w", encoding="utf-8") as fp_file:
+        json.dump(fingerprints, fp_file, indent=1, sort_keys=True)
+
+
+def _cache_record(cache, nb):
+    try:
+        return cache.match_cache_notebook(nb)
+    except KeyError:
+        return None
+
+
+def plan(book_dir, cache):
+    """Split the notebooks of the book into up to date and stale ones.
+
+    Returns ``(skipped, stale)``, two lists of ``(path, fingerprint)``.
+    """
+    stored = read_fingerprints(cache.path)
+    skipped, stale = [], []
+    for path in toc_notebooks(book_dir):
+        nb = nbformat.read(str(path), as_version=4)
+        key = path.relative_to(book_dir).as_posix()
+        current = fingerprint(path, nb)
+        record = _cache_record(cache, nb)
+        if record is not None and stored.get(key) == current:
+            skipped.append((path, current))
+            continue
+        stale.append((path, current))
+    return skipped, stale
+
+
+def invalidate(cache, notebooks):
+    """Drop the cached executions of ``notebooks``.
+
+    ``jupyter-book build`` then executes them again, even when only their
+    declared inputs changed. The notebooks are touched as well, otherwise
+    Sphinx would not read a source file it considers unchanged.
+    """
+    for path, _ in notebooks:
+        record = _cache_record(cache, nbformat.read(str(path), as_version=4))
+        if record is not None:
+            cache.remove_cache(record.pk)
+        os.utime(path)
+
+
+class NotebookTimeout(Exception):
+    """Raised in a worker when a notebook exceeds its execution budget."""
+
+
+def _alarm(signum, frame):
+    raise NotebookTimeout()
+
+
+def execute_notebook(path, cell_timeout, notebook_timeout, trace=None):
+    """Execute the notebook at ``path`` in its own directory.
+
+    Runs in a worker process and returns ``(nb, seconds, error)``, ``error``
+    being ``None`` on success. The kernel is shut down by nbclient when the
+    notebook timeout interrupts the execution. With a ``trace`` file, the
+    kernel appends the spans of :mod:`etbii.trace` to it.
+    """
+    nb = nbformat.read(str(path), as_version=4)
+    kwargs = {}
+    if trace is not None:
+        # inherited by the kernel
+        os.environ["ETBII_TRACE"] = str(trace)
+        os.environ["ETBII_TRACE_NOTEBOOK"] = Path(path).name
+        kwargs["extra_arguments"] = ["--IPKernelApp.extensions=etbii.trace"]
+    use_alarm = notebook_timeout and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _alarm)
+        signal.alarm(notebook_timeout)
+    try:
+        result = single_nb_execution(
+            nb, cwd=str(Path(path).parent), timeout=cell_timeout, allow_errors=False, **kwargs
+        )
+    except NotebookTimeout:
+        return nb, notebook_timeout, f"timed out after {notebook_timeout} seconds"
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+    if result.err is not None:
+        return result.nb, result.time, f"{type(result.err).__name__}: {result.err}"
+    return result.nb, result.time, None
+
+
+def execute_parallel(cache, notebooks, jobs, cell_timeout, notebook_timeout, trace=None):
+    """Execute ``notebooks`` concurrently and store their outputs in ``cache``.
+
+    Results are collected in the order of ``notebooks`` whatever the order
+    in which the workers finish. Failed notebooks are not cached, so
+    ``jupyter-book build`` executes them again and reports the error.
+    """
+    if not notebooks:
+        return
+    with ProcessPoolExecutor(max_workers=min(jobs, len(notebooks))) as pool:
+        futures = [
+            pool.submit(execute_notebook, path, cell_timeout, notebook_timeout, trace)
+            for path, _ in notebooks
+        ]
+        for (path, _), future in zip(notebooks, futures):
+            nb, seconds, error = future.result()
+            if error is not None:
+                print(f"failed: {path.name} ({error})")
+                continue
+            cache.cache_notebook_bundle(
+                CacheBundleIn(nb, str(path), data={"execution_seconds": seconds}),
+                check_validity=False,
+                overwrite=True,
+            )
+            print(f"executed: {path.name} in {seconds:.1f}s")
+
+
+def record_fingerprints(book_dir, cache, notebooks):
+    """Store the fingerprints of the notebooks that now have a cached execution."""
+    fingerprints = read_fingerprints(cache.path)
+    for path, current in notebooks:
+        key = path.relative_to(book_dir).as_posix()
+        if _cache_record(cache, nbformat.read(str(path), as_version=4)) is not None:
+            fingerprints[key] = current
+        else:
+            fingerprints.pop(key, None)
+    write_fingerprints(cache.path, fingerprints)
+
+
+def report(book_dir, skipped, stale):
+    for label, entries in (("skipped (unchanged)", skipped), ("to execute", stale)):
+        print(f"{label}: {len(entries)}")
+        for path, _ in entries:
+            print(f"  - {path.relative_to(book_dir).as_posix()}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("book_dir", nargs="?", default=str(BOOK_DIR))
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report which notebooks would be executed",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="execute stale notebooks in a pool of JOBS processes before the build",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="record the SPARQL requests and graph operations of the executed notebooks",
+    )
+    parser.add_argument(
+        "--notebook-timeout",
+        type=int,
+        default=DEFAULT_NOTEBOOK_TIMEOUT,
+        help="maximum execution time of a notebook in the pool, in seconds",
+    )
+    args = parser.parse_args(argv)
+    book_dir = Path(args.book_dir).resolve()
+
+    config = load_config(book_dir)
+    mode = (config.get("execute") or {}).get("execute_notebooks")
+    if mode != "cache":
+        parser.error(f"incremental builds need 'execute_notebooks: cache', not {mode!r}")
+
+    cache = get_cache(str(cache_path(book_dir, config)))
+    skipped, stale = plan(book_dir, cache)
+    report(book_dir, skipped, stale)
+    if args.dry_run:
+        return 0
+
+    invalidate(cache, stale)
+    trace = None
+    if args.trace:
+        trace = Path(book_dir, DEFAULT_TRACE_FILE)
+        trace.unlink(missing_ok=True)
+    # traced notebooks are executed here, to know which notebook a kernel runs
+    if args.jobs > 1 or trace is not None:
+        cell_timeout = (config.get("execute") or {}).get("timeout", DEFAULT_CELL_TIMEOUT)
+        execute_parallel(cache, stale, args.jobs, cell_timeout, args.notebook_timeout, trace)
+    status = subprocess.call(["jupyter-book", "build", str(book_dir)])
+    record_fingerprints(book_dir, cache, skipped + stale)
+    if trace is not None and trace.exists():
+        summary = trace.with_suffix(".txt")
+        summary.write_text(summarize(read_spans(trace)) + "\n", encoding="utf-8")
+        print(f"trace: {summary.relative_to(book_dir).as_posix()}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
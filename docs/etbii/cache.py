@@ -0,0 +1,290 @@
+"""Persistent on-disk cache for SPARQL endpoint responses.
+
+Every build of the book executes the notebooks again, which used to send the
+same queries to UniProt, Bgee, DBpedia and the PathwayCommons mirror each time.
+:class:`CachedSPARQLWrapper` is a drop-in replacement for
+``SPARQLWrapper.SPARQLWrapper`` that stores the raw HTTP payload (JSON, Turtle,
+RDF/XML, ...) on disk, keyed on the endpoint, the normalized query text and the
+requested return format. ``query().convert()`` and ``queryAndConvert()`` keep
+working unchanged because conversion still happens in SPARQLWrapper, on top of
+the cached bytes.
+
+The cache is configured with environment variables so that the notebooks do
+not need to change between a laptop and the CI build:
+
+``ETBII_SPARQL_CACHE_DIR``
+    directory holding the entries (default: ``_build/sparql_cache``)
+``ETBII_SPARQL_CACHE_TTL``
+    entry lifetime in seconds (default: one week, ``0`` disables expiry)
+``ETBII_SPARQL_CACHE_MAX_BYTES``
+    size bound of the directory, least recently used entries are evicted
+    first (default: 256 MiB)
+``ETBII_SPARQL_CACHE_DISABLE``
+    set to ``1`` to always query the endpoints
+
+``ETBII_SPARQL_STANDIN`` additionally redirects the wrappers to a local
+stand-in endpoint, see :mod:`etbii.standin`, and the fixed-string ``regex``
+filters of the queries are sent as string functions unless
+``ETBII_SPARQL_REWRITE_FILTERS`` is ``0``, see :mod:`etbii.filters`. The
+connections to the endpoints are kept open between queries unless
+``ETBII_SPARQL_POOL_DISABLE`` is ``1``, see :mod:`etbii.pool`.
+"""
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.error
+
+from etbii.filters import rewrite_enabled, rewrite_filters
+from etbii.pool import PooledSPARQLWrapper
+from etbii.query import normalize_query
+
+DEFAULT_CACHE_DIR = os.path.join("_build", "sparql_cache")
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+_EXTENSIONS = (
+    ("json", ".json"),
+    ("turtle", ".ttl"),
+    ("n3", ".n3"),
+    ("n-triples", ".nt"),
+    ("rdf+xml", ".rdf"),
+    ("xml", ".xml"),
+    ("csv", ".csv"),
+    ("tab-separated", ".tsv"),
+)
+
+
+def _extension(content_type):
+    content_type = (content_type or "").lower()
+    for marker, extension in _EXTENSIONS:
+        if marker in content_type:
+            return extension
+    return ".body"
+
+
+class CachedResponse(io.BufferedReader):
+    """Stand-in for the ``urlopen`` response SPARQLWrapper expects.
+
+    It reads a cached payload from disk, so large results can be consumed
+    incrementally (see :mod:`etbii.stream`) instead of being loaded at once.
+    """
+
+    def __init__(self, raw, headers, url):
+        super().__init__(raw)
+        self._headers = headers
+        self._url = url
+
+    def info(self):
+        return dict(self._headers)
+
+    def geturl(self):
+        return self._url
+
+
+class SPARQLCache:
+    """Directory of cached responses with a TTL and LRU size bound.
+
+    Each entry is a payload file named after the key (``<key>.json``,
+    ``<key>.ttl``, ...) plus a ``<key>.meta`` JSON file recording the endpoint,
+    the query, the content type and the creation time. The modification time
+    of the payload file is refreshed on every hit and drives LRU eviction.
+    Writes go through a temporary file and :func:`os.replace`, so notebooks
+    executed concurrently can share the same directory.
+    """
+
+    def __init__(self, directory=None, ttl=None, max_bytes=None):
+        self.directory = directory or os.environ.get(
+            "ETBII_SPARQL_CACHE_DIR", DEFAULT_CACHE_DIR
+        )
+        if ttl is None:
+            ttl = int(os.environ.get("ETBII_SPARQL_CACHE_TTL", DEFAULT_TTL))
+        if max_bytes is None:
+            max_bytes = int(
+                os.environ.get("ETBII_SPARQL_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)
+            )
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(endpoint, query, return_format):
+        """Hash of the endpoint, normalized query and return format."""
+        text = "\n".join((endpoint, normalize_query(query), return_format or ""))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, key + ".meta")
+
+    def _read_meta(self, key):
+        try:
+            with open(self._meta_path(key), encoding="utf-8") as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key, allow_stale=False):
+        """Return ``(payload, meta)`` for ``key`` or ``None`` on a miss.
+
+        ``payload`` is an unbuffered binary file opened on the cached body.
+        Expired entries are reported as misses unless ``allow_stale`` is set,
+        which is how a failing endpoint falls back to the last known answer.
+        """
+        meta = self._read_meta(key)
+        if meta is None:
+            return None
+        if not allow_stale and self.ttl and time.time() - meta["created"] > self.ttl:
+            return None
+        path = os.path.join(self.directory, meta["file"])
+        try:
+            payload = open(path, "rb", buffering=0)
+            os.utime(path)
+        except OSError:
+            return None
+        return payload, meta
+
+    def put(self, key, body, meta):
+        """Store ``body`` under ``key`` and evict entries above the size bound.
+
+        ``body`` is either bytes or a binary file object, which is copied to
+        disk in chunks.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        meta = dict(meta, file=key + _extension(meta.get("content_type")))
+        meta.setdefault("created", time.time())
+        self._write(meta["file"], body)
+        self._write(key + ".meta", json.dumps(meta, indent=1).encode("utf-8"))
+        self.evict(keep=key)
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name)
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as out_file:
+            if isinstance(data, bytes):
+                out_file.write(data)
+            else:
+                shutil.copyfileobj(data, out_file)
+        os.replace(tmp_path, path)
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if not name.endswith(".meta"):
+                continue
+            key = name[: -len(".meta")]
+            meta = self._read_meta(key)
+            if meta is None:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, meta["file"]))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, key, meta))
+        return entries
+
+    def _remove(self, key, meta):
+        for name in (meta["file"], key + ".meta"):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep=None):
+        """Drop expired entries, then least recently used ones above the bound.
+
+        The entry ``keep``, typically the one just stored, is never dropped.
+        """
+        now = time.time()
+        entries = []
+        for entry in self._entries():
+            if entry[2] == keep:
+                continue
+            if self.ttl and now - entry[3]["created"] > self.ttl:
+                self._remove(entry[2], entry[3])
+            else:
+                entries.append(entry)
+        total = sum(entry[1] for entry in entries)
+        for _, size, key, meta in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            self._remove(key, meta)
+            total -= size
+
+    def clear(self):
+        """Remove every entry of the cache."""
+        for _, _, key, meta in self._entries():
+            self._remove(key, meta)
+
+
+_default_cache = None
+
+
+def default_cache():
+    """Return the process-wide cache configured from the environment."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = SPARQLCache()
+    return _default_cache
+
+
+class CachedSPARQLWrapper(PooledSPARQLWrapper):
+    """``SPARQLWrapper`` whose query responses are served from a :class:`SPARQLCache`.
+
+    The requests reaching the endpoint go through the connection pool of
+    :mod:`etbii.pool`. Update requests are never cached. When the endpoint
+    cannot be reached, an expired entry is returned if one exists, so a build
+    can still run offline.
+    """
+
+    def __init__(self, endpoint, *args, cache=None, **kwargs):
+        # imported here so that ``python -m etbii.standin`` runs the module once
+        from etbii.standin import redirect
+
+        super().__init__(redirect(endpoint), *args, **kwargs)
+        self.cache = cache
+
+    def setQuery(self, query):
+        if rewrite_enabled():
+            query = rewrite_filters(query)
+        super().setQuery(query)
+
+    def _query(self):
+        if os.environ.get("ETBII_SPARQL_CACHE_DISABLE") == "1" or self.isSparqlUpdateRequest():
+            return super()._query()
+        cache = self.cache or default_cache()
+        key = cache.key(self.endpoint, self.queryString, self.returnFormat)
+        hit = cache.get(key)
+        if hit is None:
+            try:
+                response, return_format = super()._query()
+            except urllib.error.URLError:
+                hit = cache.get(key, allow_stale=True)
+                if hit is None:
+                    raise
+            else:
+                headers = dict(response.info())
+                meta = {
+                    "endpoint": self.endpoint,
+                    "query": self.queryString,
+                    "return_format": return_format,
+                    "content_type": response.info().get("Content-Type", ""),
+                    "headers": headers,
+                    "url": response.geturl(),
+                }
+                try:
+                    cache.put(key, response, meta)
+                finally:
+                    response.close()
+                hit = cache.get(key, allow_stale=True)
+                if hit is None:
+                    raise OSError("cannot read back the cached response %s" % key)
+        payload, meta = hit
+        headers = meta.get("headers") or {"Content-Type": meta["content_type"]}
+        return CachedResponse(payload, headers, meta["url"]), self.returnFormat
@@ -0,0 +1,142 @@
+"""Co-expression networks from gene expression graphs.
+
+The ``coExpressedWith`` CONSTRUCT of notebook 3 joins ``genex:isExpressedIn``
+with itself on the tissue, which rdflib evaluates as nested loops: quadratic
+in the number of genes of each tissue, for every tissue, before the pairs are
+even deduplicated. This module reads the expression triples once, partitions
+the genes by tissue and counts the tissues shared by each pair of genes:
+
+    from etbii.coexpression import coexpression_graph
+
+    coExNet = coexpression_graph(results)
+
+gives the graph of the CONSTRUCT, ``?gene1 etbii:coExpressedWith ?gene2`` for
+every pair of distinct genes expressed in a same tissue (in both directions).
+With SciPy installed the counts are the off-diagonal entries of the product
+of the sparse gene x tissue incidence matrix with its transpose, also
+available as a matrix from :func:`coexpression_matrix`; without SciPy, the
+pairs of each tissue are enumerated with NumPy.
+"""
+
+from array import array
+
+import numpy as np
+from rdflib import Graph, Namespace
+
+from etbii.environment import check_environment, missing_modules
+from etbii.store import CompactStore
+
+GENEX = Namespace("http://purl.org/genex#")
+ETBII = Namespace("http://etbii.fr/ontology/")
+
+
+def expression_incidence(graph, predicate=GENEX.isExpressedIn):
+    """Return ``(genes, tissues, rows, columns)`` of the expression triples.
+
+    ``genes`` and ``tissues`` are the distinct subjects and objects of
+    ``predicate``, ``rows[k]`` and ``columns[k]`` their indexes in the
+    ``k``-th triple.
+    """
+    store = graph.store
+    if isinstance(store, CompactStore):
+        if store.terms.lookup(predicate) is None:
+            return [], [], np.empty(0, np.int32), np.empty(0, np.int32)
+        triples = store.ids((None, predicate, None))
+        gene_ids, rows = np.unique(triples[:, 0], return_inverse=True)
+        tissue_ids, columns = np.unique(triples[:, 2], return_inverse=True)
+        genes = [store.terms.decode(term_id) for term_id in gene_ids.tolist()]
+        tissues = [store.terms.decode(term_id) for term_id in tissue_ids.tolist()]
+        return genes, tissues, rows.astype(np.int32), columns.astype(np.int32)
+
+    genes, tissues = {}, {}
+    rows, columns = array("i"), array("i")
+    for gene, _, tissue in graph.triples((None, predicate, None)):
+        rows.append(genes.setdefault(gene, len(genes)))
+        columns.append(tissues.setdefault(tissue, len(tissues)))
+    return (
+        list(genes),
+        list(tissues),
+        np.frombuffer(rows, dtype=np.int32),
+        np.frombuffer(columns, dtype=np.int32),
+    )
+
+
+def _pairs_sparse(rows, columns, n_genes, n_tissues):
+    from scipy import sparse
+
+    incidence = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, columns)),
+        shape=(n_genes, n_tissues),
+    )
+    shared = (incidence @ incidence.T).tocoo()
+    return shared.row, shared.col, shared.data
+
+
+def _pairs_grouped(rows, columns, n_genes):
+    order = np.argsort(columns, kind="stable")
+    genes, tissues = rows[order].astype(np.int64), columns[order]
+    bounds = np.flatnonzero(np.diff(tissues)) + 1
+    keys = []
+    for group in np.split(genes, bounds):
+        if len(group) > 1:
+            keys.append(np.repeat(group, len(group)) * n_genes + np.tile(group, len(group)))
+    if not keys:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+    return keys // n_genes, keys % n_genes, counts
+
+
+def coexpression_pairs(graph, predicate=GENEX.isExpressedIn, min_shared=1):
+    """Return ``(genes, first, second, shared)`` for the co-expressed gene pairs.
+
+    ``genes[first[k]]`` and ``genes[second[k]]`` (distinct) are expressed in
+    ``shared[k] >= min_shared`` common tissues. Both orders of a pair are
+    returned.
+    """
+    genes, tissues, rows, columns = expression_incidence(graph, predicate)
+    if missing_modules("scipy"):
+        first, second, shared = _pairs_grouped(rows, columns, len(genes))
+    else:
+        first, second, shared = _pairs_sparse(rows, columns, len(genes), len(tissues))
+    keep = (first != second) & (shared >= min_shared)
+    return genes, first[keep], second[keep], shared[keep]
+
+
+def coexpression_matrix(graph, predicate=GENEX.isExpressedIn):
+    """Return ``(genes, matrix)``, the sparse matrix of shared tissue counts.
+
+    ``matrix[i, j]`` is the number of tissues where ``genes[i]`` and
+    ``genes[j]`` are both expressed; the diagonal is zero. Requires SciPy.
+    """
+    check_environment("scipy")
+    from scipy import sparse
+
+    genes, tissues, rows, columns = expression_incidence(graph, predicate)
+    first, second, shared = _pairs_sparse(rows, columns, len(genes), len(tissues))
+    keep = first != second
+    matrix = sparse.csr_matrix(
+        (shared[keep], (first[keep], second[keep])), shape=(len(genes), len(genes))
+    )
+    return genes, matrix
+
+
+def coexpression_graph(
+    graph,
+    predicate=GENEX.isExpressedIn,
+    relation=ETBII.coExpressedWith,
+    min_shared=1,
+):
+    """Return the graph of ``?gene1 relation ?gene2`` for the co-expressed genes.
+
+    This is the result of the CONSTRUCT query joining ``predicate`` with
+    itself on the tissue, built in a :class:`~etbii.store.CompactStore`.
+    """
+    genes, first, second, _ = coexpression_pairs(graph, predicate, min_shared)
+    network = Graph(store=CompactStore())
+    network.bind("etbii", ETBII)
+    network.addN(
+        (genes[i], relation, genes[j], network)
+        for i, j in zip(first.tolist(), second.tolist())
+    )
+    return network
@@ -0,0 +1,176 @@
+"""In-memory cache of resource descriptions, with neighborhood prefetching.
+
+Exploring PathwayCommons or BioPortal in notebook 2 means describing a
+resource, picking a neighbor in the answer, describing it, coming back...
+Every ``DESCRIBE`` is a round trip to the endpoint, and even a hit of the
+on-disk response cache is parsed again. :class:`DescribeCache` keeps the
+description of each resource as an ``rdflib.Graph``::
+
+    pc = DescribeCache("http://134.214.213.234/sparql", prefetch=True)
+    regulation = pc.describe(PC2.TemplateReactionRegulation_145afc203ffa1cb5a00fa445a5a63c64)
+
+With ``prefetch`` set, the descriptions of the one-hop neighbors of every
+described resource (the IRIs it links to or is linked from, predicates and
+classes excluded) are fetched in background threads, so the next step of
+the exploration is a dictionary lookup. A resource requested while its prefetch
+is running waits for that request instead of sending a second one.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from rdflib import RDF, Graph, URIRef
+from rdflib.graph import ReadOnlyGraphAggregate
+
+from etbii.cache import CachedSPARQLWrapper
+
+DEFAULT_MAX_RESOURCES = 1000
+DEFAULT_PREFETCH_LIMIT = 50
+DEFAULT_WORKERS = 4
+
+
+def neighbors(graph, resource):
+    """Return the IRIs linked to or from ``resource`` in ``graph``, in order.
+
+    The classes of ``resource`` are left out: describing a class can return
+    all of its instances.
+    """
+    found = OrderedDict()
+    for _, predicate, obj in graph.triples((resource, None, None)):
+        if predicate != RDF.type:
+            found[obj] = None
+    for subject, _, _ in graph.triples((None, None, resource)):
+        found[subject] = None
+    return [term for term in found if isinstance(term, URIRef) and term != resource]
+
+
+class DescribeCache:
+    """Descriptions of the resources of an endpoint, kept in memory.
+
+    :param endpoint: SPARQL endpoint URL
+    :param prefetch: also describe the neighbors of every described resource
+    :param prefetch_limit: maximum number of neighbors prefetched per resource
+    :param max_resources: descriptions kept, least recently used ones are
+        dropped first
+    :param workers: number of background threads sending the prefetches
+    :param wrapper: ``SPARQLWrapper`` class used to send the queries
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        prefetch=False,
+        prefetch_limit=DEFAULT_PREFETCH_LIMIT,
+        max_resources=DEFAULT_MAX_RESOURCES,
+        workers=DEFAULT_WORKERS,
+        wrapper=CachedSPARQLWrapper,
+    ):
+        self.endpoint = endpoint
+        self.prefetch = prefetch
+        self.prefetch_limit = prefetch_limit
+        self.max_resources = max_resources
+        self.wrapper = wrapper
+        self.hits = 0
+        self.misses = 0
+        self._descriptions = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="describe")
+
+    def __contains__(self, resource):
+        with self._lock:
+            return URIRef(resource) in self._descriptions
+
+    def __len__(self):
+        with self._lock:
+            return len(self._descriptions)
+
+    def fetch(self, resource):
+        """Send ``DESCRIBE <resource>`` and return the graph of the answer."""
+        sparql = self.wrapper(self.endpoint)
+        sparql.setQuery("DESCRIBE %s" % URIRef(resource).n3())
+        response = sparql.query()
+        result = response.convert()
+        if isinstance(result, Graph):
+            return result
+        # Turtle, N-Triples, JSON-LD, ... are returned unparsed
+        content_type = response.info().get("content-type", "text/turtle")
+        graph = Graph()
+        graph.parse(data=result, format=content_type.split(";")[0].strip())
+        return graph
+
+    def _store(self, resource, graph):
+        with self._lock:
+            self._descriptions[resource] = graph
+            self._descriptions.move_to_end(resource)
+            while len(self._descriptions) > self.max_resources:
+                self._descriptions.popitem(last=False)
+            self._pending.pop(resource, None)
+
+    def _fetch_and_store(self, resource):
+        try:
+            graph = self.fetch(resource)
+        except BaseException:
+            with self._lock:
+                self._pending.pop(resource, None)
+            raise
+        self._store(resource, graph)
+        return graph
+
+    def describe(self, resource):
+        """Return the description of ``resource`` (an IRI), from memory if possible.
+
+        The returned graph is shared with the cache and must not be modified.
+        """
+        resource = URIRef(resource)
+        with self._lock:
+            graph = self._descriptions.get(resource)
+            if graph is not None:
+                self._descriptions.move_to_end(resource)
+                self.hits += 1
+            else:
+                future = self._pending.get(resource)
+                self.misses += future is None
+                self.hits += future is not None
+        if graph is None and future is not None:
+            try:
+                graph = future.result()
+            except Exception:
+                graph = None  # the prefetch failed, the request is sent again
+        if graph is None:
+            graph = self._fetch_and_store(resource)
+        if self.prefetch:
+            self.prefetch_neighbors(resource, graph)
+        return graph
+
+    def prefetch_neighbors(self, resource, graph):
+        """Describe the neighbors of ``resource`` in ``graph`` in the background."""
+        with self._lock:
+            for neighbor in neighbors(graph, resource)[: self.prefetch_limit]:
+                if neighbor in self._descriptions or neighbor in self._pending:
+                    continue
+                self._pending[neighbor] = self._executor.submit(self._fetch_and_store, neighbor)
+
+    def wait(self):
+        """Block until the prefetches sent so far are done."""
+        with self._lock:
+            pending = list(self._pending.values())
+        for future in pending:
+            future.exception()
+
+    @property
+    def graph(self):
+        """Read-only union of the descriptions in memory."""
+        with self._lock:
+            return ReadOnlyGraphAggregate(list(self._descriptions.values()))
+
+    def close(self):
+        """Stop the background threads, dropping the prefetches not started."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
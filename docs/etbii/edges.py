@@ -0,0 +1,266 @@
+"""Edge lists built once from query results, for networkx, SciPy and cytoscape.
+
+Notebooks 3 and 4 draw the interaction network of a SPARQL result with a
+loop calling ``add_edge(r['P1_label']['value'], r['P2_label']['value'])``,
+and notebook 4 loops over the bindings again to build the nodes and edges
+of the cytoscape widget. :class:`EdgeList` reads the result once into
+columns -- the node labels, and the source and target indexes of every
+edge as integer arrays -- from which every representation is produced::
+
+    edges = EdgeList.from_bindings(
+        results, "P1_label", "P2_label", edge_data={"nbExperiments": "nb_expe"}
+    )
+    G = edges.to_networkx()
+    cytoscapeobj.graph.add_graph_from_json(edges.to_cytoscape())
+
+The result is a SPARQL JSON document, an iterable of its bindings (as
+yielded by :func:`etbii.stream.iter_bindings`) or an rdflib ``SELECT``
+result; :meth:`EdgeList.from_graph` reads the triples of an rdflib graph,
+such as the answer of a ``CONSTRUCT``.
+"""
+
+from array import array
+
+import networkx as nx
+import numpy as np
+
+from etbii.environment import check_environment
+from etbii.store import CompactStore
+
+
+def _columns(results, names):
+    # {name: [value of name in each result row, None when unbound]}
+    if hasattr(results, "vars") and hasattr(results, "bindings"):
+        rows = list(results)
+        variables = [str(var) for var in results.vars]
+        columns = {}
+        for name in names:
+            position = variables.index(name)
+            columns[name] = [
+                None if row[position] is None else str(row[position]) for row in rows
+            ]
+        return columns
+    if isinstance(results, dict):
+        results = results["results"]["bindings"]
+    bindings = list(results)
+    return {
+        name: [binding[name]["value"] if name in binding else None for binding in bindings]
+        for name in names
+    }
+
+
+class EdgeList:
+    """Edges between indexed nodes, stored as columns.
+
+    ``nodes[sources[k]]`` and ``nodes[targets[k]]`` are the ends of the
+    ``k``-th edge and ``edge_data[name][k]`` its attributes;
+    ``node_data[name][i]`` is an attribute of ``nodes[i]``, ``None`` when
+    unknown.
+    """
+
+    def __init__(self, nodes, sources, targets, edge_data=None, node_data=None):
+        self.nodes = list(nodes)
+        self.sources = np.asarray(sources, dtype=np.int32)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        self.edge_data = dict(edge_data or {})
+        self.node_data = dict(node_data or {})
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __repr__(self):
+        return "EdgeList(%d nodes, %d edges)" % (len(self.nodes), len(self))
+
+    @classmethod
+    def from_bindings(cls, results, source, target, edge_data=None, node_data=None):
+        """Read the edges ``?source -- ?target`` of a SELECT result.
+
+        ``edge_data`` maps edge attributes to the variables holding them and
+        ``node_data`` maps a node variable to its attributes, for instance
+        ``{"P2_label": {"href": "P2"}}``. Rows where ``source`` or ``target``
+        is unbound are skipped.
+        """
+        edge_data = dict(edge_data or {})
+        node_data = {
+            variable: dict(attributes) for variable, attributes in (node_data or {}).items()
+        }
+        names = [source, target] + list(edge_data.values())
+        for variable, attributes in node_data.items():
+            names += [variable] + list(attributes.values())
+        columns = _columns(results, dict.fromkeys(names))
+
+        keep = None
+        if None in columns[source] or None in columns[target]:
+            keep = [
+                k
+                for k, ends in enumerate(zip(columns[source], columns[target]))
+                if None not in ends
+            ]
+            # every column once, node attributes included, to keep the rows aligned
+            for name, values in columns.items():
+                columns[name] = [values[k] for k in keep]
+
+        index = {}
+        intern = index.setdefault
+        sources = [intern(node, len(index)) for node in columns[source]]
+        targets = [intern(node, len(index)) for node in columns[target]]
+        node_columns = {}
+        for variable, attributes in node_data.items():
+            for attribute, value_variable in attributes.items():
+                values = node_columns.setdefault(attribute, {})
+                for node, value in zip(columns[variable], columns[value_variable]):
+                    if node is not None and value is not None:
+                        values.setdefault(intern(node, len(index)), value)
+        size = len(index)
+        return cls(
+            index,
+            sources,
+            targets,
+            {attribute: columns[variable] for attribute, variable in edge_data.items()},
+            {
+                attribute: [values.get(node) for node in range(size)]
+                for attribute, values in node_columns.items()
+            },
+        )
+
+    @classmethod
+    def from_graph(cls, graph, predicate=None):
+        """Read the triples of ``graph`` as edges ``subject -> object``.
+
+        The nodes are rdflib terms. Without ``predicate``, the predicate of
+        each edge is its ``predicate`` attribute.
+        """
+        store = graph.store
+        if isinstance(store, CompactStore):
+            if predicate is not None and store.terms.lookup(predicate) is None:
+                return cls([], [], [])
+            triples = store.ids((None, predicate, None))
+            node_ids, inverse = np.unique(
+                np.concatenate([triples[:, 0], triples[:, 2]]), return_inverse=True
+            )
+            nodes = [store.terms.decode(term_id) for term_id in node_ids.tolist()]
+            count = len(triples)
+            edge_data = {}
+            if predicate is None:
+                predicate_ids, predicate_index = np.unique(triples[:, 1], return_inverse=True)
+                predicates = [store.terms.decode(term_id) for term_id in predicate_ids.tolist()]
+                edge_data["predicate"] = [predicates[i] for i in predicate_index.tolist()]
+            return cls(nodes, inverse[:count], inverse[count:], edge_data)
+
+        index = {}
+        sources, targets = array("i"), array("i")
+        predicates = []
+        for subject, found, obj in graph.triples((None, predicate, None)):
+            sources.append(index.setdefault(subject, len(index)))
+            targets.append(index.setdefault(obj, len(index)))
+            predicates.append(found)
+        edge_data = {"predicate": predicates} if predicate is None else {}
+        return cls(
+            index,
+            np.frombuffer(sources, dtype=np.int32),
+            np.frombuffer(targets, dtype=np.int32),
+            edge_data,
+        )
+
+    def unique(self, directed=True):
+        """Return the edge list without repeated edges.
+
+        A repeated edge keeps the attributes of its last occurrence, as with
+        successive ``add_edge`` calls. Unless ``directed``, ``a -- b`` and
+        ``b -- a`` are the same edge.
+        """
+        first, second = self.sources.astype(np.int64), self.targets.astype(np.int64)
+        if not directed:
+            first, second = np.minimum(first, second), np.maximum(first, second)
+        keys = (first * max(1, len(self.nodes)) + second)[::-1]
+        _, last = np.unique(keys, return_index=True)
+        last = np.sort(len(keys) - 1 - last)
+        if len(last) == len(keys):
+            return self
+        positions = last.tolist()
+        return EdgeList(
+            self.nodes,
+            self.sources[last],
+            self.targets[last],
+            {name: [values[k] for k in positions] for name, values in self.edge_data.items()},
+            self.node_data,
+        )
+
+    def _node_attributes(self):
+        names = list(self.node_data)
+        for i, node in enumerate(self.nodes):
+            yield node, {
+                name: self.node_data[name][i]
+                for name in names
+                if self.node_data[name][i] is not None
+            }
+
+    def to_networkx(self, graph=None):
+        """Add the nodes and edges to ``graph``, a new ``nx.Graph`` by default.
+
+        Repeated edges are merged before reaching networkx, unless ``graph``
+        is a multigraph.
+        """
+        graph = nx.Graph() if graph is None else graph
+        edges = self if graph.is_multigraph() else self.unique(graph.is_directed())
+        if self.node_data:
+            graph.add_nodes_from(self._node_attributes())
+        else:
+            graph.add_nodes_from(self.nodes)
+        labels = np.empty(len(self.nodes), dtype=object)
+        labels[:] = self.nodes
+        ends = zip(labels[edges.sources].tolist(), labels[edges.targets].tolist())
+        if edges.edge_data:
+            names = list(edges.edge_data)
+            columns = zip(*(edges.edge_data[name] for name in names))
+            graph.add_edges_from(
+                (source, target, dict(zip(names, values)))
+                for (source, target), values in zip(ends, columns)
+            )
+        else:
+            graph.add_edges_from(ends)
+        return graph
+
+    def to_sparse(self, weight=None, symmetric=False):
+        """Return the ``len(nodes) x len(nodes)`` adjacency matrix (SciPy CSR).
+
+        Entries count the edges between two nodes, or sum their ``weight``
+        attribute. With ``symmetric``, each edge is counted in both
+        directions.
+        """
+        check_environment("scipy")
+        from scipy import sparse
+
+        if weight is None:
+            data = np.ones(len(self), dtype=np.int32)
+        else:
+            data = np.asarray(self.edge_data[weight], dtype=np.float64)
+        rows, columns = self.sources, self.targets
+        if symmetric:
+            rows, columns = np.concatenate([rows, columns]), np.concatenate([columns, rows])
+            data = np.concatenate([data, data])
+        size = len(self.nodes)
+        return sparse.csr_matrix((data, (rows, columns)), shape=(size, size))
+
+    def to_cytoscape(self):
+        """Return the ``{"nodes": ..., "edges": ...}`` JSON of ipycytoscape.
+
+        A node is identified by its string and named after it unless a
+        ``name`` attribute is given.
+        """
+        identifiers = [str(node) for node in self.nodes]
+        nodes = []
+        for (_, attributes), identifier in zip(self._node_attributes(), identifiers):
+            data = {"id": identifier, "name": identifier}
+            data.update(attributes)
+            nodes.append({"data": data})
+        names = list(self.edge_data)
+        edges = []
+        for k, (source, target) in enumerate(zip(self.sources.tolist(), self.targets.tolist())):
+            data = {"source": identifiers[source], "target": identifiers[target]}
+            for name in names:
+                value = self.edge_data[name][k]
+                # rdflib terms, such as the predicates of a graph, as strings
+                data[name] = value if isinstance(value, (int, float, type(None))) else str(value)
+            edges.append({"data": data})
+        return {"nodes": nodes, "edges": edges}
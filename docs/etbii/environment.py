@@ -0,0 +1,104 @@
+"""Check the software environment of the notebooks without calling pip.
+
+The environment is provisioned once from ``requirements.lock``::
+
+    pip install -r requirements.lock
+
+The notebooks then only verify that the modules they use are importable,
+which costs a few milliseconds instead of a pip resolution per package. From
+the ``docs/`` directory, ``python -m etbii.environment`` also compares the
+installed versions with the lockfile.
+"""
+
+import importlib.metadata
+import importlib.util
+import re
+import sys
+from pathlib import Path
+
+LOCKFILE = Path(__file__).resolve().parent.parent / "requirements.lock"
+
+# Modules imported by the notebooks and the distribution providing them.
+MODULES = {
+    "rdflib": "rdflib",
+    "SPARQLWrapper": "SPARQLWrapper",
+    "networkx": "networkx",
+    "matplotlib": "matplotlib",
+    "numpy": "numpy",
+    "scipy": "scipy",
+    "ipycytoscape": "ipycytoscape",
+    "ipywidgets": "ipywidgets",
+    "jupyterquiz": "jupyterquiz",
+}
+
+
+def missing_modules(*modules):
+    """Return the modules among ``modules`` (default: all) that cannot be imported."""
+    return [
+        module
+        for module in modules or MODULES
+        if importlib.util.find_spec(module) is None
+    ]
+
+
+def check_environment(*modules):
+    """Raise ``ImportError`` if one of ``modules`` (default: all) is missing.
+
+    Modules are located, not imported, so the check is cheap enough to run at
+    the top of every notebook.
+    """
+    missing = missing_modules(*modules)
+    if missing:
+        raise ImportError(
+            "missing modules: %s, install the environment of the book with "
+            "`pip install -r requirements.lock`" % ", ".join(missing)
+        )
+
+
+def read_lockfile(path=LOCKFILE):
+    """Return the ``{distribution: version}`` pins of a lockfile."""
+    pins = {}
+    with open(path, encoding="utf-8") as lock_file:
+        for line in lock_file:
+            line = line.split("#", 1)[0].strip()
+            if "==" in line:
+                name, version = line.split("==", 1)
+                pins[_canonical(name)] = version.split(";", 1)[0].strip()
+    return pins
+
+
+def _canonical(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def outdated(path=LOCKFILE):
+    """Return ``(distribution, pinned, installed)`` for every mismatching pin."""
+    mismatches = []
+    for name, pinned in sorted(read_lockfile(path).items()):
+        try:
+            installed = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            installed = None
+        if installed != pinned:
+            mismatches.append((name, pinned, installed))
+    return mismatches
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    path = Path(argv[0]) if argv else LOCKFILE
+    missing = missing_modules()
+    mismatches = outdated(path)
+    for module in missing:
+        print(f"missing module: {module}")
+    for name, pinned, installed in mismatches:
+        print(f"{name}: {installed or 'not installed'} (locked {pinned})")
+    if missing or mismatches:
+        print(f"run `pip install -r {path}` to sync the environment")
+        return 1
+    print("environment matches", path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""Explore the UniProt interaction network one protein at a time.
+
+Notebook 4 draws the interactions of SCN5A returned by a single query and
+builds a new widget each time the query changes. :class:`InteractionExplorer`
+grows the network instead: expanding a protein sends the one-hop interaction
+query of that protein only, and the nodes and edges not displayed yet are
+appended to the existing ``CytoscapeWidget``::
+
+    explorer = InteractionExplorer()
+    await explorer.expand("Q14524")
+    explorer.widget()
+
+Clicking a protein of the widget expands it in the background. Each
+neighborhood is queried once: the answers are kept in memory, on top of the
+response cache of :class:`~etbii.cache.CachedSPARQLWrapper`, and a protein
+clicked again while its query runs waits for that query.
+"""
+
+import asyncio
+import math
+
+import networkx as nx
+from SPARQLWrapper import JSON
+
+from etbii.environment import check_environment
+from etbii.netview import STYLE
+from etbii.runner import QueryRunner, SPARQLRequest
+
+UNIPROT_ENDPOINT = "http://sparql.uniprot.org/sparql/"
+UNIPROT = "http://purl.uniprot.org/uniprot/"
+
+INTERACTIONS_QUERY = """
+PREFIX up: <http://purl.uniprot.org/core/>
+
+SELECT DISTINCT ?P1_label ?P2 ?P2_label ?nb_expe WHERE {
+    VALUES ?P1 { <%s> }
+    ?P1 up:mnemonic ?P1_label ;
+        up:interaction ?interaction .
+    ?P2 up:interaction ?interaction ;
+        up:mnemonic ?P2_label .
+    ?interaction up:experiments ?nb_expe .
+    FILTER (?P2 != ?P1)
+}
+"""
+
+_RADIUS = 120.0
+
+
+def protein_iri(protein):
+    """Return the UniProt IRI of an accession (``Q14524``) or IRI."""
+    protein = str(protein)
+    return protein if "://" in protein else UNIPROT + protein
+
+
+class InteractionExplorer:
+    """Interaction network grown by one-hop queries around chosen proteins.
+
+    :param endpoint: SPARQL endpoint of UniProt
+    :param runner: :class:`~etbii.runner.QueryRunner` sending the queries
+    :param query: one-hop query, ``%s`` being replaced by the protein IRI;
+        it binds ``?P1_label``, ``?P2``, ``?P2_label`` and ``?nb_expe``
+
+    ``graph`` is the ``networkx`` graph explored so far, its nodes being
+    the protein IRIs with their ``name``.
+    """
+
+    def __init__(self, endpoint=UNIPROT_ENDPOINT, runner=None, query=INTERACTIONS_QUERY):
+        self.endpoint = endpoint
+        self.runner = runner or QueryRunner()
+        self.query = query
+        self.graph = nx.Graph()
+        self.positions = {}
+        self.expanded = set()
+        self.errors = []
+        self._neighborhoods = {}
+        self._pending = {}
+        self._widget = None
+        self._nodes = {}
+
+    def __repr__(self):
+        return "InteractionExplorer(%d proteins, %d interactions, %d expanded)" % (
+            self.graph.number_of_nodes(),
+            self.graph.number_of_edges(),
+            len(self.expanded),
+        )
+
+    async def neighborhood(self, protein):
+        """Return the bindings of the one-hop query of ``protein``."""
+        iri = protein_iri(protein)
+        if iri in self._neighborhoods:
+            return self._neighborhoods[iri]
+        if iri not in self._pending:
+            request = SPARQLRequest(iri, self.endpoint, self.query % iri, JSON)
+            self._pending[iri] = asyncio.ensure_future(self.runner.gather([request]))
+        try:
+            results = await self._pending[iri]
+        finally:
+            self._pending.pop(iri, None)
+        bindings = results[iri]["results"]["bindings"]
+        self._neighborhoods[iri] = bindings
+        return bindings
+
+    def _add(self, iri, bindings):
+        # add the neighborhood to the graph, return the new nodes and edges
+        new_nodes, new_edges = [], []
+        if iri not in self.graph:
+            name = bindings[0]["P1_label"]["value"] if bindings else iri.rsplit("/", 1)[-1]
+            self.graph.add_node(iri, name=name)
+            self.positions[iri] = (0.0, 0.0)
+            new_nodes.append(iri)
+        for binding in bindings:
+            other = binding["P2"]["value"]
+            if other not in self.graph:
+                self.graph.add_node(other, name=binding["P2_label"]["value"])
+                new_nodes.append(other)
+            if not self.graph.has_edge(iri, other):
+                self.graph.add_edge(iri, other, nbExperiments=binding["nb_expe"]["value"])
+                new_edges.append((iri, other))
+
+        # new neighbors on a circle around the expanded protein
+        placed = [node for node in new_nodes if node != iri]
+        x, y = self.positions[iri]
+        for position, node in enumerate(placed):
+            angle = 2 * math.pi * position / len(placed)
+            self.positions[node] = (x + _RADIUS * math.cos(angle), y + _RADIUS * math.sin(angle))
+        return new_nodes, new_edges
+
+    def elements(self, nodes=None, edges=None):
+        """Return ``nodes`` and ``edges`` (by default all of them) as cytoscape JSON."""
+        nodes = self.graph.nodes if nodes is None else nodes
+        edges = self.graph.edges if edges is None else edges
+        return {
+            "nodes": [
+                {
+                    "data": {"id": node, "name": self.graph.nodes[node]["name"], "href": node},
+                    "position": dict(zip("xy", self.positions[node])),
+                    "classes": "expanded" if node in self.expanded else "",
+                }
+                for node in nodes
+            ],
+            "edges": [
+                {"data": {"source": source, "target": target, **self.graph.edges[source, target]}}
+                for source, target in edges
+            ],
+        }
+
+    async def expand(self, protein):
+        """Query the interactions of ``protein`` and add them to the network.
+
+        Returns the cytoscape JSON of the nodes and edges that were not in
+        the network yet; they are also appended to the widget if it exists.
+        """
+        iri = protein_iri(protein)
+        bindings = await self.neighborhood(iri)
+        self.expanded.add(iri)
+        new_nodes, new_edges = self._add(iri, bindings)
+        delta = self.elements(new_nodes, new_edges)
+        if self._widget is not None:
+            if iri in self._nodes:
+                self._nodes[iri].classes = "expanded"
+            self._send(delta)
+        return delta
+
+    def _send(self, elements):
+        from ipycytoscape import Edge, Node
+
+        graph = self._widget.graph
+        nodes = [Node(**node) for node in elements["nodes"]]
+        self._nodes.update((node.data["id"], node) for node in nodes)
+        graph.add_nodes(nodes)
+        graph.add_edges([Edge(**edge) for edge in elements["edges"]])
+
+    def _done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.errors.append(task.exception())
+
+    def _on_click(self, event):
+        iri = event.get("data", {}).get("id")
+        if iri is None or iri in self.expanded:
+            return
+        task = asyncio.ensure_future(self.expand(iri))
+        task.add_done_callback(self._done)
+
+    def widget(self):
+        """Return the ``CytoscapeWidget`` of the network, created on the first call.
+
+        A click on a protein expands it; the errors of these background
+        queries are collected in ``errors``.
+        """
+        if self._widget is not None:
+            return self._widget
+        check_environment("ipycytoscape")
+        from ipycytoscape import CytoscapeWidget
+
+        self._widget = CytoscapeWidget()
+        self._widget.set_style(
+            STYLE + [{"selector": "node.expanded", "css": {"background-color": "darkgreen"}}]
+        )
+        self._widget.set_layout(name="preset", fit=True)
+        self._send(self.elements())
+        self._widget.on("node", "click", self._on_click)
+        return self._widget
@@ -0,0 +1,315 @@
+"""Federated queries with bind joins between SERVICE endpoints.
+
+Notebook 3 runs the UniProt interaction query, copies the gene names of the
+answers into a Python string and pastes it in the ``VALUES`` clause of the
+Bgee query. :func:`federated_query` runs the two stages as one query, the
+endpoints being named by ``SERVICE`` blocks::
+
+    results = federated_query('''
+    PREFIX up: <http://purl.uniprot.org/core/>
+    PREFIX uniprot: <http://purl.uniprot.org/uniprot/>
+    PREFIX orth: <http://purl.org/net/orth#>
+
+    SELECT ?geneName ?seq WHERE {
+        SERVICE <http://sparql.uniprot.org/sparql/> {
+            uniprot:Q14524 up:interaction ?interaction .
+            ?P2 up:interaction ?interaction ; up:mnemonic ?P2_label .
+        }
+        BIND (STRBEFORE(?P2_label, "_HUMAN") AS ?geneName)
+        SERVICE <http://bgee.org/sparql> {
+            ?seq a orth:Gene ; rdfs:label ?geneName .
+        }
+    }''')
+
+The query is evaluated by rdflib, against an empty local graph unless one is
+given, except for the ``SERVICE`` patterns. A ``SERVICE`` joined with the
+patterns before it is a bind join: the solutions of the left side are
+shipped to the endpoint as ``VALUES`` rows of the shared variables, in
+batches bounded like the ones of :mod:`etbii.batch`, the batches of a wave
+are sent concurrently by a :class:`~etbii.runner.QueryRunner` (response
+cache, stand-in endpoints and per-endpoint limits included) and their
+answers are joined to the left solutions by hash. rdflib alone sends one
+request per left solution.
+"""
+
+import contextvars
+import re
+from collections import namedtuple
+
+from rdflib import BNode, Graph, Literal, URIRef, Variable
+from rdflib.namespace import XSD
+from rdflib.plugins.sparql import CUSTOM_EVALS, prepareQuery
+from rdflib.plugins.sparql.evaluate import evalPart
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.plugins.sparql.sparql import FrozenBindings
+from SPARQLWrapper import JSON
+
+from etbii.batch import DEFAULT_MAX_BYTES, DEFAULT_MAX_VALUES, sparql_term
+from etbii.query import split_prologue, tokenize
+from etbii.runner import QueryRunner, SPARQLRequest
+
+DEFAULT_PARALLEL = 4
+_EXTENSION = "etbii.federation"
+_federation = contextvars.ContextVar("etbii_federation", default=None)
+_BRACES = re.compile(r"[{}]|[^{}]+")
+
+ServiceBlock = namedtuple("ServiceBlock", "endpoint silent body")
+
+
+def service_blocks(query):
+    """Return the :class:`ServiceBlock` of every ``SERVICE`` of ``query``, in order.
+
+    ``endpoint`` is the IRI or prefixed name as written and ``body`` the text
+    between the braces of the block.
+    """
+    tokens = []
+    for kind, text, start in tokenize(query):
+        if kind in ("space", "comment"):
+            continue
+        if kind != "other":
+            tokens.append((kind, text, start))
+            continue
+        for part in _BRACES.finditer(text):
+            tokens.append((kind, part.group(), start + part.start()))
+
+    blocks = []
+    for index, (kind, text, _) in enumerate(tokens):
+        if kind != "other" or text.upper() != "SERVICE":
+            continue
+        position = index + 1
+        silent = tokens[position][1].upper() == "SILENT"
+        position += silent
+        endpoint = tokens[position][1]
+        position += 1
+        if tokens[position][1] != "{":
+            raise ValueError("malformed SERVICE block near %r" % endpoint)
+        body_start = tokens[position][2] + 1
+        depth = 0
+        for kind, text, start in tokens[position:]:
+            if kind == "other" and text in "{}":
+                depth += 1 if text == "{" else -1
+                if not depth:
+                    blocks.append(ServiceBlock(endpoint, silent, query[body_start:start]))
+                    break
+        else:
+            raise ValueError("unbalanced braces in the SERVICE block of %s" % endpoint)
+    return blocks
+
+
+def _service_patterns(node, patterns):
+    if isinstance(node, CompValue):
+        if node.name == "ServiceGraphPattern":
+            patterns.append(node)
+            return patterns
+        for value in node.values():
+            _service_patterns(value, patterns)
+    elif isinstance(node, (list, tuple)):
+        for value in node:
+            _service_patterns(value, patterns)
+    return patterns
+
+
+def json_term(binding):
+    """Return the rdflib term of a SPARQL JSON ``binding``."""
+    kind, value = binding["type"], binding["value"]
+    if kind == "uri":
+        return URIRef(value)
+    if kind == "bnode":
+        return BNode(value)
+    if kind not in ("literal", "typed-literal"):
+        raise ValueError("invalid term type %r" % kind)
+    datatype = binding.get("datatype")
+    if datatype == str(XSD.string):
+        datatype = None  # the same term as a simple literal in RDF 1.1
+    return Literal(value, lang=binding.get("xml:lang"), datatype=datatype)
+
+
+def _values_row(values):
+    # blank nodes are local to their endpoint: they are joined after the fact
+    return "(%s)" % " ".join(
+        "UNDEF" if value is None or isinstance(value, BNode) else sparql_term(value)
+        for value in values
+    )
+
+
+def _row_batches(rows, max_values, max_bytes):
+    batch, size = [], 0
+    for row in rows:
+        row_size = len(row.encode("utf-8")) + 1
+        if batch and (len(batch) >= max_values or size + row_size > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(row)
+        size += row_size
+    if batch:
+        yield batch
+
+
+class Federation:
+    """Evaluation state of a federated query."""
+
+    def __init__(
+        self,
+        query,
+        algebra,
+        runner,
+        max_values=DEFAULT_MAX_VALUES,
+        max_bytes=DEFAULT_MAX_BYTES,
+        parallel=DEFAULT_PARALLEL,
+        namespaces=None,
+    ):
+        self.runner = runner
+        self.max_values = max_values
+        self.max_bytes = max_bytes
+        self.parallel = parallel
+        self.requests = 0
+        prologue = split_prologue(query)[0].strip()
+        declared = set(re.findall(r"(?i)PREFIX\s+([^\s:]*):", prologue))
+        extra = [
+            "PREFIX %s: <%s>" % (prefix, namespace)
+            for prefix, namespace in (namespaces or {}).items()
+            if prefix not in declared
+        ]
+        self.prologue = "\n".join(extra + [prologue]).strip()
+
+        # rdflib keeps the text of the first SERVICE block for all of them
+        blocks = service_blocks(query)
+        patterns = _service_patterns(algebra, [])
+        if len(blocks) != len(patterns):
+            raise ValueError("cannot locate the SERVICE blocks of the query")
+        self.blocks = {}
+        for block, pattern in zip(blocks, patterns):
+            if not isinstance(pattern.term, URIRef):
+                raise ValueError("SERVICE endpoints must be IRIs, not %s" % block.endpoint)
+            if block.endpoint.startswith("<") and block.endpoint[1:-1] != str(pattern.term):
+                raise ValueError("cannot locate the SERVICE block of %s" % pattern.term)
+            self.blocks[id(pattern)] = block
+
+    def service_query(self, block, variables, rows):
+        """Return the query sent for ``block``, with ``VALUES`` for ``rows``."""
+        values = ""
+        if variables:
+            values = "VALUES (%s) { %s }\n" % (
+                " ".join(variable.n3() for variable in variables),
+                " ".join(rows),
+            )
+        return "%s\nSELECT * WHERE {\n%s%s\n}" % (self.prologue, values, block.body)
+
+    def bind_join(self, ctx, solutions, part):
+        """Join the ``solutions`` with the answers of the SERVICE ``part``."""
+        wave, size = [], self.max_values * self.parallel
+        for solution in solutions:
+            wave.append(solution)
+            if len(wave) >= size:
+                yield from self._join_wave(ctx, wave, part)
+                wave = []
+        if wave:
+            yield from self._join_wave(ctx, wave, part)
+
+    def _join_wave(self, ctx, wave, part):
+        block = self.blocks[id(part)]
+        endpoint = str(part.term)
+        variables = sorted(
+            variable
+            for variable in part._vars
+            if any(solution.get(variable) is not None for solution in wave)
+        )
+        rows = list(
+            dict.fromkeys(
+                _values_row([solution.get(variable) for variable in variables])
+                for solution in wave
+            )
+        )
+        batches = list(_row_batches(rows, self.max_values, self.max_bytes)) or [[]]
+        requests = [
+            SPARQLRequest(
+                "%s/%d" % (endpoint, index),
+                endpoint,
+                self.service_query(block, variables, batch),
+                JSON,
+            )
+            for index, batch in enumerate(batches)
+        ]
+        self.requests += len(requests)
+        try:
+            results = self.runner.run(requests)
+        except Exception:
+            if not block.silent:
+                raise
+            # a failing SERVICE SILENT is a single empty solution
+            yield from wave
+            return
+
+        answers, index = [], {}
+        for request in requests:
+            result = results[request.name]
+            for binding in result["results"]["bindings"]:
+                answer = FrozenBindings(
+                    ctx, {Variable(name): json_term(term) for name, term in binding.items()}
+                )
+                key = tuple(answer.get(variable) for variable in variables)
+                if None in key:
+                    answers.append(answer)  # compared with every solution
+                else:
+                    index.setdefault(key, []).append(answer)
+        for solution in wave:
+            key = tuple(solution.get(variable) for variable in variables)
+            if None in key:
+                candidates = answers + [a for group in index.values() for a in group]
+            else:
+                candidates = index.get(key, []) + answers
+            for answer in candidates:
+                if solution.compatible(answer):
+                    yield solution.merge(answer)
+
+
+def _federated_eval(ctx, part):
+    federation = _federation.get()
+    if federation is None:
+        raise NotImplementedError
+    if part.name == "ServiceGraphPattern":
+        return federation.bind_join(ctx, [ctx.solution()], part)
+    if part.name == "Join" and getattr(part.p2, "name", None) == "ServiceGraphPattern":
+        return federation.bind_join(ctx, evalPart(ctx, part.p1), part.p2)
+    raise NotImplementedError
+
+
+def federated_query(
+    query,
+    graph=None,
+    runner=None,
+    max_values=DEFAULT_MAX_VALUES,
+    max_bytes=DEFAULT_MAX_BYTES,
+    parallel=DEFAULT_PARALLEL,
+    initNs=None,
+    initBindings=None,
+):
+    """Run ``query`` with bind joins for its ``SERVICE`` blocks.
+
+    The patterns outside the blocks match ``graph`` (empty by default). A
+    batch holds at most ``max_values`` rows and ``max_bytes`` bytes of
+    ``VALUES``, and ``parallel`` batches are sent at a time. Returns the
+    rdflib ``Result``, already evaluated; its ``federation`` attribute
+    counts the ``requests`` sent.
+    """
+    graph = Graph() if graph is None else graph
+    prepared = prepareQuery(query, initNs=initNs or {})
+    federation = Federation(
+        query,
+        prepared.algebra,
+        runner or QueryRunner(),
+        max_values,
+        max_bytes,
+        parallel,
+        initNs,
+    )
+    CUSTOM_EVALS[_EXTENSION] = _federated_eval
+    token = _federation.set(federation)
+    try:
+        result = graph.query(prepared, initBindings=initBindings)
+        if result.type == "SELECT":
+            len(result)  # evaluate the services now
+    finally:
+        _federation.reset(token)
+    result.federation = federation
+    return result
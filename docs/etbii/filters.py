@@ -0,0 +1,215 @@
+"""Rewriting of regex filters matching a fixed string.
+
+The exercises of notebooks 2 and 3 select IRIs with ``FILTER (regex(?publi,
+"pubmed"))`` or ``FILTER (regex(?anatEntity, "CL_"))``: the endpoint, or
+rdflib, compiles the pattern and runs it on every row. When the pattern is a
+plain string, optionally anchored with ``^`` or ``$``, the same test is a
+string function that engines answer without a regex engine, and that a
+sorted term dictionary answers without looking at the rows at all:
+
+==========================  ==================================
+``regex(?x, "^http://a")``  ``STRSTARTS(STR(?x), "http://a")``
+``regex(?x, "_1$")``        ``STRENDS(STR(?x), "_1")``
+``regex(?x, "^CL_1$")``     ``(STR(?x) = "CL_1")``
+``regex(?x, "pubmed")``     ``CONTAINS(STR(?x), "pubmed")``
+==========================  ==================================
+
+:class:`~etbii.CachedSPARQLWrapper` applies :func:`rewrite_filters` to the
+queries it sends (``ETBII_SPARQL_REWRITE_FILTERS=0`` sends them as written),
+and the planner of :mod:`etbii.plan` turns these filters into range lookups on
+the term dictionary of a :class:`~etbii.store.CompactStore`, or into word
+lookups in the label index of :mod:`etbii.labels`. Like Virtuoso, which
+serves most of the endpoints of the book, the rewritten filters match IRIs
+through their string.
+"""
+
+import os
+import re
+from collections import namedtuple
+
+from rdflib import Literal, URIRef, Variable
+
+from etbii.labels import label_index
+from etbii.query import tokenize
+from etbii.store import CompactStore
+
+_METACHARACTERS = frozenset(".^$*+?()[]{}|\\")
+_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f"}
+_STRING_ESCAPE = re.compile(r"\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)", re.DOTALL)
+_VARIABLE_NAME = r"[?$][A-Za-z0-9_\u00b7\u00c0-\uffff]+"
+_CALL = re.compile(
+    r"""
+    \b regex \s* \( \s*
+        (?: str \s* \( \s* (?P<str>%s) \s* \) | (?P<variable>%s) ) \s* , \s*
+        (?P<pattern>"_*") \s*
+        (?: , \s* (?P<flags>"_*") \s* )?
+    \)
+    """
+    % (_VARIABLE_NAME, _VARIABLE_NAME),
+    re.IGNORECASE | re.VERBOSE,
+)
+
+
+class StringFilter(namedtuple("StringFilter", "variable kind text")):
+    """A filter testing the string of ``variable`` against the fixed ``text``.
+
+    ``kind`` is ``prefix``, ``suffix``, ``exact`` or ``substring``.
+    """
+
+    __slots__ = ()
+
+    def matches(self, term):
+        """Return whether the IRI or literal ``term`` passes the filter."""
+        if not isinstance(term, (URIRef, Literal)):
+            return False
+        string = str(term)
+        if self.kind == "prefix":
+            return string.startswith(self.text)
+        if self.kind == "suffix":
+            return string.endswith(self.text)
+        if self.kind == "exact":
+            return string == self.text
+        return self.text in string
+
+    def sparql(self):
+        """Return the filter as a SPARQL expression."""
+        variable, text = self.variable.n3(), _quote(self.text)
+        if self.kind == "exact":
+            return "(STR(%s) = %s)" % (variable, text)
+        function = {"prefix": "STRSTARTS", "suffix": "STRENDS", "substring": "CONTAINS"}
+        return "%s(STR(%s), %s)" % (function[self.kind], variable, text)
+
+
+def literal_pattern(pattern, flags=None):
+    """Return ``(kind, text)`` when the regex ``pattern`` matches a fixed string.
+
+    ``None`` is returned for flags, character classes, repetitions, ... The
+    ``kind`` values are the ones of :class:`StringFilter`.
+    """
+    if flags:
+        return None
+    start = pattern.startswith("^")
+    end = pattern.endswith("$") and not pattern.endswith("\\$")
+    body = pattern[int(start) : len(pattern) - int(end)]
+    text, escaped = [], False
+    for char in body:
+        if escaped:
+            if char.isalnum():
+                return None  # \d, \w, \b, ...
+            text.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char in _METACHARACTERS:
+            return None
+        else:
+            text.append(char)
+    if escaped or not text:
+        return None
+    kind = {(True, True): "exact", (True, False): "prefix", (False, True): "suffix"}
+    return kind.get((start, end), "substring"), "".join(text)
+
+
+def string_filter(expr):
+    """Return the :class:`StringFilter` of an rdflib ``regex`` expression, or ``None``."""
+    if getattr(expr, "name", None) != "Builtin_REGEX":
+        return None
+    text = expr.text
+    if getattr(text, "name", None) == "Builtin_STR":
+        text = text.arg
+    if not isinstance(text, Variable) or not isinstance(expr.pattern, Literal):
+        return None
+    if expr.flags is not None and not isinstance(expr.flags, Literal):
+        return None
+    found = literal_pattern(str(expr.pattern), expr.flags and str(expr.flags))
+    return None if found is None else StringFilter(text, *found)
+
+
+def matching_terms(graph, string_filter, predicates=None):
+    """Return the terms of ``graph`` passing ``string_filter``.
+
+    When the filtered variable is only bound as the object of
+    ``predicates``, all indexed by the :class:`~etbii.labels.LabelIndex` of
+    ``graph``, the terms are looked up in that index. Otherwise they are read
+    from the dictionary of a :class:`CompactStore`, with a range lookup for
+    prefixes and exact strings; ``None`` is returned for the other stores.
+    """
+    if predicates:
+        index = label_index(graph)
+        if index is not None and set(predicates) <= set(index.predicates):
+            terms = index.matching(string_filter)
+            if terms is not None:
+                return terms
+    store = graph.store
+    if not isinstance(store, CompactStore):
+        return None
+    terms = store.terms
+    if string_filter.kind in ("prefix", "exact"):
+        term_ids = terms.prefixed(string_filter.text)
+    else:
+        term_ids = terms.containing(string_filter.text)
+    candidates = (terms.decode(term_id) for term_id in term_ids)
+    return [term for term in candidates if string_filter.matches(term)]
+
+
+def _quote(text):
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"')
+    return '"%s"' % escaped.replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _unquote(literal):
+    quotes = 3 if literal[:3] in ('"""', "'''") else 1
+    body = literal[quotes:-quotes]
+    return _STRING_ESCAPE.sub(
+        lambda match: (
+            chr(int(match.group(1)[1:], 16))
+            if match.group(1)[0] in "uU" and len(match.group(1)) > 1
+            else _ESCAPES.get(match.group(1), match.group(1))
+        ),
+        body,
+    )
+
+
+def _masked(query):
+    # comments blanked, strings and IRIs reduced to delimiters and underscores
+    parts = []
+    for kind, text, _ in tokenize(query):
+        if kind == "comment":
+            parts.append(" " * len(text))
+        elif kind == "string":
+            parts.append('"' + "_" * (len(text) - 2) + '"')
+        elif kind == "iri":
+            parts.append("<" + "_" * (len(text) - 2) + ">")
+        else:
+            parts.append(text)
+    return "".join(parts)
+
+
+def rewrite_filters(query):
+    """Return ``query`` with its fixed-string ``regex`` calls as string functions.
+
+    The query text is otherwise kept as written; regexes with flags or
+    special characters are left alone.
+    """
+    if isinstance(query, bytes):
+        query = query.decode("utf-8")
+    if not query or "regex" not in query.lower():
+        return query
+    parts, position = [], 0
+    for call in _CALL.finditer(_masked(query)):
+        flags = call.group("flags") and _unquote(query[call.start("flags") : call.end("flags")])
+        pattern = _unquote(query[call.start("pattern") : call.end("pattern")])
+        found = literal_pattern(pattern, flags)
+        if found is None:
+            continue
+        variable = Variable((call.group("str") or call.group("variable"))[1:])
+        parts.append(query[position : call.start()])
+        parts.append(StringFilter(variable, *found).sparql())
+        position = call.end()
+    parts.append(query[position:])
+    return "".join(parts)
+
+
+def rewrite_enabled():
+    """Return whether the wrappers rewrite the queries they send."""
+    return os.environ.get("ETBII_SPARQL_REWRITE_FILTERS", "1") != "0"
@@ -0,0 +1,351 @@
+"""Class hierarchy index for local ontology dumps.
+
+The questions of notebook 2 navigate ontologies: the sub-classes of "mitral
+stenosis" in HPO, the direct sub-classes of ``DOID_4079`` and their
+``obo:hasExactSynonym``. On a local dump, ``rdfs:subClassOf*`` is evaluated
+by rdflib as a graph traversal from every candidate class, for every query.
+:class:`ClassHierarchy` labels the ``rdfs:subClassOf`` graph once:
+
+* the strongly connected components (classes declared equivalent through a
+  cycle) are merged, which leaves a DAG;
+* a depth-first walk from the most general classes numbers the classes in
+  post-order, so that the sub-classes reached through the walk are a range
+  of numbers ending at the class itself;
+* each class keeps the sorted, merged ranges of all its sub-classes -- one
+  range for a tree, a few more for the classes with several parents.
+
+A sub-class test is then a binary search of one number among the ranges of
+the super-class, and the sub-classes of a class are read as slices of the
+post-order. The same labeling of the reversed DAG answers the super-classes.
+The labels and exact synonyms of the classes are kept in a case-insensitive
+lookup table::
+
+    doid = ClassHierarchy(graph)
+    doid.lookup("heart valve disease")
+    doid.children(DOID.DOID_4079)
+    doid.is_subclass(DOID.DOID_1728, DOID.DOID_4079)
+
+:func:`index_hierarchy` also registers the index of a graph: once
+:func:`enable_hierarchy` is called, the ``rdfs:subClassOf*`` and
+``rdfs:subClassOf+`` paths of the local queries on that graph are answered
+from it. The index is rebuilt when the number of triples of the graph
+changes.
+"""
+
+import weakref
+from bisect import bisect_right
+
+import networkx as nx
+import numpy as np
+from rdflib import Literal, Namespace
+from rdflib.namespace import RDFS
+from rdflib.paths import AlternativePath, InvPath, MulPath, SequencePath
+from rdflib.plugins.sparql import CUSTOM_EVALS
+from rdflib.plugins.sparql.evaluate import evalPart
+from rdflib.plugins.sparql.parserutils import CompValue
+
+from etbii.edges import EdgeList
+
+OBO_IN_OWL = Namespace("http://www.geneontology.org/formats/oboInOwl#")
+DEFAULT_NAMES = (RDFS.label, OBO_IN_OWL.hasExactSynonym)
+
+_EXTENSION = "etbii.hierarchy"
+_indexes = weakref.WeakKeyDictionary()
+
+
+def _label(children, roots, count):
+    """Return ``(post, order, starts, ends)`` of the DAG ``children``.
+
+    ``post[node]`` is the post-order number of ``node`` in a depth-first
+    walk from ``roots``, ``order`` its inverse, and ``starts[node]`` and
+    ``ends[node]`` the sorted bounds of the ranges of post-order numbers of
+    the nodes reachable from ``node``, itself included.
+    """
+    post = [-1] * count
+    low = [0] * count
+    order = []
+    visited = [False] * count
+    for root in roots:
+        if visited[root]:
+            continue
+        visited[root] = True
+        stack = [(root, iter(children[root]))]
+        low[root] = len(order)
+        while stack:
+            node, pending = stack[-1]
+            for child in pending:
+                if not visited[child]:
+                    visited[child] = True
+                    low[child] = len(order)
+                    stack.append((child, iter(children[child])))
+                    break
+            else:
+                stack.pop()
+                post[node] = len(order)
+                order.append(node)
+
+    # in a DAG, every child is numbered before its parents
+    starts, ends = [None] * count, [None] * count
+    for node in order:
+        first, last = low[node], post[node]
+        ranges = [(first, last)]
+        for child in children[node]:
+            # the children reached through the walk are within the range of node
+            if not (first <= starts[child][0] and ends[child][-1] <= last):
+                ranges.extend(zip(starts[child], ends[child]))
+        if len(ranges) == 1:
+            starts[node], ends[node] = [first], [last]
+            continue
+        ranges.sort()
+        merged_starts, merged_ends = [ranges[0][0]], [ranges[0][1]]
+        for start, end in ranges[1:]:
+            if start <= merged_ends[-1] + 1:
+                merged_ends[-1] = max(merged_ends[-1], end)
+            else:
+                merged_starts.append(start)
+                merged_ends.append(end)
+        starts[node], ends[node] = merged_starts, merged_ends
+    return post, order, starts, ends
+
+
+def _reaches(post, starts, ends, node, other):
+    # whether the ranges of node contain the number of other
+    position = bisect_right(starts[node], post[other]) - 1
+    return position >= 0 and ends[node][position] >= post[other]
+
+
+def _reached(order, starts, ends, node):
+    return [
+        reached
+        for start, end in zip(starts[node], ends[node])
+        for reached in order[start : end + 1]
+    ]
+
+
+class ClassHierarchy:
+    """Sub-class closure of an ontology, with its labels and synonyms.
+
+    :param graph: rdflib graph of the ontology
+    :param predicate: the hierarchy property
+    :param names: the properties whose literals name the classes, in the
+        lookup table
+
+    The classes are the subjects and objects of ``predicate``; the methods
+    raise ``KeyError`` for other terms. Like ``rdfs:subClassOf*``, the
+    closure is reflexive unless ``strict``.
+    """
+
+    def __init__(self, graph, predicate=RDFS.subClassOf, names=DEFAULT_NAMES):
+        self.predicate = predicate
+        self.names = names
+        self.triples = len(graph)
+        edges = EdgeList.from_graph(graph, predicate).unique()
+        self.classes = edges.nodes
+        self._index = {term: i for i, term in enumerate(self.classes)}
+
+        # classes made equivalent by a cycle are merged into a component
+        sources, targets = edges.sources, edges.targets
+        cycles = nx.DiGraph()
+        cycles.add_nodes_from(range(len(self.classes)))
+        cycles.add_edges_from(zip(sources.tolist(), targets.tolist()))
+        self._members = [sorted(members) for members in nx.strongly_connected_components(cycles)]
+        self._component = np.empty(len(self.classes), dtype=np.int32)
+        for component, members in enumerate(self._members):
+            self._component[members] = component
+        count = len(self._members)
+        self._cyclic = [len(members) > 1 for members in self._members]
+        for component in self._component[sources[sources == targets]].tolist():
+            self._cyclic[component] = True
+
+        # super-class -> sub-class edges between the components, a DAG
+        subs, supers = self._component[sources], self._component[targets]
+        between = np.unique(np.stack([supers, subs])[:, subs != supers], axis=1)
+        down, up = [[] for _ in range(count)], [[] for _ in range(count)]
+        for component, sub in zip(*between.tolist()):
+            down[component].append(sub)
+            up[sub].append(component)
+        self._down = _label(down, [c for c in range(count) if not up[c]], count)
+        self._up = _label(up, [c for c in range(count) if not down[c]], count)
+        self._parents = [[] for _ in self.classes]
+        self._children = [[] for _ in self.classes]
+        for source, target in zip(sources.tolist(), targets.tolist()):
+            self._parents[source].append(target)
+            self._children[target].append(source)
+
+        self._names = {}
+        self._synonyms = {}
+        for name_predicate in names:
+            for subject, name in graph.subject_objects(name_predicate):
+                if not isinstance(name, Literal):
+                    continue
+                self._names.setdefault(str(name).casefold(), []).append(subject)
+                if name_predicate != RDFS.label:
+                    self._synonyms.setdefault(subject, []).append(name)
+
+    def __len__(self):
+        return len(self.classes)
+
+    def __contains__(self, term):
+        return term in self._index
+
+    def __repr__(self):
+        return "ClassHierarchy(%d classes)" % len(self)
+
+    def _terms(self, indexes):
+        return [self.classes[i] for i in indexes]
+
+    def is_subclass(self, cls, superclass, strict=False):
+        """Return whether ``cls`` is a sub-class of ``superclass``."""
+        node, other = self._index[cls], self._index[superclass]
+        component, super_component = self._component[node], self._component[other]
+        if component == super_component:
+            return not strict or node != other or self._cyclic[component]
+        return _reaches(self._down[0], self._down[2], self._down[3], super_component, component)
+
+    def _closure(self, cls, labels, strict):
+        node = self._index[cls]
+        component = self._component[node]
+        _, order, starts, ends = labels
+        reached = [
+            member
+            for reached_component in _reached(order, starts, ends, component)
+            for member in self._members[reached_component]
+        ]
+        if strict and not self._cyclic[component]:
+            reached.remove(node)
+        return self._terms(reached)
+
+    def descendants(self, cls, strict=False):
+        """Return the sub-classes of ``cls``, in post-order."""
+        return self._closure(cls, self._down, strict)
+
+    def ancestors(self, cls, strict=False):
+        """Return the super-classes of ``cls``."""
+        return self._closure(cls, self._up, strict)
+
+    def children(self, cls):
+        """Return the direct sub-classes of ``cls``."""
+        return self._terms(self._children[self._index[cls]])
+
+    def parents(self, cls):
+        """Return the direct super-classes of ``cls``."""
+        return self._terms(self._parents[self._index[cls]])
+
+    def synonyms(self, term):
+        """Return the synonyms of ``term``, the literals of ``names`` but ``rdfs:label``."""
+        return list(self._synonyms.get(term, ()))
+
+    def lookup(self, name):
+        """Return the terms labeled or named ``name``, ignoring case."""
+        return list(dict.fromkeys(self._names.get(str(name).casefold(), ())))
+
+    def pairs(self, subj=None, obj=None, strict=False):
+        """Yield the ``(sub-class, super-class)`` pairs of the closure.
+
+        ``subj`` and ``obj`` restrict the pairs, as the ends of a property
+        path; at least one of them is bound.
+        """
+        if subj is not None and obj is not None:
+            if subj in self and obj in self and self.is_subclass(subj, obj, strict):
+                yield subj, obj
+        elif subj is not None:
+            for ancestor in self.ancestors(subj, strict):
+                yield subj, ancestor
+        else:
+            for descendant in self.descendants(obj, strict):
+                yield descendant, obj
+
+
+class _IndexedPath(MulPath):
+    """``predicate*`` or ``predicate+`` evaluated with a :class:`ClassHierarchy`."""
+
+    def __init__(self, path, hierarchy):
+        super().__init__(path.path, path.mod)
+        self.hierarchy = hierarchy
+
+    def eval(self, graph, subj=None, obj=None, first=True):
+        hierarchy = self.hierarchy
+        strict = not self.zero
+        if subj is None and obj is None:
+            if self.zero:
+                # every node of the graph is a zero-length path
+                yield from super().eval(graph, subj, obj, first)
+                return
+            for node in hierarchy.classes:
+                for pair in hierarchy.pairs(node, None, strict):
+                    yield pair
+            return
+        if (subj is None or subj in hierarchy) and (obj is None or obj in hierarchy):
+            yield from hierarchy.pairs(subj, obj, strict)
+        elif self.zero and (subj is None or obj is None or subj == obj):
+            # a term outside the hierarchy only reaches itself
+            yield (subj or obj), (subj or obj)
+
+
+def _indexed(path, hierarchy):
+    # path with its hierarchy closures indexed, path itself if it has none
+    if type(path) is MulPath and path.path == hierarchy.predicate and path.mod in "*+":
+        return _IndexedPath(path, hierarchy)
+    if isinstance(path, InvPath):
+        arg = _indexed(path.arg, hierarchy)
+        return path if arg is path.arg else InvPath(arg)
+    if isinstance(path, (SequencePath, AlternativePath)):
+        args = [_indexed(arg, hierarchy) for arg in path.args]
+        if all(arg is old for arg, old in zip(args, path.args)):
+            return path
+        return type(path)(*args)
+    return path
+
+
+def index_hierarchy(graph, predicate=RDFS.subClassOf, names=DEFAULT_NAMES):
+    """Return the :class:`ClassHierarchy` of ``graph``, built once and registered.
+
+    The registered index answers the ``predicate`` paths of the local
+    queries on ``graph`` once :func:`enable_hierarchy` is called.
+    """
+    indexes = _indexes.setdefault(graph.store, {})
+    hierarchy = indexes.get(predicate)
+    if hierarchy is None or hierarchy.triples != len(graph):
+        hierarchy = indexes[predicate] = ClassHierarchy(graph, predicate, names)
+    return hierarchy
+
+
+def _rewrite(ctx, bgp):
+    # bgp with the indexed paths, None if it has none
+    indexes = _indexes.get(ctx.graph.store)
+    if not indexes:
+        return None
+    triples, changed = [], False
+    for subject, path, obj in bgp.triples:
+        for predicate, hierarchy in list(indexes.items()):
+            indexed = _indexed(path, hierarchy)
+            if indexed is not path:
+                # rebuilt if the graph changed
+                hierarchy = index_hierarchy(ctx.graph, predicate, hierarchy.names)
+                path, changed = _indexed(path, hierarchy), True
+        triples.append((subject, path, obj))
+    if not changed:
+        return None
+    return CompValue("BGP", **dict(bgp, triples=triples))
+
+
+def hierarchy_eval(ctx, part):
+    """rdflib custom evaluation of the basic graph patterns with indexed paths."""
+    if part.name == "BGP":
+        rewritten = _rewrite(ctx, part)
+        if rewritten is not None:
+            return evalPart(ctx, rewritten)
+    elif part.name == "Filter" and getattr(part.p, "name", None) == "BGP":
+        rewritten = _rewrite(ctx, part.p)
+        if rewritten is not None:
+            return evalPart(ctx, CompValue("Filter", **dict(part, p=rewritten)))
+    raise NotImplementedError
+
+
+def enable_hierarchy():
+    """Answer the hierarchy paths of local queries with the registered indexes."""
+    CUSTOM_EVALS[_EXTENSION] = hierarchy_eval
+
+
+def disable_hierarchy():
+    CUSTOM_EVALS.pop(_EXTENSION, None)
@@ -0,0 +1,212 @@
+"""Full-text index of the labels and synonyms of a local graph.
+
+Notebook 2 finds "mitral valve prolapse" with the "jump to" box of BioPortal,
+and the string filters of notebooks 2 and 3 (``FILTER (regex(?name,
+"^CYP2B6"))``) are tested on every label the patterns produce. A
+:class:`LabelIndex` reads the ``rdfs:label``, ``up:mnemonic``,
+``bp:displayName`` and ``oboInOwl:hasExactSynonym`` values of a graph once
+and keeps an inverted index of their words: the case-folded words sorted in
+a vocabulary, each with the sorted ids of the labels containing it. A word
+prefix is a range of the vocabulary, so a search is a few binary searches
+and the intersection of integer arrays::
+
+    labels = index_labels(graph)
+    labels.search("mitral valve prol")
+
+:func:`index_labels` also registers the index of a graph, which the planner
+of :mod:`etbii.plan` then uses for the fixed-string filters of
+:mod:`etbii.filters` on a variable bound only by the indexed properties: the
+words of the filter that start a word of the label select the candidate
+labels, and the filter is tested on these candidates only. The index is
+rebuilt when the number of triples of the graph changes.
+"""
+
+import re
+import weakref
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from itertools import chain
+
+import numpy as np
+from rdflib import Literal, Namespace, URIRef
+from rdflib.namespace import RDFS
+
+from etbii.edges import EdgeList
+from etbii.hierarchy import OBO_IN_OWL
+
+UP = Namespace("http://purl.uniprot.org/core/")
+BP = Namespace("http://www.biopax.org/release/biopax-level3.owl#")
+DEFAULT_PREDICATES = (RDFS.label, UP.mnemonic, BP.displayName, OBO_IN_OWL.hasExactSynonym)
+DEFAULT_LIMIT = 20
+RANKED = 1000
+
+_WORD = re.compile(r"\w+")
+_indexes = weakref.WeakKeyDictionary()
+
+
+class LabelMatch(namedtuple("LabelMatch", "subject predicate label")):
+    """A resource found by its ``label``, the value of ``predicate``."""
+
+    __slots__ = ()
+
+
+class LabelIndex:
+    """Inverted index of the words of the values of ``predicates``.
+
+    ``labels`` are the distinct IRIs and literals of the indexed
+    properties, numbered in the order they were read.
+    """
+
+    def __init__(self, graph, predicates=DEFAULT_PREDICATES):
+        self.predicates = tuple(predicates)
+        self.triples = len(graph)
+        label_ids = {}
+        entries = []
+        for predicate in self.predicates:
+            edges = EdgeList.from_graph(graph, predicate)
+            nodes = edges.nodes
+            for source, target in zip(edges.sources.tolist(), edges.targets.tolist()):
+                label = nodes[target]
+                if isinstance(label, (Literal, URIRef)):
+                    label_id = label_ids.setdefault(label, len(label_ids))
+                    entries.append((label_id, nodes[source], predicate))
+        self.labels = list(label_ids)
+
+        # the subjects of each label, ordered by label id
+        entries.sort(key=lambda entry: entry[0])
+        self._subjects = [subject for _, subject, _ in entries]
+        self._subject_predicates = [predicate for _, _, predicate in entries]
+        self._subject_offsets = np.searchsorted(
+            np.array([label_id for label_id, _, _ in entries], dtype=np.int64),
+            np.arange(len(self.labels) + 1),
+        )
+
+        # the ids of the labels containing each word, words in sorted order
+        words = {}
+        for label_id, label in enumerate(self.labels):
+            for word in set(_WORD.findall(str(label).casefold())):
+                words.setdefault(word, []).append(label_id)
+        self.vocabulary = sorted(words)
+        sizes = [len(words[word]) for word in self.vocabulary]
+        self._offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self._offsets[1:])
+        self._postings = np.fromiter(
+            chain.from_iterable(words[word] for word in self.vocabulary),
+            dtype=np.int32,
+            count=int(self._offsets[-1]),
+        )
+        self._lengths = np.array([len(str(label)) for label in self.labels], dtype=np.int32)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __repr__(self):
+        return "LabelIndex(%d labels, %d words)" % (len(self.labels), len(self.vocabulary))
+
+    def _word_labels(self, word, prefix):
+        # ids of the labels with the word, or a word starting with it
+        start = bisect_left(self.vocabulary, word)
+        if prefix:
+            end = bisect_left(self.vocabulary, word + "\U0010ffff", start)
+        else:
+            end = bisect_right(self.vocabulary, word, start)
+        postings = self._postings[self._offsets[start] : self._offsets[end]]
+        if end - start <= 1:
+            return postings
+        if len(postings) > len(self.labels) // 16:
+            # cheaper than sorting the postings of a short prefix
+            found = np.zeros(len(self.labels), dtype=bool)
+            found[postings] = True
+            return np.flatnonzero(found).astype(np.int32)
+        return np.unique(postings)
+
+    def _candidates(self, words):
+        # ids of the labels matching all the (word, prefix) pairs, rarest first
+        postings = sorted(
+            (self._word_labels(word, prefix) for word, prefix in words), key=len
+        )
+        found = postings[0]
+        for other in postings[1:]:
+            if not len(found):
+                break
+            found = np.intersect1d(found, other, assume_unique=True)
+        return found
+
+    def search(self, text, limit=DEFAULT_LIMIT):
+        """Return the :class:`LabelMatch` of the labels with words starting as those of ``text``.
+
+        The search ignores case and word order, like a "jump to" box. Labels
+        equal to ``text``, then starting with it, then the shortest ones come
+        first; only the ``RANKED`` shortest labels are ranked when more
+        match. ``limit=None`` returns all the matches.
+        """
+        words = _WORD.findall(str(text).casefold())
+        if not words:
+            return []
+        query = " ".join(words)
+        found = self._candidates([(word, True) for word in words])
+        if len(found) > RANKED and limit is not None:
+            found = found[np.argpartition(self._lengths[found], RANKED)[:RANKED]]
+        found = found.tolist()
+
+        def rank(label_id):
+            folded = " ".join(_WORD.findall(str(self.labels[label_id]).casefold()))
+            return (folded != query, not folded.startswith(query), len(folded), folded)
+
+        matches = []
+        for label_id in sorted(found, key=rank):
+            matches.extend(self._matches(label_id))
+            if limit is not None and len(matches) >= limit:
+                return matches[:limit]
+        return matches
+
+    def _matches(self, label_id):
+        start, end = self._subject_offsets[label_id], self._subject_offsets[label_id + 1]
+        return [
+            LabelMatch(subject, predicate, self.labels[label_id])
+            for subject, predicate in zip(
+                self._subjects[start:end], self._subject_predicates[start:end]
+            )
+        ]
+
+    def matching(self, string_filter):
+        """Return the labels passing a :class:`~etbii.filters.StringFilter`.
+
+        ``None`` is returned when the filter text starts no word of the
+        labels, for instance ``"_1"`` as a suffix, and cannot use the index.
+        """
+        text = string_filter.text.casefold()
+        starts = string_filter.kind in ("prefix", "exact")
+        ends = string_filter.kind in ("suffix", "exact")
+        words = []
+        for word in _WORD.finditer(text):
+            # a word of the text starts a word of the label if it follows a
+            # separator, and ends it if it is followed by one
+            if word.start() == 0 and not starts:
+                continue
+            whole = word.end() < len(text) or ends
+            words.append((word.group(), not whole))
+        if not words:
+            return None
+        labels = (self.labels[label_id] for label_id in self._candidates(words).tolist())
+        return [label for label in labels if string_filter.matches(label)]
+
+
+def index_labels(graph, predicates=DEFAULT_PREDICATES):
+    """Return the :class:`LabelIndex` of ``graph``, built once and registered.
+
+    The registered index answers the string filters of the planned local
+    queries on ``graph``, see :mod:`etbii.plan`.
+    """
+    index = _indexes.get(graph.store)
+    if index is None or index.triples != len(graph) or index.predicates != tuple(predicates):
+        index = _indexes[graph.store] = LabelIndex(graph, predicates)
+    return index
+
+
+def label_index(graph):
+    """Return the registered :class:`LabelIndex` of ``graph``, ``None`` if there is none."""
+    index = _indexes.get(graph.store)
+    if index is not None and index.triples != len(graph):
+        index = index_labels(graph, index.predicates)
+    return index
@@ -0,0 +1,337 @@
+"""Parallel bulk loading of N-Triples and Turtle dumps.
+
+``kg.parse(data=..., format="turtle")`` parses a whole document in one
+thread and keeps every triple as Python objects, which is fine for the
+examples of notebook 1 but not for a local dump of UniProt or PathwayCommons.
+:func:`load` streams the files from disk (gzip included), cuts them into
+chunks at statement boundaries and parses the chunks in a pool of processes.
+Each worker returns the encodings of its distinct terms and its triples as
+integer ids; the parent deduplicates the terms through a single dictionary
+and builds the indexes of a :class:`~etbii.store.CompactStore` once, at the
+end::
+
+    graph, stats = load(["pc-biopax.nt.gz"], jobs=8)
+    print(stats)
+
+From the ``docs/`` directory, ``python -m etbii.load DUMP... --snapshot
+OUT`` writes the result as a snapshot (:mod:`etbii.snapshot`) that later
+sessions reopen instantly, without building rdflib terms in the parent.
+
+N-Triples chunks are cut at line ends. Turtle is cut after the statements
+ending at the top level, the ``@prefix``/``@base`` directives read so far
+being repeated at the top of every chunk. Blank node labels are scoped to
+their file: they are rewritten to IRIs before a chunk is parsed and turned
+back into blank nodes afterwards.
+"""
+
+import argparse
+import codecs
+import gzip
+import hashlib
+import os
+import re
+import sys
+import time
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from rdflib import BNode, Graph, URIRef
+from rdflib.store import Store
+from rdflib.util import guess_format
+
+from etbii.query import tokenize
+from etbii.snapshot import decode_term, encode_term, write_snapshot
+from etbii.store import DTYPE, CompactStore, TermDictionary, build_indexes, sort_rows
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+SKOLEM = "urn:etbii:bnode:"
+
+_LABEL = re.compile(r"_:([A-Za-z0-9_][A-Za-z0-9_.\-]*[A-Za-z0-9_\-]|[A-Za-z0-9_])")
+_DIRECTIVES = ("@prefix", "@base")
+
+
+class LoadStats(namedtuple("LoadStats", "triples terms bytes seconds")):
+    """Counters of a bulk load."""
+
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """Triples loaded per second."""
+        return self.triples / self.seconds if self.seconds else float("inf")
+
+    def __str__(self):
+        return "%d triples, %d terms, %.1f MB in %.1fs (%.0f triples/s)" % (
+            self.triples,
+            self.terms,
+            self.bytes / 1e6,
+            self.seconds,
+            self.rate,
+        )
+
+
+def dump_format(path):
+    """Return the rdflib format of the dump at ``path`` (``nt`` or ``turtle``)."""
+    name = str(path)
+    if name.endswith(".gz"):
+        name = name[: -len(".gz")]
+    rdf_format = guess_format(name)
+    if rdf_format not in ("nt", "turtle"):
+        raise ValueError("%s: only N-Triples and Turtle dumps can be bulk loaded" % path)
+    return rdf_format
+
+
+def _open(path):
+    if str(path).endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def _blocks(path, chunk_size):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with _open(path) as dump:
+        while True:
+            data = dump.read(chunk_size)
+            text = decoder.decode(data, final=not data)
+            if text:
+                yield text
+            if not data:
+                return
+
+
+def ntriples_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield ``("", text)`` chunks of whole lines of an N-Triples file."""
+    rest = ""
+    for block in _blocks(path, chunk_size):
+        text = rest + block
+        end = text.rfind("\n") + 1
+        if end:
+            yield "", text[:end]
+        rest = text[end:]
+    if rest.strip():
+        yield "", rest
+
+
+def _statement_ends(text, prologue):
+    """Return the offset after the last complete top-level statement of ``text``.
+
+    The directives met on the way are appended to ``prologue``.
+    """
+    depth, start, end, directive = 0, None, 0, 0
+    for kind, token, position in tokenize(text):
+        if kind in ("space", "comment"):
+            continue
+        if kind == "other" and token in ('"', "'", "<"):
+            break  # string or IRI cut by the end of the block
+        if start is None:
+            start = position
+            # SPARQL-style PREFIX and BASE have no final dot
+            directive = {"prefix": 3, "base": 2}.get(token.lower(), 0)
+        if directive:
+            directive -= 1
+            if not directive:
+                prologue.append(text[start : position + len(token)])
+                start, end = None, position + len(token)
+            continue
+        if kind != "other":
+            continue
+        depth += sum(token.count(char) for char in "[(")
+        depth -= sum(token.count(char) for char in "])")
+        if depth == 0 and token.endswith("."):
+            statement_end = position + len(token)
+            if text[start:statement_end].split(None, 1)[0].lower() in _DIRECTIVES:
+                prologue.append(text[start:statement_end])
+            start, end = None, statement_end
+    return end
+
+
+def turtle_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield ``(prologue, text)`` chunks of whole statements of a Turtle file."""
+    prologue, rest = [], ""
+    for block in _blocks(path, chunk_size):
+        text = rest + block
+        known = "\n".join(prologue)
+        end = _statement_ends(text, prologue)
+        if end:
+            yield known, text[:end]
+        rest = text[end:]
+    if rest.strip():
+        yield "\n".join(prologue), rest
+
+
+def _skolemize(text, tag):
+    if "_:" not in text:
+        return text
+    parts = []
+    for kind, token, _ in tokenize(text):
+        if kind == "other" and "_:" in token:
+            token = _LABEL.sub(lambda match: "<%s%s%s>" % (SKOLEM, tag, match.group(1)), token)
+        parts.append(token)
+    return "".join(parts)
+
+
+class _ChunkSink(Store):
+    """Store encoding the triples of a parsed chunk as they are added."""
+
+    def __init__(self):
+        super().__init__()
+        self.ids = {}
+        self.encodings = []
+        self.triples = array("i")
+
+    def add(self, triple, context, quoted=False):
+        ids = self.ids
+        for term in triple:
+            term_id = ids.get(term)
+            if term_id is None:
+                if isinstance(term, URIRef) and term.startswith(SKOLEM):
+                    encoding = encode_term(BNode(term[len(SKOLEM):]))
+                else:
+                    encoding = encode_term(term)
+                term_id = ids[term] = len(self.encodings)
+                self.encodings.append(encoding)
+            self.triples.append(term_id)
+
+    def bind(self, prefix, namespace, override=True):
+        pass
+
+    def namespace(self, prefix):
+        return None
+
+    def prefix(self, namespace):
+        return None
+
+    def namespaces(self):
+        return iter(())
+
+
+def parse_chunk(prologue, text, rdf_format, tag, public_id=None):
+    """Parse a chunk, return ``(encodings, triples)``.
+
+    ``encodings`` lists the encoded distinct terms of the chunk and
+    ``triples`` holds the ``int32`` local ids of its terms, 3 per triple
+    (duplicates included).
+    """
+    sink = _ChunkSink()
+    data = _skolemize(prologue + "\n" + text if prologue else text, tag)
+    Graph(store=sink).parse(data=data, format=rdf_format, publicID=public_id)
+    return sink.encodings, sink.triples.tobytes()
+
+
+def _chunks(paths, chunk_size):
+    for path in paths:
+        rdf_format = dump_format(path)
+        tag = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:8] + "_"
+        public_id = Path(path).resolve().as_uri()
+        split = ntriples_chunks if rdf_format == "nt" else turtle_chunks
+        for prologue, text in split(path, chunk_size):
+            yield prologue, text, rdf_format, tag, public_id
+
+
+def load_ids(paths, jobs=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Load ``paths`` into ``(encodings, triples, stats)``.
+
+    ``encodings`` are the distinct terms (as :func:`~etbii.snapshot.encode_term`
+    bytes) and ``triples`` the sorted, unique ``(n, 3)`` array of their ids.
+    ``progress(stats)`` is called after every chunk.
+    """
+    start = time.perf_counter()
+    size = sum(os.path.getsize(path) for path in paths)
+    ids, encodings = {}, []
+    triples = array("i")
+    jobs = jobs or os.cpu_count() or 1
+
+    def merge(result):
+        chunk_encodings, chunk_triples = result
+        remap = np.empty(len(chunk_encodings), dtype=DTYPE)
+        for local_id, encoding in enumerate(chunk_encodings):
+            term_id = ids.get(encoding)
+            if term_id is None:
+                term_id = ids[encoding] = len(encodings)
+                encodings.append(encoding)
+            remap[local_id] = term_id
+        triples.frombytes(remap[np.frombuffer(chunk_triples, dtype=DTYPE)].tobytes())
+        if progress is not None:
+            elapsed = time.perf_counter() - start
+            progress(LoadStats(len(triples) // 3, len(encodings), size, elapsed))
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for chunk in _chunks(paths, chunk_size):
+            pending.append(pool.submit(parse_chunk, *chunk))
+            # bound the number of parsed chunks waiting in memory
+            while len(pending) > 2 * jobs:
+                merge(pending.popleft().result())
+        while pending:
+            merge(pending.popleft().result())
+
+    rows = sort_rows(np.frombuffer(triples, dtype=DTYPE).reshape(-1, 3))
+    stats = LoadStats(len(rows), len(encodings), size, time.perf_counter() - start)
+    return encodings, rows, stats
+
+
+def merge_equal_terms(encodings, rows):
+    """Return ``(terms, encodings, rows)`` with the equal terms merged.
+
+    Encodings that differ in text can decode to terms that rdflib considers
+    equal, such as ``"x"@EN`` and ``"x"@en`` read in different chunks. The
+    ids of such terms are mapped to the id of the first one, the other ids
+    are dropped and ``rows`` is renumbered, sorted and deduplicated again.
+    """
+    terms = [decode_term(encoding) for encoding in encodings]
+    first = {}
+    merged = np.fromiter(
+        (first.setdefault(term, term_id) for term_id, term in enumerate(terms)),
+        dtype=DTYPE,
+        count=len(terms),
+    )
+    kept = np.flatnonzero(merged == np.arange(len(terms), dtype=DTYPE))
+    if len(kept) == len(terms):
+        return terms, encodings, rows
+    renumber = np.empty(len(terms), dtype=DTYPE)
+    renumber[kept] = np.arange(len(kept), dtype=DTYPE)
+    rows = sort_rows(renumber[merged][rows])
+    positions = kept.tolist()
+    return [terms[i] for i in positions], [encodings[i] for i in positions], rows
+
+
+def load(paths, jobs=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Load N-Triples/Turtle ``paths`` into a graph, return ``(graph, stats)``.
+
+    The graph is backed by a :class:`~etbii.store.CompactStore`.
+    """
+    encodings, rows, stats = load_ids(paths, jobs, chunk_size, progress)
+    terms, encodings, rows = merge_equal_terms(encodings, rows)
+    terms = TermDictionary.from_terms(terms)
+    if len(terms) != len(encodings):
+        raise ValueError("%d terms for %d encodings" % (len(terms), len(encodings)))
+    graph = Graph(store=CompactStore(terms=terms, indexes=build_indexes(rows)))
+    return graph, stats._replace(triples=len(rows), terms=len(terms))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="N-Triples or Turtle files, optionally gzipped")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="parsing processes")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--snapshot", help="write the loaded graph to this snapshot file")
+    args = parser.parse_args(argv)
+
+    def progress(stats):
+        print(f"\r{stats}", end="", file=sys.stderr, flush=True)
+
+    encodings, rows, stats = load_ids(args.paths, args.jobs, args.chunk_size, progress)
+    print(file=sys.stderr)
+    _, encodings, rows = merge_equal_terms(encodings, rows)
+    stats = stats._replace(triples=len(rows), terms=len(encodings))
+    if args.snapshot:
+        write_snapshot(args.snapshot, encodings, build_indexes(rows))
+    print(stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
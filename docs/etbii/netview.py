@@ -0,0 +1,319 @@
+"""Display large interaction networks in ipycytoscape.
+
+``add_graph_from_networkx`` creates one widget per node and per edge and
+lets the browser run the layout: with the tens of thousands of edges of an
+interactome, the page freezes. :class:`NetworkView` keeps the browser's work
+proportional to what is displayed:
+
+* the nodes of degree lower than ``min_degree`` are hidden behind an
+  aggregate node (``+12``) attached to their most connected neighbor, which
+  is usually the protein the interactions were queried for;
+* the positions are computed in Python by :func:`force_layout` and the
+  widget uses the ``preset`` layout;
+* the nodes and edges are sent in batches of ``batch_size``;
+* clicking an aggregate node, or a node with hidden neighbors, displays
+  them around it.
+
+::
+
+    view = NetworkView(EdgeList.from_bindings(results, "P1_label", "P2_label"))
+    view.widget()
+"""
+
+import math
+
+import numpy as np
+
+from etbii.environment import check_environment
+
+DEFAULT_MIN_DEGREE = 2
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_ITERATIONS = 50
+# above this number of nodes the repulsion between nodes is computed on a grid
+EXACT_REPULSION_LIMIT = 2000
+_CHUNK = 1024
+
+STYLE = [
+    {
+        "selector": "node",
+        "css": {
+            "content": "data(name)",
+            "text-valign": "center",
+            "color": "white",
+            "text-outline-width": 2,
+            "text-outline-color": "green",
+            "background-color": "green",
+        },
+    },
+    {
+        "selector": "node.aggregate",
+        "css": {
+            "shape": "round-rectangle",
+            "background-color": "gray",
+            "text-outline-color": "gray",
+        },
+    },
+    {"selector": "edge", "css": {"width": 1, "line-color": "#bbb"}},
+    {
+        "selector": ":selected",
+        "css": {"background-color": "black", "line-color": "black", "text-outline-color": "black"},
+    },
+]
+
+
+def _repel(chunk, centers, masses, k):
+    # weights[i, j] = masses[j] k^2 / d^2: the displacement of node i is
+    # sum_j weights[i, j] (chunk[i] - centers[j])
+    dx = chunk[:, 0, None] - centers[None, :, 0]
+    dy = chunk[:, 1, None] - centers[None, :, 1]
+    return (k * k) * masses[None, :] / np.maximum(dx * dx + dy * dy, 1e-6 * k * k)
+
+
+def _exact_repulsion(positions, k):
+    displacement = np.empty_like(positions)
+    masses = np.ones(len(positions))
+    for start in range(0, len(positions), _CHUNK):
+        chunk = positions[start:start + _CHUNK]
+        weights = _repel(chunk, positions, masses, k)
+        weights[np.arange(len(chunk)), np.arange(start, start + len(chunk))] = 0.0
+        pushed = chunk * weights.sum(axis=1)[:, None] - weights @ positions
+        displacement[start:start + _CHUNK] = pushed
+    return displacement
+
+
+def _grid_repulsion(positions, k, cells):
+    # every node is repelled by the center of mass of each cell of a grid;
+    # its own cell is taken without itself
+    low = positions.min(axis=0)
+    span = np.maximum(positions.max(axis=0) - low, 1e-9)
+    coordinates = np.minimum(((positions - low) / span * cells).astype(np.int64), cells - 1)
+    cell = coordinates[:, 0] * cells + coordinates[:, 1]
+    size = cells * cells
+    mass = np.bincount(cell, minlength=size).astype(np.float64)
+    sums = np.stack(
+        [np.bincount(cell, weights=positions[:, axis], minlength=size) for axis in range(2)],
+        axis=1,
+    )
+    occupied = np.flatnonzero(mass)
+    centers = sums[occupied] / mass[occupied, None]
+    own = np.searchsorted(occupied, cell)
+
+    displacement = np.empty_like(positions)
+    for start in range(0, len(positions), _CHUNK):
+        chunk = positions[start:start + _CHUNK]
+        weights = _repel(chunk, centers, mass[occupied], k)
+        weights[np.arange(len(chunk)), own[start:start + _CHUNK]] = 0.0
+        pushed = chunk * weights.sum(axis=1)[:, None] - weights @ centers
+        displacement[start:start + _CHUNK] = pushed
+    others = mass[cell] - 1
+    center = (sums[cell] - positions) / np.maximum(others, 1)[:, None]
+    delta = positions - center
+    distance2 = np.maximum((delta ** 2).sum(axis=1), 1e-6 * k * k)
+    displacement += delta * (others * k * k / distance2)[:, None]
+    return displacement
+
+
+def force_layout(count, sources, targets, iterations=DEFAULT_ITERATIONS, seed=0):
+    """Return ``(count, 2)`` positions in the unit square (Fruchterman-Reingold).
+
+    ``sources[k]`` and ``targets[k]`` are the nodes of the ``k``-th edge.
+    The repulsion between all pairs of nodes is exact up to
+    :data:`EXACT_REPULSION_LIMIT` nodes, approximated with the centers of
+    mass of a grid above.
+    """
+    rng = np.random.default_rng(seed)
+    positions = rng.random((count, 2))
+    if count < 2:
+        return positions
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    k = 1.0 / math.sqrt(count)
+    cells = max(2, min(32, int(math.sqrt(count) / 2)))
+    temperature = 0.1
+    for iteration in range(iterations):
+        if count <= EXACT_REPULSION_LIMIT:
+            displacement = _exact_repulsion(positions, k)
+        else:
+            displacement = _grid_repulsion(positions, k, cells)
+        delta = positions[sources] - positions[targets]
+        distance = np.sqrt((delta ** 2).sum(axis=1))
+        force = delta * (distance / k)[:, None]
+        for axis in range(2):
+            displacement[:, axis] -= np.bincount(sources, weights=force[:, axis], minlength=count)
+            displacement[:, axis] += np.bincount(targets, weights=force[:, axis], minlength=count)
+        length = np.maximum(np.sqrt((displacement ** 2).sum(axis=1)), 1e-9)
+        step = np.minimum(length, temperature * (1 - iteration / iterations))
+        positions += displacement * (step / length)[:, None]
+    low = positions.min(axis=0)
+    return (positions - low) / np.maximum(positions.max(axis=0) - low, 1e-9)
+
+
+class NetworkView:
+    """Level-of-detail display of an :class:`~etbii.edges.EdgeList`.
+
+    :param edges: the network, read as undirected
+    :param min_degree: nodes of lower degree are hidden behind an aggregate
+        node, ``1`` displays every node
+    :param batch_size: nodes or edges sent to the widget at once
+    :param iterations: iterations of :func:`force_layout`
+    """
+
+    def __init__(
+        self,
+        edges,
+        min_degree=DEFAULT_MIN_DEGREE,
+        batch_size=DEFAULT_BATCH_SIZE,
+        iterations=DEFAULT_ITERATIONS,
+        seed=0,
+    ):
+        edges = edges.unique(directed=False)
+        loops = edges.sources == edges.targets
+        self.edges = edges
+        self.sources = edges.sources[~loops].astype(np.int64)
+        self.targets = edges.targets[~loops].astype(np.int64)
+        self.batch_size = batch_size
+        count = len(edges.nodes)
+        self.degree = np.bincount(self.sources, minlength=count) + np.bincount(
+            self.targets, minlength=count
+        )
+
+        # a hidden node belongs to its most connected displayed neighbor
+        visible = self.degree >= min_degree
+        self.owner = np.full(count, -1, dtype=np.int64)
+        hidden = np.concatenate([self.sources, self.targets])
+        neighbor = np.concatenate([self.targets, self.sources])
+        candidates = np.flatnonzero(~visible[hidden] & visible[neighbor])
+        order = candidates[np.argsort(self.degree[neighbor[candidates]], kind="stable")]
+        self.owner[hidden[order]] = neighbor[order]  # the last, most connected, wins
+        # nodes without a displayed neighbor, such as isolated pairs, stay displayed
+        visible |= self.owner < 0
+        self.visible = visible
+
+        self.positions = np.zeros((count, 2))
+        shown = np.flatnonzero(visible)
+        index = np.full(count, -1, dtype=np.int64)
+        index[shown] = np.arange(len(shown))
+        inside = visible[self.sources] & visible[self.targets]
+        layout = force_layout(
+            len(shown), index[self.sources[inside]], index[self.targets[inside]], iterations, seed
+        )
+        self.scale = 80.0 * math.sqrt(max(1, len(shown)))
+        self.positions[shown] = layout * self.scale
+        self.shown = set(shown.tolist())
+        self.index = {str(node): i for i, node in enumerate(edges.nodes)}
+        self._aggregates = set()
+        self._widget = None
+
+    def __repr__(self):
+        return "NetworkView(%d of %d nodes displayed)" % (len(self.shown), len(self.edges.nodes))
+
+    def hidden(self, node):
+        """Return the indexes of the hidden nodes attached to the node ``node``."""
+        return [
+            other for other in np.flatnonzero(self.owner == node).tolist()
+            if other not in self.shown
+        ]
+
+    def _identifier(self, node):
+        return str(self.edges.nodes[node])
+
+    def _node(self, node):
+        data = {"id": self._identifier(node), "name": self._identifier(node)}
+        for name, values in self.edges.node_data.items():
+            if values[node] is not None:
+                data[name] = values[node]
+        x, y = self.positions[node].tolist()
+        return {"data": data, "position": {"x": x, "y": y}}
+
+    def _aggregate(self, node, count):
+        x, y = self.positions[node].tolist()
+        return {
+            "data": {"id": "+" + self._identifier(node), "name": "+%d" % count, "of": node},
+            "position": {"x": x + 30.0, "y": y + 30.0},
+            "classes": "aggregate",
+        }
+
+    def _edges_between(self, nodes, others):
+        # edges with one end in ``nodes`` and the other in ``others``
+        nodes = np.fromiter(nodes, dtype=np.int64)
+        others = np.fromiter(others, dtype=np.int64)
+        forward = np.isin(self.sources, nodes) & np.isin(self.targets, others)
+        backward = np.isin(self.targets, nodes) & np.isin(self.sources, others)
+        selected = np.flatnonzero(forward | backward)
+        return [
+            {
+                "data": {
+                    "source": self._identifier(self.sources[k]),
+                    "target": self._identifier(self.targets[k]),
+                }
+            }
+            for k in selected.tolist()
+        ]
+
+    def elements(self):
+        """Return the displayed nodes and edges, as cytoscape JSON."""
+        nodes = [self._node(node) for node in sorted(self.shown)]
+        pending = self.owner >= 0
+        pending[list(self.shown)] = False
+        owners, counts = np.unique(self.owner[pending], return_counts=True)
+        owners = owners.tolist()
+        aggregates = [self._aggregate(node, count) for node, count in zip(owners, counts.tolist())]
+        self._aggregates = set(owners)
+        edges = self._edges_between(self.shown, self.shown)
+        edges += [
+            {"data": {"source": self._identifier(node), "target": aggregate["data"]["id"]}}
+            for node, aggregate in zip(owners, aggregates)
+        ]
+        return {"nodes": nodes + aggregates, "edges": edges}
+
+    def expand(self, node):
+        """Return the JSON of the hidden neighbors of ``node``, now displayed.
+
+        They are placed on a circle around ``node``; the returned edges join
+        them to the displayed nodes.
+        """
+        hidden = self.hidden(node)
+        self._aggregates.discard(node)
+        if not hidden:
+            return {"nodes": [], "edges": []}
+        radius = 40.0 + 6.0 * len(hidden)
+        angles = np.linspace(0, 2 * math.pi, len(hidden), endpoint=False)
+        center = self.positions[node]
+        self.positions[hidden] = center + radius * np.stack([np.cos(angles), np.sin(angles)], 1)
+        self.shown.update(hidden)
+        return {
+            "nodes": [self._node(other) for other in hidden],
+            "edges": self._edges_between(hidden, self.shown),
+        }
+
+    def _send(self, elements):
+        from ipycytoscape import Edge, Node
+
+        graph = self._widget.graph
+        nodes, edges = elements["nodes"], elements["edges"]
+        for start in range(0, len(nodes), self.batch_size):
+            graph.add_nodes([Node(**node) for node in nodes[start:start + self.batch_size]])
+        for start in range(0, len(edges), self.batch_size):
+            graph.add_edges([Edge(**edge) for edge in edges[start:start + self.batch_size]])
+
+    def _on_click(self, event):
+        data = event.get("data", {})
+        node = data["of"] if "of" in data else self.index.get(data.get("id"))
+        if node is None or node not in self._aggregates:
+            return
+        self._widget.graph.remove_node_by_id("+" + self._identifier(node))
+        self._send(self.expand(node))
+
+    def widget(self):
+        """Return the ``CytoscapeWidget`` of the view, created on the first call."""
+        if self._widget is not None:
+            return self._widget
+        check_environment("ipycytoscape")
+        from ipycytoscape import CytoscapeWidget
+
+        self._widget = CytoscapeWidget()
+        self._widget.set_style(STYLE)
+        self._widget.set_layout(name="preset", fit=True)
+        self._send(self.elements())
+        self._widget.on("node", "click", self._on_click)
+        return self._widget
@@ -0,0 +1,181 @@
+"""Fetch complete SELECT results page by page.
+
+Public endpoints cap the number of rows of a response (10,000 for a default
+Virtuoso) and slow down on large results, which is why notebook 2 asks for a
+``LIMIT 10`` on the PathwayCommons regulations. :func:`paginate` rewrites a
+SELECT query into ordered ``LIMIT``/``OFFSET`` pages, fetches the next pages
+in background threads while the current one is consumed and yields the rows
+as a single stream::
+
+    for row in paginate("http://134.214.213.234/sparql", query, page_size=5000):
+        ...
+
+A ``LIMIT``/``OFFSET`` of the original query still bounds the whole stream.
+The pages need a total order to be consistent, so when the query has no
+``ORDER BY`` one is added on its projected variables.
+
+A page shorter than requested either ends the results or was cut by the
+server. The next row is probed to tell both cases apart; on a silent
+truncation a :class:`TruncatedResultWarning` is emitted and the page size is
+lowered to the server cap. Partial results flagged by Virtuoso (``X-SQL-State:
+S1TAT``) are reported the same way.
+"""
+
+import re
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from SPARQLWrapper import JSON
+
+from etbii.cache import CachedSPARQLWrapper
+from etbii.query import last_brace, normalize_query, split_prologue, tokenize, variables
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_PREFETCH = 2
+
+_LIMIT = re.compile(r"\bLIMIT\s+(\d+)", re.IGNORECASE)
+_OFFSET = re.compile(r"\bOFFSET\s+(\d+)", re.IGNORECASE)
+_ORDER_BY = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+
+
+class TruncatedResultWarning(UserWarning):
+    """An endpoint returned fewer rows than it holds without reporting an error."""
+
+
+def projected_variables(select):
+    """Return the variables projected by a ``SELECT ... WHERE {`` clause.
+
+    ``SELECT *`` projects every variable of the query.
+    """
+    names, depth, after_as = [], 0, False
+    for kind, text, _ in tokenize(select):
+        if kind != "other":
+            continue
+        if text == "*" and depth == 0:
+            return None
+        if text.upper() == "AS":
+            after_as = True
+            continue
+        for char in text:
+            depth += {"(": 1, ")": -1}.get(char, 0)
+        if depth == 0 or after_as:
+            names.extend(name for name in variables(text) if name not in names)
+        after_as = False
+    return names
+
+
+class PagedQuery:
+    """A SELECT query split into ordered ``LIMIT``/``OFFSET`` pages.
+
+    :param order_by: variables defining the order of the pages, used when
+        the query has no ``ORDER BY`` (default: the projected variables)
+    """
+
+    def __init__(self, query, order_by=None):
+        self.prologue, body = split_prologue(query)
+        brace = last_brace(body)
+        if brace < 0:
+            raise ValueError("expected a SELECT query with a WHERE clause")
+        self.body = body[: brace + 1]
+        tail = normalize_query(body[brace + 1:])
+
+        limit = _LIMIT.search(tail)
+        offset = _OFFSET.search(tail)
+        self.limit = int(limit.group(1)) if limit else None
+        self.offset = int(offset.group(1)) if offset else 0
+        tail = _OFFSET.sub("", _LIMIT.sub("", tail)).strip()
+        if not _ORDER_BY.search(tail):
+            if order_by is None:
+                select = self.body[: self.body.index("{")]
+                order_by = projected_variables(select)
+                if order_by is None:
+                    order_by = variables(self.body)
+            if order_by:
+                order = " ".join("?" + name.lstrip("?$") for name in order_by)
+                tail = f"{tail} ORDER BY {order}".strip()
+        self.modifiers = tail
+
+    def size_at(self, start, page_size):
+        """Number of rows to request at ``start``, 0 past the query ``LIMIT``."""
+        if self.limit is None:
+            return page_size
+        return max(0, min(page_size, self.offset + self.limit - start))
+
+    def page(self, start, size):
+        """Return the query text of the page of ``size`` rows at ``start``."""
+        return (
+            f"{self.prologue}{self.body} {self.modifiers} LIMIT {size} OFFSET {start}\n"
+        )
+
+
+def fetch_bindings(endpoint, query, wrapper=CachedSPARQLWrapper):
+    """Return ``(bindings, partial)`` for a SELECT ``query``.
+
+    ``partial`` tells whether the endpoint flagged the result as incomplete.
+    """
+    sparql = wrapper(endpoint)
+    sparql.setQuery(query)
+    sparql.setReturnFormat(JSON)
+    result = sparql.query()
+    partial = result.info().get("x-sql-state", "") == "S1TAT"
+    return result.convert()["results"]["bindings"], partial
+
+
+def paginate(
+    endpoint,
+    query,
+    page_size=DEFAULT_PAGE_SIZE,
+    prefetch=DEFAULT_PREFETCH,
+    order_by=None,
+    wrapper=CachedSPARQLWrapper,
+):
+    """Yield every row of the SELECT ``query``, fetching it page by page.
+
+    Up to ``prefetch`` pages are requested ahead of the one being consumed.
+    """
+    paged = PagedQuery(query, order_by)
+
+    def fetch(start, size):
+        return fetch_bindings(endpoint, paged.page(start, size), wrapper)
+
+    with ThreadPoolExecutor(max_workers=prefetch + 1) as pool:
+        pending = deque()
+        next_start = paged.offset
+
+        def fill():
+            nonlocal next_start
+            while len(pending) <= prefetch:
+                size = paged.size_at(next_start, page_size)
+                if size == 0:
+                    return
+                pending.append((next_start, size, pool.submit(fetch, next_start, size)))
+                next_start += size
+
+        fill()
+        while pending:
+            start, size, future = pending.popleft()
+            rows, partial = future.result()
+            if partial:
+                warnings.warn(
+                    f"{endpoint} flagged the page at offset {start} as partial",
+                    TruncatedResultWarning,
+                )
+            yield from rows
+            if len(rows) == size:
+                fill()
+                continue
+            end = start + len(rows)
+            if not rows or paged.size_at(end, 1) == 0 or not fetch(end, 1)[0]:
+                return
+            warnings.warn(
+                f"{endpoint} returned {len(rows)} of {size} rows at offset {start}, "
+                f"continuing with pages of {len(rows)} rows",
+                TruncatedResultWarning,
+            )
+            page_size = len(rows)
+            for _, _, stale in pending:
+                stale.cancel()
+            pending.clear()
+            next_start = end
+            fill()
@@ -0,0 +1,347 @@
+"""Cost-based join ordering for local ``Graph.query`` calls.
+
+rdflib evaluates a basic graph pattern as nested loops, in an order fixed
+before the evaluation by counting the constants of each triple pattern. The
+teaching queries are written in reading order -- anatomical entity, organism,
+then gene -- so the Bgee queries of notebook 3 scan every anatomical entity
+before reaching ``FILTER (?geneName = 'TEKT4')``, the only selective part.
+
+Once :func:`enable_planner` is called, the basic graph patterns of local
+queries are ordered greedily: each step picks, among the patterns joined to
+the variables bound so far, the one with the fewest estimated rows. The
+estimates come from the graph itself -- exact range sizes and distinct counts
+for a :class:`~etbii.store.CompactStore`, a bounded sample of
+``graph.triples`` for other stores. Equality filters between a variable and
+an IRI or a string (``FILTER (?geneName = 'TEKT4')``) are pushed into the
+patterns as bound values, the filter itself being still evaluated. So are
+the fixed-string regexes of :mod:`etbii.filters`
+(``FILTER (regex(?publi, "pubmed"))``) when the term dictionary of a
+``CompactStore``, or the label index of :mod:`etbii.labels`, finds fewer
+matching terms than a scan of the pattern would return rows; like on the
+endpoints of the book, they match IRIs through their string.
+
+:func:`explain` runs a query and returns its plan with the estimated and the
+actual number of rows after each pattern::
+
+    print(explain(KG, q2))
+"""
+
+import contextvars
+from itertools import islice, product
+
+import numpy as np
+from rdflib import BNode, Literal, URIRef, Variable
+from rdflib.namespace import XSD
+from rdflib.plugins.sparql import CUSTOM_EVALS
+from rdflib.plugins.sparql.evalutils import _ebv
+from rdflib.plugins.sparql.sparql import AlreadyBound
+
+from etbii.filters import matching_terms, string_filter
+from etbii.store import CompactStore
+
+SAMPLE_SIZE = 10000
+_EXTENSION = "etbii.plan"
+_explained = contextvars.ContextVar("etbii_plan_explained", default=None)
+
+
+class PatternStats:
+    """Number of matches of a triple pattern and distinct values per position."""
+
+    def __init__(self, count, distinct):
+        self.count = count
+        self.distinct = distinct
+
+    @classmethod
+    def of(cls, graph, pattern):
+        """Compute the statistics of ``pattern`` (``None`` for variables) in ``graph``."""
+        store = graph.store
+        if isinstance(store, CompactStore) and not any(
+            isinstance(term, (list, tuple)) or hasattr(term, "eval") for term in pattern
+        ):
+            rows = store.ids(pattern)
+            sample = rows[:: max(1, len(rows) // SAMPLE_SIZE)]
+            distinct = [
+                len(np.unique(sample[:, position])) * len(rows) / max(1, len(sample))
+                for position in range(3)
+            ]
+            return cls(len(rows), distinct)
+        triples = list(islice(graph.triples(pattern), SAMPLE_SIZE))
+        distinct = [len({triple[position] for triple in triples}) for position in range(3)]
+        return cls(len(triples), distinct)
+
+
+def _variable(term):
+    return isinstance(term, (Variable, BNode))
+
+
+class Planner:
+    """Order the triple patterns of a basic graph pattern."""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self._stats = {}
+
+    def stats(self, pattern):
+        key = tuple(pattern)
+        if key not in self._stats:
+            self._stats[key] = PatternStats.of(self.graph, key)
+        return self._stats[key]
+
+    def estimate(self, triple, ctx, bound):
+        """Estimated rows of ``triple`` for one binding of the ``bound`` variables."""
+        stats = self.stats([ctx[term] if _variable(term) else term for term in triple])
+        rows = float(stats.count)
+        for position, term in enumerate(triple):
+            if _variable(term) and ctx[term] is None and term in bound:
+                rows /= max(1.0, stats.distinct[position])
+        return rows
+
+    def order(self, triples, ctx):
+        """Return ``[(triple, estimate)]``, the patterns in evaluation order."""
+        remaining = list(triples)
+        bound = {variable for variable in ctx.bindings if ctx[variable] is not None}
+        plan = []
+        while remaining:
+
+            def cost(triple):
+                joined = not bound or any(
+                    _variable(term) and term in bound for term in triple
+                )
+                return (not joined, self.estimate(triple, ctx, bound))
+
+            best = min(remaining, key=cost)
+            remaining.remove(best)
+            plan.append((best, cost(best)[1]))
+            bound.update(term for term in best if _variable(term))
+        return plan
+
+
+def _eval_bgp(ctx, triples, counts, depth=0):
+    # rdflib's evalBGP, counting the solutions reached after each pattern
+    if depth == len(triples):
+        yield ctx.solution()
+        return
+    s, p, o = triples[depth]
+    _s, _p, _o = ctx[s], ctx[p], ctx[o]
+    for ss, sp, so in ctx.graph.triples((_s, _p, _o)):
+        c = ctx.push() if None in (_s, _p, _o) else ctx
+        if _s is None:
+            c[s] = ss
+        try:
+            if _p is None:
+                c[p] = sp
+        except AlreadyBound:
+            continue
+        try:
+            if _o is None:
+                c[o] = so
+        except AlreadyBound:
+            continue
+        counts[depth] += 1
+        yield from _eval_bgp(c, triples, counts, depth + 1)
+
+
+class PlanStep:
+    """A basic graph pattern of an explained query, with its row counts."""
+
+    def __init__(self, plan, pushed=None):
+        self.triples = [triple for triple, _ in plan]
+        self.estimates = []
+        rows = 1.0
+        for _, estimate in plan:
+            rows *= estimate
+            self.estimates.append(rows)
+        self.counts = [0] * len(plan)
+        self.pushed = pushed
+
+    def format(self, graph):
+        def n3(term):
+            return term.n3(graph.namespace_manager) if hasattr(term, "n3") else str(term)
+
+        lines = ["BGP" + (" with %s" % self.pushed if self.pushed else "")]
+        for triple, estimate, count in zip(self.triples, self.estimates, self.counts):
+            pattern = " ".join(n3(term) for term in triple)
+            lines.append("  %-70s est %10.0f  rows %8d" % (pattern, estimate, count))
+        return "\n".join(lines)
+
+
+def _evaluate_bgp(ctx, triples):
+    plan = Planner(ctx.graph).order(triples, ctx)
+    step = PlanStep(plan)
+    steps = _explained.get()
+    if steps is not None:
+        steps.append(step)
+    return _eval_bgp(ctx, step.triples, step.counts)
+
+
+def _conjuncts(expr):
+    if getattr(expr, "name", None) == "ConditionalAndExpression":
+        return [
+            conjunct
+            for operand in [expr.expr] + list(expr.other or [])
+            for conjunct in _conjuncts(operand)
+        ]
+    return [expr]
+
+
+def equality_candidates(expr):
+    """Return ``{variable: [terms]}`` for the pushable equalities of a filter.
+
+    Only the conjuncts comparing a variable with an IRI or a string are
+    pushed; a string also matches its ``xsd:string`` typed form.
+    """
+    candidates = {}
+    for conjunct in _conjuncts(expr):
+        if getattr(conjunct, "name", None) != "RelationalExpression" or conjunct.op != "=":
+            continue
+        left, right = conjunct.expr, conjunct.other
+        if isinstance(right, Variable):
+            left, right = right, left
+        if not isinstance(left, Variable) or left in candidates:
+            continue
+        if isinstance(right, URIRef):
+            candidates[left] = [right]
+        elif isinstance(right, Literal) and not right.language:
+            if right.datatype is None or right.datatype == XSD.string:
+                candidates[left] = [Literal(str(right)), Literal(str(right), datatype=XSD.string)]
+    return candidates
+
+
+def _plan_cost(plan):
+    # rows produced by all the steps of the plan
+    cost, rows = 0.0, 1.0
+    for _, estimate in plan:
+        rows *= estimate
+        cost += rows
+    return cost
+
+
+def _pushed_plan(planner, ctx, triples, candidates):
+    # plan of the first candidate values, and its cost for all of them
+    child = ctx.push()
+    combinations = 1
+    for variable, terms in candidates.items():
+        combinations *= len(terms)
+        if terms:
+            child[variable] = terms[0]
+    plan = planner.order(triples, child)
+    return plan, combinations * (1 + _plan_cost(plan))
+
+
+def _object_predicates(triples, variable):
+    # the predicates binding variable, None unless it is only the object of IRIs
+    predicates = set()
+    for subject, predicate, obj in triples:
+        if variable in (subject, predicate):
+            return None
+        if obj == variable:
+            if not isinstance(predicate, URIRef):
+                return None
+            predicates.add(predicate)
+    return predicates
+
+
+def _filter_plan(ctx, part):
+    """Return ``(candidates, plan, pushed, strings, rest)``, ``None`` if not planned.
+
+    ``strings`` are the fixed-string regex conjuncts of the filter, tested
+    on the solutions with :meth:`~etbii.filters.StringFilter.matches`, and
+    ``rest`` the other conjuncts, evaluated by rdflib.
+    """
+    strings, rest = [], []
+    for conjunct in _conjuncts(part.expr):
+        found = string_filter(conjunct)
+        if found is None:
+            rest.append(conjunct)
+        else:
+            strings.append(found)
+    triples = part.p.triples
+    free = {term for triple in triples for term in triple if _variable(term) and ctx[term] is None}
+    equal = {
+        variable: terms
+        for variable, terms in equality_candidates(part.expr).items()
+        if variable in free
+    }
+    if not equal and not strings:
+        return None
+    pushed = ["%s = %s" % (variable.n3(), terms[0].n3()) for variable, terms in equal.items()]
+
+    planner = Planner(ctx.graph)
+    plan, cost = _pushed_plan(planner, ctx, triples, equal)
+    candidates = equal
+    for found in strings:
+        if found.variable not in free or found.variable in candidates:
+            continue
+        terms = matching_terms(ctx.graph, found, _object_predicates(triples, found.variable))
+        if terms is None:
+            continue
+        # a regex matching many terms is cheaper as a scan of the pattern
+        extended = dict(candidates, **{found.variable: terms})
+        extended_plan, extended_cost = _pushed_plan(planner, ctx, triples, extended)
+        if extended_cost < cost:
+            candidates, plan, cost = extended, extended_plan, extended_cost
+            pushed.append("%s (%d terms)" % (found.sparql(), len(terms)))
+    return candidates, plan, ", ".join(pushed), strings, rest
+
+
+def _evaluate_filter(ctx, part, candidates, plan, pushed, strings, rest):
+    step = PlanStep(plan, pushed)
+    steps = _explained.get()
+    if steps is not None:
+        steps.append(step)
+    variables = list(candidates)
+    for values in product(*(candidates[variable] for variable in variables)):
+        child = ctx.push()
+        for variable, value in zip(variables, values):
+            child[variable] = value
+        for solution in _eval_bgp(child, step.triples, step.counts):
+            if not all(found.matches(solution.get(found.variable)) for found in strings):
+                continue
+            scoped = (
+                solution.forget(ctx, _except=part._vars)
+                if not part.no_isolated_scope
+                else solution
+            )
+            if all(_ebv(conjunct, scoped) for conjunct in rest):
+                yield solution
+
+
+def planned_eval(ctx, part):
+    """rdflib custom evaluation of basic graph patterns and their filters."""
+    if part.name == "BGP":
+        return _evaluate_bgp(ctx, part.triples)
+    if part.name == "Filter" and getattr(part.p, "name", None) == "BGP":
+        planned = _filter_plan(ctx, part)
+        if planned is not None:
+            return _evaluate_filter(ctx, part, *planned)
+    raise NotImplementedError
+
+
+def enable_planner():
+    """Plan the basic graph patterns of every local ``Graph.query``."""
+    CUSTOM_EVALS[_EXTENSION] = planned_eval
+
+
+def disable_planner():
+    CUSTOM_EVALS.pop(_EXTENSION, None)
+
+
+def explain(graph, query, **kwargs):
+    """Run ``query`` on ``graph`` with the planner and return its plan as text.
+
+    ``kwargs`` are passed to ``graph.query`` (``initNs``, ``initBindings``).
+    """
+    enabled = CUSTOM_EVALS.get(_EXTENSION) is planned_eval
+    steps = []
+    token = _explained.set(steps)
+    enable_planner()
+    try:
+        result = graph.query(query, **kwargs)
+        rows = len(result.graph) if result.type in ("CONSTRUCT", "DESCRIBE") else len(result)
+    finally:
+        _explained.reset(token)
+        if not enabled:
+            disable_planner()
+    plan = [step.format(graph) for step in steps]
+    plan.append("%d results" % rows)
+    return "\n".join(plan)
@@ -0,0 +1,254 @@
+"""Persistent, compressed HTTP connections to the SPARQL endpoints.
+
+``SPARQLWrapper`` sends every query through ``urllib.request.urlopen``,
+which opens a new connection -- DNS lookup, TCP and TLS handshakes -- and
+closes it after the response. The questions of notebooks 2 to 4 send many
+small queries in a row to the same few endpoints. :class:`ConnectionPool`
+keeps the connections of each host open between queries and asks for
+gzip-compressed responses, decompressed while they are read.
+
+:class:`PooledSPARQLWrapper` is ``SPARQLWrapper`` with its requests sent
+through the process-wide pool; :class:`~etbii.cache.CachedSPARQLWrapper`
+derives from it, so the notebooks use the pool without any change. Setting
+``ETBII_SPARQL_POOL_DISABLE`` to ``1`` goes back to ``urlopen``, which is
+also used for proxied hosts and HTTP digest authentication.
+"""
+
+import gzip
+import http.client
+import io
+import os
+import ssl
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from SPARQLWrapper import DIGEST, SPARQLWrapper
+from SPARQLWrapper.SPARQLExceptions import (
+    EndPointInternalError,
+    EndPointNotFound,
+    QueryBadFormed,
+    Unauthorized,
+    URITooLong,
+)
+
+DEFAULT_MAX_IDLE = 4
+MAX_REDIRECTS = 5
+# unread bytes still skipped to keep the connection of a closed response
+DRAIN_BYTES = 64 * 1024
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+_ERRORS = {
+    400: QueryBadFormed,
+    401: Unauthorized,
+    404: EndPointNotFound,
+    414: URITooLong,
+    500: EndPointInternalError,
+}
+
+
+class PooledResponse(io.RawIOBase):
+    """Body of a response read from a pooled connection.
+
+    It mimics the responses of ``urlopen`` (``info()``, ``geturl()``,
+    ``status``). The connection returns to its pool once the body has been
+    read to the end, or when it is closed with at most :data:`DRAIN_BYTES`
+    left to read; closing it earlier closes the connection.
+    """
+
+    def __init__(self, response, url, release):
+        super().__init__()
+        self._response = response
+        self._release = release
+        self.url = url
+        self.status = self.code = response.status
+        self.reason = self.msg = response.reason
+        self.headers = response.msg
+        self._body = response
+        if (self.headers.get("Content-Encoding") or "").lower() == "gzip":
+            self._body = gzip.GzipFile(fileobj=response)
+            # the headers describe the decompressed body
+            del self.headers["Content-Encoding"]
+            del self.headers["Content-Length"]
+
+    def info(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def geturl(self):
+        return self.url
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._release is None:
+            return 0
+        count = self._body.readinto(buffer)
+        if not count and len(buffer):
+            self._finish(reuse=True)
+        return count
+
+    def _finish(self, reuse):
+        release, self._release = self._release, None
+        if release is not None:
+            release(reuse and not self._response.will_close)
+
+    def close(self):
+        remaining = self._response.length
+        reuse = False
+        if self._release is not None and remaining is not None and remaining <= DRAIN_BYTES:
+            try:
+                self._response.read()
+                reuse = True
+            except (OSError, http.client.HTTPException):
+                pass
+        self._finish(reuse)
+        super().close()
+
+
+class ConnectionPool:
+    """Idle HTTP(S) connections, by scheme, host and port.
+
+    :param max_idle: idle connections kept per host, the other ones are
+        closed when released
+    """
+
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE):
+        self.max_idle = max_idle
+        self.connections = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = None
+
+    def _acquire(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                connection = idle.pop()
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+            self.connections += 1
+        scheme, host, port = key
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            connection = http.client.HTTPSConnection(
+                host, port, timeout=timeout, context=self._ssl_context
+            )
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        return connection, False
+
+    def _release(self, key, connection, reuse):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if reuse and len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _send(self, key, method, target, body, headers, timeout):
+        for attempt in range(2):
+            connection, reused = self._acquire(key, timeout)
+            try:
+                connection.request(method, target, body=body, headers=headers)
+                return connection, connection.getresponse()
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                # the server may have closed an idle connection: retry once
+                if reused and attempt == 0 and not isinstance(error, TimeoutError):
+                    continue
+                raise urllib.error.URLError(error) from error
+
+    def urlopen(self, request, timeout=None):
+        """Send the ``urllib.request.Request`` ``request``, like ``urlopen``.
+
+        Redirections are followed and error statuses raise
+        ``urllib.error.HTTPError``.
+        """
+        url, method, body = request.full_url, request.get_method(), request.data
+        headers = dict(request.header_items())
+        headers["Accept-Encoding"] = "gzip"
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https") or _proxied(parts):
+                return urllib.request.urlopen(request, timeout=timeout)
+            key = (parts.scheme, parts.hostname, parts.port)
+            target = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            connection, response = self._send(key, method, target, body, headers, timeout)
+
+            def release(reuse, key=key, connection=connection):
+                self._release(key, connection, reuse)
+
+            result = PooledResponse(response, url, release)
+            location = response.getheader("Location")
+            if response.status in _REDIRECTS and location:
+                result.read()
+                url = urllib.parse.urljoin(url, location)
+                if response.status in (301, 302, 303) and method != "HEAD":
+                    method, body = "GET", None
+                    headers.pop("Content-type", None)
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason, result.info(), result
+                )
+            return result
+        raise urllib.error.HTTPError(
+            url, response.status, "too many redirections", result.info(), result
+        )
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+def _proxied(parts):
+    proxies = urllib.request.getproxies()
+    return parts.scheme in proxies and not urllib.request.proxy_bypass(parts.hostname)
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool():
+    """Return the process-wide connection pool."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+
+class PooledSPARQLWrapper(SPARQLWrapper):
+    """``SPARQLWrapper`` sending its requests through a :class:`ConnectionPool`."""
+
+    def __init__(self, endpoint, *args, pool=None, **kwargs):
+        super().__init__(endpoint, *args, **kwargs)
+        self.pool = pool
+
+    def _query(self):
+        if os.environ.get("ETBII_SPARQL_POOL_DISABLE") == "1" or (
+            self.user and self.http_auth == DIGEST
+        ):
+            return super()._query()
+        request = self._createRequest()
+        pool = self.pool or default_pool()
+        try:
+            response = pool.urlopen(request, timeout=self.timeout or None)
+        except urllib.error.HTTPError as error:
+            if error.code in _ERRORS:
+                raise _ERRORS[error.code](error.read()) from None
+            raise
+        return response, self.returnFormat
@@ -0,0 +1,93 @@
+"""Lexical helpers to inspect and rewrite SPARQL query text.
+
+Endpoint-specific syntax (Virtuoso ``define`` pragmas, undeclared ``rdfs:``
+prefixes, ...) does not always go through rdflib's parser, so the rewrites of
+this package work on tokens: IRIs, string literals and comments are kept
+intact and everything else is split on whitespace.
+"""
+
+import re
+
+_TOKEN = re.compile(
+    r"""
+      (?P<iri><[^<>"{}|^`\\\s]*>)
+    | (?P<string>\"\"\"(?:[^"\\]|\\.|"(?!""))*\"\"\"
+                |'''(?:[^'\\]|\\.|'(?!''))*'''
+                |"(?:[^"\\\n]|\\.)*"
+                |'(?:[^'\\\n]|\\.)*')
+    | (?P<comment>\#[^\n]*)
+    | (?P<space>\s+)
+    | (?P<other>[^<"'\#\s]+|.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+_VARIABLE = re.compile(r"[?$]([A-Za-z0-9_·À-￿]+)")
+
+
+def tokenize(query):
+    """Yield ``(kind, text, start)`` for the tokens of ``query``.
+
+    ``kind`` is one of ``iri``, ``string``, ``comment``, ``space`` and
+    ``other``.
+    """
+    if isinstance(query, bytes):
+        query = query.decode("utf-8")
+    for match in _TOKEN.finditer(query):
+        yield match.lastgroup, match.group(), match.start()
+
+
+def normalize_query(query):
+    """Return ``query`` with comments removed and whitespace collapsed.
+
+    IRIs and string literals are kept verbatim, so two queries that only
+    differ by indentation or comments share the same cache entry.
+    """
+    parts = []
+    for kind, text, _ in tokenize(query):
+        if kind in ("comment", "space"):
+            if parts and parts[-1] != " ":
+                parts.append(" ")
+        else:
+            parts.append(text)
+    return "".join(parts).strip()
+
+
+def split_prologue(query):
+    """Split ``query`` into its ``PREFIX``/``BASE`` prologue and the rest."""
+    expected = 0
+    for kind, text, start in tokenize(query):
+        if kind in ("space", "comment"):
+            continue
+        if expected:
+            expected -= 1
+            continue
+        keyword = text.upper() if kind == "other" else ""
+        if keyword == "PREFIX":
+            expected = 2
+        elif keyword == "BASE":
+            expected = 1
+        else:
+            return query[:start], query[start:]
+    return query, ""
+
+
+def variables(text):
+    """Return the distinct variable names used in ``text``, in order."""
+    names = []
+    for kind, token, _ in tokenize(text):
+        if kind != "other":
+            continue
+        for name in _VARIABLE.findall(token):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def last_brace(query):
+    """Return the offset of the last ``}`` outside IRIs, strings and comments."""
+    position = -1
+    for kind, text, start in tokenize(query):
+        if kind == "other" and "}" in text:
+            position = start + text.rindex("}")
+    return position
@@ -0,0 +1,165 @@
+"""Concurrent execution of independent SPARQL queries.
+
+In ``3-Multi-source_queries`` the UniProt interaction query and the Bgee
+queries do not depend on each other, yet each blocking ``query()`` call waits
+for the previous one. :class:`QueryRunner` issues them concurrently from an
+asyncio event loop and yields the results as they arrive, so the total time
+approaches the one of the slowest query::
+
+    runner = QueryRunner(timeout=120)
+    async for name, result in runner.stream([
+        SPARQLRequest("interactions", "http://sparql.uniprot.org/sparql/", uniprot_query, JSON),
+        SPARQLRequest("tissues", "http://bgee.org/sparql", bgee_query, JSON),
+    ]):
+        ...
+
+A request may declare a ``then`` callback which receives its converted result
+and returns the requests of the next stage; they are scheduled as soon as the
+result is available, without waiting for the other requests.
+
+The HTTP calls themselves go through :class:`~etbii.cache.CachedSPARQLWrapper`
+in worker threads, so they share the on-disk response cache of the notebooks.
+"""
+
+import asyncio
+import threading
+import urllib.error
+from collections import namedtuple
+
+from SPARQLWrapper.SPARQLExceptions import EndPointInternalError
+
+from etbii.cache import CachedSPARQLWrapper
+
+RETRYABLE_ERRORS = (
+    urllib.error.URLError,
+    TimeoutError,
+    ConnectionError,
+    EndPointInternalError,
+)
+
+_SPARQLRequest = namedtuple(
+    "SPARQLRequest", ["name", "endpoint", "query", "return_format", "then"]
+)
+
+
+class SPARQLRequest(_SPARQLRequest):
+    """A named query for an endpoint, with an optional follow-up stage."""
+
+    def __new__(cls, name, endpoint, query, return_format=None, then=None):
+        return super().__new__(cls, name, endpoint, query, return_format, then)
+
+
+class QueryRunner:
+    """Run SPARQL requests concurrently with per-endpoint limits.
+
+    :param limits: maximum number of concurrent requests per endpoint URL
+    :param default_limit: limit of the endpoints missing from ``limits``
+    :param timeout: socket timeout of a single attempt, in seconds
+    :param retries: number of additional attempts on network or server errors
+    :param backoff: delay before the first retry, doubled on each attempt
+    :param wrapper: ``SPARQLWrapper`` class used to send the queries
+    """
+
+    def __init__(
+        self,
+        limits=None,
+        default_limit=4,
+        timeout=60,
+        retries=2,
+        backoff=1.0,
+        wrapper=CachedSPARQLWrapper,
+    ):
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.wrapper = wrapper
+
+    def execute(self, request):
+        """Send ``request`` and return its converted result (blocking)."""
+        sparql = self.wrapper(request.endpoint)
+        sparql.setQuery(request.query)
+        if request.return_format is not None:
+            sparql.setReturnFormat(request.return_format)
+        if self.timeout:
+            sparql.setTimeout(int(self.timeout))
+        return sparql.query().convert()
+
+    async def _run(self, request, semaphores):
+        if request.endpoint not in semaphores:
+            limit = self.limits.get(request.endpoint, self.default_limit)
+            semaphores[request.endpoint] = asyncio.Semaphore(limit)
+        async with semaphores[request.endpoint]:
+            for attempt in range(self.retries + 1):
+                # the socket timeout of execute() bounds the attempt: a thread
+                # cannot be stopped, so an asyncio timeout would let the
+                # request run on while a retry holds its slot of the endpoint
+                try:
+                    return await asyncio.to_thread(self.execute, request)
+                except RETRYABLE_ERRORS:
+                    if attempt == self.retries:
+                        raise
+                await asyncio.sleep(self.backoff * 2**attempt)
+
+    async def stream(self, requests):
+        """Yield ``(name, result)`` pairs in completion order.
+
+        An error of one request is raised to the consumer and cancels the
+        requests still running.
+        """
+        semaphores = {}
+        pending = {}
+
+        def schedule(request):
+            task = asyncio.ensure_future(self._run(request, semaphores))
+            pending[task] = request
+
+        for request in requests:
+            schedule(request)
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    request = pending.pop(task)
+                    result = task.result()
+                    if request.then is not None:
+                        for follow_up in request.then(result) or ():
+                            schedule(follow_up)
+                    yield request.name, result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def gather(self, requests):
+        """Return a ``{name: result}`` dict once every request completed."""
+        return {name: result async for name, result in self.stream(requests)}
+
+    def run(self, requests):
+        """Blocking version of :meth:`gather`.
+
+        Jupyter kernels already run an event loop, in which case the requests
+        are run from a separate thread. In a notebook, ``await
+        runner.gather(...)`` is the more direct spelling.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.gather(requests))
+
+        outcome = {}
+
+        def target():
+            try:
+                outcome["result"] = asyncio.run(self.gather(requests))
+            except BaseException as error:
+                outcome["error"] = error
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["result"]
@@ -0,0 +1,280 @@
+"""Binary, memory-mapped snapshots of rdflib graphs.
+
+Saving a constructed graph such as the Bgee subgraph ``KG`` of notebook 3 as
+Turtle is slow to write and slower to parse again. A snapshot stores what a
+:class:`~etbii.store.CompactStore` holds in memory -- the term dictionary and
+the SPO/POS/OSP integer index arrays -- so that reopening it is a ``mmap``
+and no parsing::
+
+    from etbii.snapshot import open_snapshot, save_snapshot
+
+    save_snapshot(KG, "_build/bgee_subgraph.kg")
+    KG = open_snapshot("_build/bgee_subgraph.kg")
+
+The reopened graph is an ordinary ``rdflib.Graph``. Its indexes are views on
+the mapped file, shared between the processes that open it, and its terms
+are only decoded when a lookup returns them; terms are found by a binary
+search on their sorted encodings. Adding or removing triples works on an
+in-memory copy, the file is never modified.
+
+Layout of a snapshot, little-endian, arrays aligned on 8 bytes::
+
+    magic (8 bytes) | header length (uint64) | JSON header
+    term offsets    uint64[n_terms + 1]
+    term order      int32[n_terms]     term ids sorted by encoding
+    term data       bytes              encoded terms
+    spo, pos, osp   int32[n_triples, 3]
+"""
+
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+from rdflib import BNode, Graph, Literal, URIRef
+
+from etbii.store import DTYPE, ORDERS, CompactStore
+
+MAGIC = b"ETBIIKG1"
+_LENGTH = struct.Struct("<Q")
+
+
+def encode_term(term):
+    """Return the bytes encoding ``term`` in a snapshot."""
+    if isinstance(term, URIRef):
+        return b"U" + term.encode("utf-8")
+    if isinstance(term, BNode):
+        return b"B" + term.encode("utf-8")
+    if isinstance(term, Literal):
+        return b"L" + b"\0".join(
+            (
+                str(term).encode("utf-8"),
+                (term.language or "").encode("utf-8"),
+                (term.datatype or "").encode("utf-8"),
+            )
+        )
+    raise ValueError("cannot store %r in a snapshot" % (term,))
+
+
+def decode_term(data):
+    """Return the term encoded by ``data``."""
+    kind, value = data[:1], bytes(data[1:])
+    if kind == b"U":
+        return URIRef(value.decode("utf-8"))
+    if kind == b"B":
+        return BNode(value.decode("utf-8"))
+    if kind == b"L":
+        lexical, language, datatype = value.rsplit(b"\0", 2)
+        return Literal(
+            lexical.decode("utf-8"),
+            lang=language.decode("utf-8") or None,
+            datatype=URIRef(datatype.decode("utf-8")) if datatype else None,
+        )
+    raise ValueError("invalid term encoding %r" % (kind,))
+
+
+def _align(position):
+    return -position % 8
+
+
+class MappedTermDictionary:
+    """Term dictionary read from a snapshot, decoding terms on demand.
+
+    Terms added after the snapshot was opened are kept in memory, with ids
+    following the ones of the file.
+    """
+
+    def __init__(self, buffer, offsets, order, data_start):
+        self._buffer = buffer
+        self._offsets = offsets
+        self._order = order
+        self._data_start = data_start
+        self._decoded = {}
+        self._added = {}
+        self._added_terms = []
+
+    def __len__(self):
+        return len(self._order) + len(self._added_terms)
+
+    def _encoding(self, term_id):
+        start = self._data_start + int(self._offsets[term_id])
+        end = self._data_start + int(self._offsets[term_id + 1])
+        return self._buffer[start:end]
+
+    def _search(self, key):
+        # position of the first encoding >= key in the sorted order
+        low, high = 0, len(self._order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._encoding(int(self._order[middle])) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, term):
+        """Return the id of ``term``, ``None`` when it is not in the dictionary."""
+        term_id = self._added.get(term)
+        if term_id is not None:
+            return term_id
+        try:
+            key = encode_term(term)
+        except ValueError:
+            return None
+        low = self._search(key)
+        if low < len(self._order):
+            term_id = int(self._order[low])
+            if self._encoding(term_id) == key:
+                return term_id
+        if isinstance(term, Literal):
+            # an equal literal written differently, such as "x"@EN for "x"@en,
+            # is stored with the same lexical form
+            prefix = b"L" + str(term).encode("utf-8") + b"\0"
+            position = self._search(prefix)
+            while position < len(self._order):
+                term_id = int(self._order[position])
+                encoding = self._encoding(term_id)
+                if not encoding.startswith(prefix):
+                    break
+                if decode_term(encoding) == term:
+                    return term_id
+                position += 1
+        return None
+
+    def encode(self, term):
+        """Return the id of ``term``, adding it in memory if needed."""
+        term_id = self.lookup(term)
+        if term_id is None:
+            term_id = self._added[term] = len(self)
+            self._added_terms.append(term)
+        return term_id
+
+    def _added_matching(self, test):
+        return [
+            len(self._order) + position
+            for position, term in enumerate(self._added_terms)
+            if isinstance(term, (URIRef, Literal)) and test(str(term))
+        ]
+
+    def prefixed(self, prefix):
+        """Return the ids of the IRIs and literals whose string starts with ``prefix``.
+
+        Literals are returned when their encoding starts with the prefix,
+        which includes the literals whose lexical form does.
+        """
+        term_ids = []
+        for kind in (b"U", b"L"):
+            key = kind + prefix.encode("utf-8")
+            position = self._search(key)
+            while position < len(self._order):
+                term_id = int(self._order[position])
+                if not self._encoding(term_id).startswith(key):
+                    break
+                term_ids.append(term_id)
+                position += 1
+        return term_ids + self._added_matching(lambda string: string.startswith(prefix))
+
+    def containing(self, text):
+        """Return the ids of the terms whose encoding contains ``text``.
+
+        The mapped term data is searched as a whole, so a match can be in a
+        datatype or span two terms: the caller checks the decoded terms.
+        """
+        needle = text.encode("utf-8")
+        end = self._data_start + int(self._offsets[-1])
+        term_ids = []
+        position = self._buffer.find(needle, self._data_start, end)
+        while position != -1:
+            term_id = int(np.searchsorted(self._offsets, position - self._data_start, "right")) - 1
+            term_ids.append(term_id)
+            # the next match of interest is in the next term
+            next_term = self._data_start + int(self._offsets[term_id + 1])
+            position = self._buffer.find(needle, max(next_term, position + 1), end)
+        return term_ids + self._added_matching(lambda string: text in string)
+
+    def decode(self, term_id):
+        if term_id >= len(self._order):
+            return self._added_terms[term_id - len(self._order)]
+        term = self._decoded.get(term_id)
+        if term is None:
+            term = self._decoded[term_id] = decode_term(self._encoding(term_id))
+        return term
+
+
+def write_snapshot(path, encoded, indexes, namespaces=()):
+    """Write a snapshot from term encodings and index arrays.
+
+    ``encoded[i]`` is the :func:`encode_term` encoding of the term of id
+    ``i`` and ``indexes`` the ``{"spo": ..., "pos": ..., "osp": ...}``
+    arrays of a :class:`CompactStore`.
+    """
+    offsets = np.zeros(len(encoded) + 1, dtype="<u8")
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype="<i4")
+
+    header = {
+        "n_terms": len(encoded),
+        "n_triples": len(indexes["spo"]),
+        "namespaces": {prefix: str(namespace) for prefix, namespace in namespaces},
+    }
+    header_bytes = json.dumps(header, sort_keys=True).encode("utf-8")
+    header_bytes += b" " * _align(len(MAGIC) + _LENGTH.size + len(header_bytes))
+
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    with open(tmp, "wb") as snapshot:
+        snapshot.write(MAGIC + _LENGTH.pack(len(header_bytes)) + header_bytes)
+        snapshot.write(offsets.tobytes())
+        snapshot.write(order.tobytes())
+        snapshot.write(b"\0" * _align(order.nbytes))
+        for data in encoded:
+            snapshot.write(data)
+        snapshot.write(b"\0" * _align(int(offsets[-1])))
+        for name in ORDERS:
+            snapshot.write(np.ascontiguousarray(indexes[name], dtype="<i4").tobytes())
+    os.replace(tmp, path)
+
+
+def save_snapshot(graph, path):
+    """Write ``graph`` (a ``Graph`` or a :class:`CompactStore`) to ``path``."""
+    store = graph if isinstance(graph, CompactStore) else graph.store
+    if not isinstance(store, CompactStore):
+        store = CompactStore()
+        compact = Graph(store=store)
+        for prefix, namespace in graph.namespaces():
+            compact.bind(prefix, namespace)
+        compact += graph
+    indexes = store.indexes()
+    encoded = [encode_term(store.terms.decode(term_id)) for term_id in range(len(store.terms))]
+    write_snapshot(path, encoded, indexes, store.namespaces())
+
+
+def open_snapshot(path):
+    """Return the graph stored at ``path``, backed by a read-only mapping."""
+    with open(path, "rb") as snapshot:
+        buffer = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[: len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a graph snapshot" % path)
+    (header_length,) = _LENGTH.unpack_from(buffer, len(MAGIC))
+    position = len(MAGIC) + _LENGTH.size
+    header = json.loads(buffer[position : position + header_length])
+    position += header_length
+    n_terms, n_triples = header["n_terms"], header["n_triples"]
+
+    offsets = np.frombuffer(buffer, dtype="<u8", count=n_terms + 1, offset=position)
+    position += offsets.nbytes
+    order = np.frombuffer(buffer, dtype="<i4", count=n_terms, offset=position)
+    position += order.nbytes + _align(order.nbytes)
+    data_start = position
+    position += int(offsets[-1]) + _align(int(offsets[-1]))
+    indexes = {}
+    for name in ORDERS:
+        index = np.frombuffer(buffer, dtype="<i4", count=n_triples * 3, offset=position)
+        indexes[name] = index.reshape(n_triples, 3).view(DTYPE)
+        position += index.nbytes
+
+    terms = MappedTermDictionary(buffer, offsets, order, data_start)
+    graph = Graph(store=CompactStore(terms=terms, indexes=indexes))
+    for prefix, namespace in header["namespaces"].items():
+        graph.bind(prefix, URIRef(namespace), override=True)
+    return graph
@@ -0,0 +1,314 @@
+"""Local stand-in SPARQL endpoint for offline, reproducible runs.
+
+The notebooks query UniProt, Bgee, DBpedia and the PathwayCommons mirror,
+whose availability and latency vary from one build to the next. This module
+serves recorded rdflib datasets over the SPARQL protocol from a local HTTP
+server, one dataset per remote endpoint:
+
+``standin/<slug>.nt`` (or ``.ttl``, ``.nt.gz``, ...)
+    triples standing in for the endpoint whose URL gives ``<slug>``, for
+    instance ``sparql.uniprot.org-sparql`` for
+    ``http://sparql.uniprot.org/sparql/``
+
+Setting ``ETBII_SPARQL_STANDIN`` to the URL of the server redirects every
+:class:`~etbii.cache.CachedSPARQLWrapper`, hence every notebook query, to
+``<server>/<slug>``. From the ``docs/`` directory::
+
+    python -m etbii.standin record http://bgee.org/sparql query.rq
+    python -m etbii.standin serve --port 8890
+    ETBII_SPARQL_STANDIN=http://127.0.0.1:8890 jupyter-book build .
+
+``record`` runs a query against the live endpoint and appends the triples it
+matches to the dataset of that endpoint (a SELECT is turned into the
+CONSTRUCT of its basic graph patterns first), so that the query gives the
+same answer locally.
+"""
+
+import argparse
+import gzip
+import http.server
+import os
+import re
+import sys
+import threading
+import urllib.parse
+from pathlib import Path
+
+from rdflib import Graph
+from rdflib.namespace import OWL, RDF, RDFS, XSD
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.util import guess_format
+from SPARQLWrapper import SPARQLWrapper
+
+from etbii.query import last_brace, split_prologue, tokenize
+
+DEFAULT_DATA_DIR = Path(__file__).resolve().parent.parent / "standin"
+DEFAULT_PORT = 8890
+
+# Prefixes predefined by Virtuoso that the notebook queries rely on.
+INIT_NS = {"rdf": RDF, "rdfs": RDFS, "owl": OWL, "xsd": XSD}
+
+_RESULT_FORMATS = (
+    ("json", "json", "application/sparql-results+json"),
+    ("tab-separated", "tsv", "text/tab-separated-values"),
+    ("csv", "csv", "text/csv"),
+    ("xml", "xml", "application/sparql-results+xml"),
+)
+_GRAPH_FORMATS = (
+    ("turtle", "turtle", "text/turtle"),
+    ("n-triples", "nt", "application/n-triples"),
+    ("n3", "n3", "text/n3"),
+    ("ld+json", "json-ld", "application/ld+json"),
+    ("xml", "xml", "application/rdf+xml"),
+)
+
+
+def slug(endpoint):
+    """Return the dataset name standing in for ``endpoint``."""
+    parts = urllib.parse.urlsplit(endpoint)
+    return re.sub(r"[^A-Za-z0-9.]+", "-", parts.netloc + parts.path).strip("-")
+
+
+def redirect(endpoint, server=None):
+    """Return the URL of ``endpoint`` on the stand-in ``server``.
+
+    ``server`` defaults to ``ETBII_SPARQL_STANDIN``; ``endpoint`` is returned
+    unchanged when neither is set.
+    """
+    server = server or os.environ.get("ETBII_SPARQL_STANDIN")
+    if not server or endpoint.startswith(server):
+        return endpoint
+    return "%s/%s" % (server.rstrip("/"), slug(endpoint))
+
+
+def _open(path):
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def load_datasets(data_dir=DEFAULT_DATA_DIR):
+    """Return ``{slug: Graph}`` for the dataset files of ``data_dir``."""
+    datasets = {}
+    for path in sorted(Path(data_dir).glob("*")):
+        name = path.name[: -len(".gz")] if path.suffix == ".gz" else path.name
+        rdf_format = guess_format(name)
+        if rdf_format is None:
+            continue
+        graph = datasets.setdefault(name.rsplit(".", 1)[0], Graph())
+        with _open(path) as data:
+            graph.parse(data, format=rdf_format)
+    return datasets
+
+
+def _serialize_tsv(result):
+    # rdflib has a TSV results parser but no serializer
+    lines = ["\t".join("?" + name for name in result.vars)]
+    for row in result:
+        lines.append(
+            "\t".join("" if term is None else term.n3() for term in row)
+        )
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _negotiate(accept, formats):
+    accept = (accept or "").lower()
+    for marker, rdflib_format, content_type in formats:
+        if marker in accept:
+            return rdflib_format, content_type
+    return formats[0][1:]
+
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    """SPARQL protocol handler answering from ``server.datasets``.
+
+    Like the real endpoints, it keeps connections alive and compresses the
+    responses for the clients accepting gzip.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately: no delayed ACK in between
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query).get("query", [None])[0]
+        self._answer(url.path, query)
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        if self.headers.get("Content-Type", "").startswith("application/sparql-query"):
+            query = body
+        else:
+            query = urllib.parse.parse_qs(body).get("query", [None])[0]
+        self._answer(url.path, query)
+
+    def _answer(self, path, query):
+        graph = self.server.datasets.get(path.strip("/"))
+        if graph is None:
+            return self._error(404, "no stand-in dataset for %s" % path)
+        if not query:
+            return self._error(400, "missing query parameter")
+        try:
+            with self.server.lock:
+                result = graph.query(query, initNs=INIT_NS)
+                if result.type in ("CONSTRUCT", "DESCRIBE"):
+                    rdf_format, content_type = _negotiate(
+                        self.headers.get("Accept"), _GRAPH_FORMATS
+                    )
+                    body = result.graph.serialize(format=rdf_format, encoding="utf-8")
+                else:
+                    rdf_format, content_type = _negotiate(
+                        self.headers.get("Accept"), _RESULT_FORMATS
+                    )
+                    if rdf_format == "tsv":
+                        body = _serialize_tsv(result)
+                    else:
+                        body = result.serialize(format=rdf_format, encoding="utf-8")
+        except Exception as error:  # parse and evaluation errors
+            return self._error(400, "%s: %s" % (type(error).__name__, error))
+        self._send(200, content_type + "; charset=utf-8", body)
+
+    def _error(self, status, message):
+        self._send(status, "text/plain; charset=utf-8", message.encode("utf-8"))
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class StandinServer(http.server.ThreadingHTTPServer):
+    """HTTP server exposing each dataset at ``/<slug>``.
+
+    rdflib's SPARQL parser is not thread-safe, queries are evaluated one at
+    a time.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, datasets, host="127.0.0.1", port=DEFAULT_PORT, verbose=False):
+        super().__init__((host, port), StandinHandler)
+        self.datasets = datasets
+        self.lock = threading.Lock()
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+
+def start(data_dir=DEFAULT_DATA_DIR, port=0):
+    """Serve the datasets of ``data_dir`` from a background thread.
+
+    Returns the server; its ``url`` is the value to give to
+    ``ETBII_SPARQL_STANDIN``, ``shutdown()`` stops it.
+    """
+    server = StandinServer(load_datasets(data_dir), port=port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _bgp_triples(node, triples):
+    if isinstance(node, dict):
+        if getattr(node, "name", None) == "BGP":
+            triples.extend(node["triples"])
+        for value in node.values():
+            _bgp_triples(value, triples)
+    elif isinstance(node, (list, tuple)):
+        for value in node:
+            _bgp_triples(value, triples)
+    return triples
+
+
+def construct_query(query):
+    """Turn a SELECT or ASK ``query`` into the CONSTRUCT of its graph patterns.
+
+    Triple patterns with property paths are left out of the template.
+    """
+    algebra = prepareQuery(query, initNs=INIT_NS).algebra
+    template = []
+    for triple in _bgp_triples(algebra, []):
+        if all(hasattr(term, "n3") for term in triple):
+            line = " ".join(term.n3() for term in triple) + " ."
+            if line not in template:
+                template.append(line)
+    prologue, body = split_prologue(query)
+    where = None
+    for kind, text, start in tokenize(body):
+        if kind == "other" and "{" in text:
+            where = start + text.index("{")
+            break
+    if where is None or not template:
+        raise ValueError("no graph pattern to record in the query")
+    end = last_brace(body)
+    modifiers = body[end + 1:]
+    return "%sCONSTRUCT {\n    %s\n} WHERE %s%s" % (
+        prologue,
+        "\n    ".join(template),
+        body[where : end + 1],
+        modifiers,
+    )
+
+
+def record(endpoint, query, data_dir=DEFAULT_DATA_DIR):
+    """Append the triples matched by ``query`` on ``endpoint`` to its dataset.
+
+    Returns the number of recorded triples. The live endpoint is queried
+    directly, bypassing the response cache and the stand-in redirection.
+    """
+    if prepareQuery(query, initNs=INIT_NS).algebra.name in ("SelectQuery", "AskQuery"):
+        query = construct_query(query)
+    sparql = SPARQLWrapper(endpoint)
+    sparql.setQuery(query)
+    graph = sparql.queryAndConvert()
+    os.makedirs(data_dir, exist_ok=True)
+    with open(Path(data_dir, slug(endpoint) + ".nt"), "ab") as dataset:
+        dataset.write(graph.serialize(format="nt", encoding="utf-8"))
+    return len(graph)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data", default=str(DEFAULT_DATA_DIR), help="dataset directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve the recorded datasets")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve.add_argument("--verbose", action="store_true", help="log every request")
+    rec = commands.add_parser("record", help="record the triples of queries")
+    rec.add_argument("endpoint")
+    rec.add_argument("queries", nargs="+", help="files holding one query each")
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        for path in args.queries:
+            query = Path(path).read_text(encoding="utf-8")
+            print(f"{path}: {record(args.endpoint, query, args.data)} triples")
+        return 0
+
+    datasets = load_datasets(args.data)
+    server = StandinServer(datasets, args.host, args.port, args.verbose)
+    for name, graph in sorted(datasets.items()):
+        print(f"{server.url}/{name}: {len(graph)} triples")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,271 @@
+"""Compact, indexed in-memory store for rdflib graphs.
+
+rdflib's default ``Memory`` store keeps every triple as Python objects in
+several nested dictionaries, a few hundred bytes per triple: fine for the
+SNP example of notebook 1, not for a full Bgee CONSTRUCT result in notebook
+3. :class:`CompactStore` encodes every term once in a :class:`TermDictionary`
+and keeps the triples as three sorted integer arrays, in SPO, POS and OSP
+order. A triple pattern is answered by a binary search on the index whose
+leading columns are the bound terms, and the store costs 36 bytes per triple
+plus one entry per distinct term.
+
+The store plugs into rdflib, so ``Graph`` code, ``Graph.query`` included,
+works unchanged::
+
+    from etbii.store import CompactStore
+
+    KG = rdflib.Graph(store=CompactStore())
+    KG += results
+
+``rdflib.Graph(store="Compact")`` works too once this module is imported.
+Added triples are buffered and merged into the indexes on the next lookup,
+so bulk loads stay linear. The store holds a single graph (no contexts).
+"""
+
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+from rdflib import Literal, URIRef, plugin
+from rdflib.store import Store
+
+DTYPE = np.int32
+
+# Column order of each index, and the index answering each set of bound
+# positions (subject, predicate, object) with the order of its key.
+ORDERS = {"spo": (0, 1, 2), "pos": (1, 2, 0), "osp": (2, 0, 1)}
+_PLANS = {
+    (False, False, False): "spo",
+    (True, False, False): "spo",
+    (True, True, False): "spo",
+    (True, True, True): "spo",
+    (False, True, False): "pos",
+    (False, True, True): "pos",
+    (False, False, True): "osp",
+    (True, False, True): "osp",
+}
+
+
+class TermDictionary:
+    """Bidirectional mapping between rdflib terms and integer ids."""
+
+    def __init__(self):
+        self._ids = {}
+        self._terms = []
+        self._strings = None
+
+    def __len__(self):
+        return len(self._terms)
+
+    @classmethod
+    def from_terms(cls, terms):
+        """Return the dictionary giving each of ``terms`` its position as id.
+
+        ``terms`` are distinct for rdflib: of two equal terms, :meth:`lookup`
+        would only return the first one.
+        """
+        dictionary = cls()
+        dictionary._terms = list(terms)
+        for term_id, term in enumerate(dictionary._terms):
+            dictionary._ids.setdefault(term, term_id)
+        return dictionary
+
+    def lookup(self, term):
+        """Return the id of ``term``, ``None`` when it is not in the dictionary."""
+        return self._ids.get(term)
+
+    def encode(self, term):
+        """Return the id of ``term``, adding it to the dictionary if needed."""
+        term_id = self._ids.get(term)
+        if term_id is None:
+            term_id = self._ids[term] = len(self._terms)
+            self._terms.append(term)
+        return term_id
+
+    def decode(self, term_id):
+        return self._terms[term_id]
+
+    def _sorted_strings(self):
+        # IRIs and literals sorted by their string, rebuilt after additions
+        if self._strings is None or self._strings[0] != len(self._terms):
+            pairs = sorted(
+                (str(term), term_id)
+                for term_id, term in enumerate(self._terms)
+                if isinstance(term, (URIRef, Literal))
+            )
+            self._strings = (
+                len(self._terms),
+                [string for string, _ in pairs],
+                [term_id for _, term_id in pairs],
+            )
+        return self._strings[1:]
+
+    def prefixed(self, prefix):
+        """Return the ids of the IRIs and literals whose string starts with ``prefix``."""
+        strings, term_ids = self._sorted_strings()
+        start = end = bisect_left(strings, prefix)
+        while end < len(strings) and strings[end].startswith(prefix):
+            end += 1
+        return term_ids[start:end]
+
+    def containing(self, text):
+        """Return the ids of the IRIs and literals whose string contains ``text``."""
+        strings, term_ids = self._sorted_strings()
+        return [term_id for string, term_id in zip(strings, term_ids) if text in string]
+
+
+def sort_rows(rows):
+    """Return the ``(n, 3)`` array ``rows`` sorted and without duplicates."""
+    rows = rows[np.lexsort(rows.T[::-1])]
+    if len(rows) > 1:
+        keep = np.empty(len(rows), dtype=bool)
+        keep[0] = True
+        np.any(rows[1:] != rows[:-1], axis=1, out=keep[1:])
+        rows = rows[keep]
+    return rows
+
+
+def build_indexes(spo):
+    """Return the SPO/POS/OSP indexes of the sorted, unique ``spo`` rows."""
+    indexes = {"spo": spo}
+    for name in ("pos", "osp"):
+        indexes[name] = sort_rows(spo[:, ORDERS[name]])
+    return indexes
+
+
+def index_range(index, key):
+    """Return the rows of the sorted ``index`` whose leading columns equal ``key``."""
+    low, high = 0, len(index)
+    for column, value in enumerate(key):
+        values = index[low:high, column]
+        low, high = (
+            low + int(np.searchsorted(values, value, "left")),
+            low + int(np.searchsorted(values, value, "right")),
+        )
+        if low == high:
+            break
+    return index[low:high]
+
+
+class CompactStore(Store):
+    """rdflib store keeping integer-encoded triples in sorted index arrays."""
+
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    def __init__(self, configuration=None, identifier=None, terms=None, indexes=None):
+        super().__init__(configuration)
+        self.identifier = identifier
+        self.terms = TermDictionary() if terms is None else terms
+        empty = np.empty((0, 3), dtype=DTYPE)
+        self._indexes = indexes or {name: empty for name in ORDERS}
+        self._pending = array("i")
+        self._namespace = {}
+        self._prefix = {}
+
+    def _flush(self):
+        if not self._pending:
+            return
+        added = np.frombuffer(self._pending, dtype=DTYPE).reshape(-1, 3)
+        spo = sort_rows(np.concatenate([self._indexes["spo"], added]))
+        self._indexes = build_indexes(spo)
+        self._pending = array("i")
+
+    def _match(self, pattern):
+        """Return the SPO rows matching ``pattern``, ``None`` for no match."""
+        self._flush()
+        ids = []
+        for term in pattern:
+            if term is None:
+                ids.append(None)
+                continue
+            term_id = self.terms.lookup(term)
+            if term_id is None:
+                return None
+            ids.append(term_id)
+        name = _PLANS[tuple(term_id is not None for term_id in ids)]
+        order = ORDERS[name]
+        key = [ids[position] for position in order if ids[position] is not None]
+        rows = index_range(self._indexes[name], key)
+        return rows[:, np.argsort(order)] if name != "spo" else rows
+
+    def indexes(self):
+        """Return the ``{"spo": ..., "pos": ..., "osp": ...}`` index arrays."""
+        self._flush()
+        return self._indexes
+
+    def ids(self, triple_pattern):
+        """Return the triples matching ``triple_pattern`` as an ``(n, 3)`` id array."""
+        rows = self._match(triple_pattern)
+        return np.empty((0, 3), dtype=DTYPE) if rows is None else rows
+
+    def add(self, triple, context, quoted=False):
+        Store.add(self, triple, context, quoted)
+        self._pending.extend(self.terms.encode(term) for term in triple)
+
+    def remove(self, triple, context=None):
+        Store.remove(self, triple, context)
+        self._flush()
+        spo = self._indexes["spo"]
+        keep = np.zeros(len(spo), dtype=bool)
+        for position, term in enumerate(triple):
+            if term is None:
+                continue
+            term_id = self.terms.lookup(term)
+            if term_id is None:
+                return
+            keep |= spo[:, position] != term_id
+        if not keep.all():
+            self._indexes = build_indexes(spo[keep])
+
+    def triples(self, triple_pattern, context=None):
+        rows = self._match(triple_pattern)
+        if rows is None:
+            return
+        decode = self.terms.decode
+        for subject, predicate, obj in rows.tolist():
+            yield (decode(subject), decode(predicate), decode(obj)), iter(())
+
+    def __len__(self, context=None):
+        self._flush()
+        return len(self._indexes["spo"])
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    def bind(self, prefix, namespace, override=True):
+        bound_namespace = self._namespace.get(prefix)
+        bound_prefix = self._prefix.get(namespace)
+        if bound_prefix is None and bound_namespace is not None:
+            bound_prefix = self._prefix.get(bound_namespace)
+        if override:
+            if bound_prefix is not None:
+                del self._namespace[bound_prefix]
+            if bound_namespace is not None:
+                del self._prefix[bound_namespace]
+            self._prefix[namespace] = prefix
+            self._namespace[prefix] = namespace
+        else:
+            namespace = namespace if bound_namespace is None else bound_namespace
+            prefix = prefix if bound_prefix is None else bound_prefix
+            self._prefix[namespace] = prefix
+            self._namespace[prefix] = namespace
+
+    def namespace(self, prefix):
+        return self._namespace.get(prefix)
+
+    def prefix(self, namespace):
+        return self._prefix.get(namespace)
+
+    def namespaces(self):
+        yield from self._namespace.items()
+
+    def nbytes(self):
+        """Size of the index arrays in bytes (the terms are not counted)."""
+        self._flush()
+        return sum(index.nbytes for index in self._indexes.values())
+
+
+plugin.register("Compact", Store, "etbii.store", "CompactStore")
@@ -0,0 +1,159 @@
+"""Iterate over SPARQL SELECT results without materializing them.
+
+``sparql.query().convert()`` decodes the whole JSON document before the first
+row can be used, which for a UniProt query without ``limit`` means hundreds of
+MB of Python dicts. :func:`iter_bindings` parses the response incrementally
+and yields the bindings one at a time, in the same shape as the items of
+``results['results']['bindings']``::
+
+    for r in iter_bindings(sparql):
+        g.add_edge(r['P1_label']['value'], r['P2_label']['value'])
+
+Only the binding being decoded is kept in memory. Both the SPARQL 1.1 JSON
+and TSV result formats are supported.
+"""
+
+import codecs
+import json
+import re
+
+from SPARQLWrapper import JSON
+
+CHUNK_SIZE = 64 * 1024
+
+_BINDINGS = re.compile(r'"bindings"\s*:\s*\[')
+_SEPARATORS = " \t\r\n,"
+_DECODER = json.JSONDecoder()
+
+
+def _chunks(fileobj, chunk_size):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+            return
+        text = decoder.decode(data) if isinstance(data, bytes) else data
+        if text:
+            yield text
+
+
+def iter_json_bindings(fileobj, chunk_size=CHUNK_SIZE):
+    """Yield the bindings of a SPARQL JSON results document read from ``fileobj``."""
+    chunks = _chunks(fileobj, chunk_size)
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        match = _BINDINGS.search(buffer)
+        if match:
+            buffer = buffer[match.end():]
+            break
+        # keep enough text to match a key split across two chunks
+        buffer = buffer[-64:]
+    else:
+        raise ValueError("no results.bindings array in the SPARQL JSON response")
+
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in _SEPARATORS:
+            position += 1
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        try:
+            binding, end = _DECODER.raw_decode(buffer, position)
+        except ValueError:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError("truncated SPARQL JSON response") from None
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield binding
+        position = end
+        if position > chunk_size:
+            buffer = buffer[position:]
+            position = 0
+
+
+_ESCAPES = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+_SIMPLE_ESCAPES = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f"}
+_XSD = "http://www.w3.org/2001/XMLSchema#"
+
+
+def _unescape(text):
+    def replace(match):
+        code = match.group(1) or match.group(2)
+        if code:
+            return chr(int(code, 16))
+        return _SIMPLE_ESCAPES.get(match.group(3), match.group(3))
+
+    return _ESCAPES.sub(replace, text)
+
+
+def parse_tsv_term(text):
+    """Convert a term of a SPARQL TSV result into its SPARQL JSON form."""
+    if text.startswith("<") and text.endswith(">"):
+        return {"type": "uri", "value": text[1:-1]}
+    if text.startswith("_:"):
+        return {"type": "bnode", "value": text[2:]}
+    if text.startswith('"'):
+        end = text.rindex('"')
+        term = {"type": "literal", "value": _unescape(text[1:end])}
+        suffix = text[end + 1:]
+        if suffix.startswith("@"):
+            term["xml:lang"] = suffix[1:]
+        elif suffix.startswith("^^<"):
+            term["datatype"] = suffix[3:-1]
+        return term
+    if text in ("true", "false"):
+        return {"type": "literal", "value": text, "datatype": _XSD + "boolean"}
+    if re.fullmatch(r"[+-]?\d+", text):
+        datatype = "integer"
+    elif re.fullmatch(r"[+-]?\d*\.\d+", text):
+        datatype = "decimal"
+    else:
+        datatype = "double"
+    return {"type": "literal", "value": text, "datatype": _XSD + datatype}
+
+
+def iter_tsv_bindings(fileobj):
+    """Yield the bindings of a SPARQL TSV results document read from ``fileobj``."""
+    lines = iter(fileobj)
+    header = next(lines, None)
+    if header is None:
+        return
+    if isinstance(header, bytes):
+        header = header.decode("utf-8")
+    variables = [name.lstrip("?$") for name in header.rstrip("\r\n").split("\t")]
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        yield {
+            variable: parse_tsv_term(value)
+            for variable, value in zip(variables, line.split("\t"))
+            if value
+        }
+
+
+def iter_bindings(sparql, return_format=JSON):
+    """Run the SELECT query of ``sparql`` and yield its bindings one by one.
+
+    ``return_format`` is ``JSON`` or ``TSV``; the format actually returned
+    by the endpoint is taken from the ``Content-Type`` of the response.
+    """
+    sparql.setReturnFormat(return_format)
+    result = sparql.query()
+    content_type = result.info().get("content-type", "").lower()
+    try:
+        if "tab-separated" in content_type:
+            yield from iter_tsv_bindings(result.response)
+        else:
+            yield from iter_json_bindings(result.response)
+    finally:
+        result.response.close()
+
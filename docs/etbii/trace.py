@@ -0,0 +1,383 @@
+"""Timings of the SPARQL requests and RDF processing of the notebooks.
+
+A slow notebook may wait on an endpoint, download a large response, parse
+it, build an rdflib graph or evaluate a local query. :func:`install` wraps
+``SPARQLWrapper.query``, ``QueryResult.convert``, ``Graph.parse``,
+``Graph.query`` and ``Graph.serialize`` and appends one JSON line per call
+(a span) to the trace file:
+
+``sparql``
+    one request: endpoint, query hash, time to the response headers
+    (``ttfb``), total time until the response was converted or closed,
+    bytes read, rows of the converted result and whether the response cache
+    answered
+``parse``, ``query``, ``serialize``
+    the ``Graph`` calls, with the size of the input or output and the
+    number of triples or rows; the results of ``Graph.query`` are evaluated
+    in the call so that its time is the evaluation time
+
+Every span also records the notebook (``ETBII_TRACE_NOTEBOOK``) and the
+execution count and first line of the cell. The build traces the notebooks
+it executes with::
+
+    python -m etbii.build --trace
+
+which writes ``_build/html/reports/sparql_trace.jsonl`` and its summary,
+``sparql_trace.txt``. In a notebook, ``%load_ext etbii.trace`` or
+``ETBII_TRACE=1`` (``1`` for the default file, or a path) before importing
+:mod:`etbii` does the same. ``python -m etbii.trace`` prints the summary of
+a trace file.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from rdflib import Graph
+from SPARQLWrapper import SPARQLWrapper
+from SPARQLWrapper.Wrapper import QueryResult
+
+from etbii.cache import CachedResponse
+from etbii.query import normalize_query
+
+DEFAULT_TRACE_FILE = os.path.join("_build", "html", "reports", "sparql_trace.jsonl")
+DEFAULT_TOP = 20
+
+_tracer = None
+_tracer_lock = threading.Lock()
+_originals = {}
+
+
+def trace_path():
+    """Return the trace file configured by ``ETBII_TRACE``, ``None`` if unset."""
+    value = os.environ.get("ETBII_TRACE", "")
+    if value in ("", "0"):
+        return None
+    return DEFAULT_TRACE_FILE if value == "1" else value
+
+
+def query_hash(query):
+    """Short hash of the normalized text of ``query``."""
+    return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()[:12]
+
+
+class Tracer:
+    """Append spans to a JSON lines file, with the current notebook cell."""
+
+    def __init__(self, path):
+        self.path = path
+        self.notebook = os.environ.get("ETBII_TRACE_NOTEBOOK")
+        self.cell = None
+        self.source = None
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def pre_run_cell(self, info):
+        """IPython ``pre_run_cell`` callback: spans are attributed to this cell."""
+        from IPython import get_ipython
+
+        shell = get_ipython()
+        self.cell = shell.execution_count if shell is not None else None
+        lines = [line.strip() for line in (info.raw_cell or "").splitlines()]
+        self.source = next((line for line in lines if line), "")[:80]
+
+    def record(self, kind, started, seconds, **fields):
+        span = {
+            "kind": kind,
+            "notebook": self.notebook,
+            "cell": self.cell,
+            "source": self.source,
+            "started": started,
+            "seconds": seconds,
+        }
+        span.update(fields)
+        line = json.dumps(span) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class _CountingReader:
+    """Response wrapper counting the bytes read, records its span once."""
+
+    def __init__(self, response, span):
+        self._response = response
+        self._span = span
+        self.bytes = 0
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _count(self, data):
+        self.bytes += len(data)
+        return data
+
+    def read(self, *args):
+        return self._count(self._response.read(*args))
+
+    def read1(self, *args):
+        return self._count(self._response.read1(*args))
+
+    def readline(self, *args):
+        return self._count(self._response.readline(*args))
+
+    def readinto(self, buffer):
+        count = self._response.readinto(buffer)
+        self.bytes += count or 0
+        return count
+
+    def __iter__(self):
+        for line in self._response:
+            yield self._count(line)
+
+    def finish(self, **fields):
+        span, self._span = self._span, None
+        if span is not None and _tracer is not None:
+            seconds = time.perf_counter() - span.pop("clock")
+            _tracer.record("sparql", seconds=seconds, bytes=self.bytes, **span, **fields)
+
+    def close(self):
+        self.finish()
+        self._response.close()
+
+
+def _rows(converted):
+    if isinstance(converted, dict):
+        if "boolean" in converted:
+            return 1
+        return len(converted.get("results", {}).get("bindings", []))
+    if isinstance(converted, Graph):
+        return len(converted)
+    return None
+
+
+def _size(source):
+    if isinstance(source, str) and os.path.isfile(source):
+        return os.path.getsize(source)
+    return None
+
+
+def _traced_query(self):
+    started, clock = time.time(), time.perf_counter()
+    result = _originals["query"](self)
+    span = {
+        "started": started,
+        "clock": clock,
+        "endpoint": self.endpoint,
+        "query": query_hash(self.queryString),
+        "ttfb": time.perf_counter() - clock,
+        "cached": isinstance(result.response, CachedResponse),
+    }
+    result.response = _CountingReader(result.response, span)
+    return result
+
+
+def _traced_convert(self):
+    clock = time.perf_counter()
+    converted = _originals["convert"](self)
+    if isinstance(self.response, _CountingReader):
+        self.response.finish(rows=_rows(converted), convert=time.perf_counter() - clock)
+    return converted
+
+
+def _traced_parse(self, source=None, *args, **kwargs):
+    before = len(self)
+    started, clock = time.time(), time.perf_counter()
+    result = _originals["parse"](self, source, *args, **kwargs)
+    seconds = time.perf_counter() - clock
+    data = kwargs.get("data")
+    location = kwargs.get("location") or source
+    if data is not None:
+        name, size = "data", len(data)
+    else:
+        name = location if isinstance(location, str) else type(location).__name__
+        size = _size(location)
+    _tracer.record(
+        "parse",
+        started,
+        seconds,
+        input=name,
+        format=kwargs.get("format"),
+        bytes=size,
+        rows=len(self) - before,
+    )
+    return result
+
+
+def _traced_graph_query(self, query_object, *args, **kwargs):
+    started, clock = time.time(), time.perf_counter()
+    result = _originals["graph_query"](self, query_object, *args, **kwargs)
+    rows = len(result)  # evaluates a SELECT now
+    _tracer.record(
+        "query",
+        started,
+        time.perf_counter() - clock,
+        endpoint="local",
+        query=query_hash(query_object) if isinstance(query_object, str) else None,
+        rows=rows,
+    )
+    return result
+
+
+def _traced_serialize(self, destination=None, format="turtle", *args, **kwargs):
+    started, clock = time.time(), time.perf_counter()
+    result = _originals["serialize"](self, destination, format, *args, **kwargs)
+    seconds = time.perf_counter() - clock
+    size = len(result) if isinstance(result, (bytes, str)) else _size(destination)
+    _tracer.record("serialize", started, seconds, format=format, bytes=size, rows=len(self))
+    return result
+
+
+_PATCHES = (
+    ("query", SPARQLWrapper, "query", _traced_query),
+    ("convert", QueryResult, "convert", _traced_convert),
+    ("parse", Graph, "parse", _traced_parse),
+    ("graph_query", Graph, "query", _traced_graph_query),
+    ("serialize", Graph, "serialize", _traced_serialize),
+)
+
+
+def install(path=None):
+    """Start tracing to ``path`` (default: :func:`trace_path` or the build report).
+
+    Returns the :class:`Tracer`; calling it again returns the same one.
+    """
+    global _tracer
+    with _tracer_lock:
+        if _tracer is not None:
+            return _tracer
+        _tracer = Tracer(path or trace_path() or DEFAULT_TRACE_FILE)
+        for name, owner, attribute, wrapper in _PATCHES:
+            _originals[name] = getattr(owner, attribute)
+            setattr(owner, attribute, wrapper)
+        return _tracer
+
+
+def uninstall():
+    """Stop tracing and restore the wrapped methods."""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            return
+        for name, owner, attribute, _ in _PATCHES:
+            setattr(owner, attribute, _originals.pop(name))
+        _tracer.close()
+        _tracer = None
+
+
+def load_ipython_extension(ipython):
+    tracer = install()
+    ipython.events.register("pre_run_cell", tracer.pre_run_cell)
+
+
+def unload_ipython_extension(ipython):
+    if _tracer is not None:
+        ipython.events.unregister("pre_run_cell", _tracer.pre_run_cell)
+    uninstall()
+
+
+def read_spans(path):
+    """Return the spans of the trace file ``path``."""
+    with open(path, encoding="utf-8") as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+def _format_bytes(size):
+    if size is None:
+        return "-"
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "%.0f %s" % (size, unit)
+        size /= 1024
+    return "%.1f GiB" % size
+
+
+def summarize(spans, top=DEFAULT_TOP):
+    """Return the text report of ``spans``: totals, slowest cells and requests."""
+    lines = ["%d spans" % len(spans), "", "kind        calls    seconds       bytes        rows"]
+    totals = defaultdict(lambda: [0, 0.0, None, 0])
+    for span in spans:
+        total = totals[span["kind"]]
+        total[0] += 1
+        total[1] += span["seconds"]
+        if span.get("bytes") is not None:
+            total[2] = (total[2] or 0) + span["bytes"]
+        total[3] += span.get("rows") or 0
+    for kind, (calls, seconds, size, rows) in sorted(totals.items()):
+        lines.append(
+            "%-10s %6d %10.3f %11s %11d" % (kind, calls, seconds, _format_bytes(size), rows)
+        )
+
+    # time spent waiting for the endpoints vs reading and converting responses
+    cells = defaultdict(lambda: defaultdict(float))
+    for span in spans:
+        key = (span.get("notebook") or "?", span.get("cell"), span.get("source") or "")
+        if span["kind"] == "sparql":
+            cells[key]["network"] += span.get("ttfb") or 0.0
+            cells[key]["read"] += span["seconds"] - (span.get("ttfb") or 0.0)
+        else:
+            cells[key][span["kind"]] += span["seconds"]
+    lines += ["", "slowest cells", "%-40s %5s %9s %9s %9s %9s %9s  %s" % (
+        "notebook", "cell", "total", "network", "read", "parse", "query", "code"
+    )]
+    ranked = sorted(cells.items(), key=lambda item: -sum(item[1].values()))
+    for (notebook, cell, source), times in ranked[:top]:
+        lines.append(
+            "%-40s %5s %9.3f %9.3f %9.3f %9.3f %9.3f  %s"
+            % (
+                notebook[:40],
+                "-" if cell is None else cell,
+                sum(times.values()),
+                times["network"],
+                times["read"],
+                times["parse"],
+                times["query"],
+                source,
+            )
+        )
+
+    requests = sorted(
+        (span for span in spans if span["kind"] == "sparql"), key=lambda span: -span["seconds"]
+    )
+    lines += ["", "slowest requests", "%-40s %-12s %8s %8s %11s %8s %s" % (
+        "endpoint", "query", "ttfb", "total", "bytes", "rows", "cached"
+    )]
+    for span in requests[:top]:
+        lines.append(
+            "%-40s %-12s %8.3f %8.3f %11s %8s %s"
+            % (
+                span["endpoint"][:40],
+                span["query"],
+                span.get("ttfb") or 0.0,
+                span["seconds"],
+                _format_bytes(span.get("bytes")),
+                "-" if span.get("rows") is None else span["rows"],
+                "yes" if span.get("cached") else "no",
+            )
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize a trace of the notebooks.")
+    parser.add_argument("path", nargs="?", default=DEFAULT_TRACE_FILE)
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP, help="cells and requests listed")
+    args = parser.parse_args(argv)
+    print(summarize(read_spans(args.path), args.top))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())